@@ -1,121 +1,385 @@
+import asyncio
 import logging
-import requests
+import httpx
 from sqlalchemy.ext.asyncio import AsyncSession
-from fastapi import APIRouter, Depends, HTTPException
-from app.crud import store_data_in_db, check_duplicate_data
-from app.db import get_db
-from app.schemas import DataIngestionResponse, DataCreate
+from fastapi import APIRouter, HTTPException
+from app.crud import store_rows, get_watermarks, update_watermarks, Row
+from app.db import AsyncSessionLocal
+from app.jobs import IngestionJob, ingestion_jobs
+from app.rollups import backfill_rollups
+from app.schemas import IngestionJobResponse, DataCreate
 from app.config import settings
+from app.fetch import feed_client
 from app.logger import get_logger
-import json
-from typing import List, Dict, Any
+from app.sources import file_source, INGEST_SOURCES, HTTP_SOURCE
+from app.streaming import MeasurementStreamParser
+import numpy as np
+import pandas as pd
+from datetime import datetime, timezone
+from itertools import chain, compress
+from typing import List, Dict, Any, AsyncGenerator, AsyncIterator, Optional, Sequence, Tuple
 
 router = APIRouter()
 logger = get_logger("data_ingestion")
 
 logger.setLevel(logging.ERROR)
 
-def fetch_data_from_json_server() -> List[DataCreate]:
-    try:
-        response = requests.get(settings.DATA_URL)
-        response.raise_for_status()
-        raw_data = response.json()
-        # logger.info(f"Number of records received: {len(raw_data)}")
-
-        # Log the raw data for inspection, truncate if too large
-        # raw_data_str = json.dumps(raw_data, indent=2)
-        # if len(raw_data_str) > 1000:
-        #     logger.info(f"Raw data received (truncated): {raw_data_str[:500]}...{raw_data_str[-500:]}")
-        # else:
-        #     logger.info(f"Raw data received: {raw_data_str}")
-
-        transformed_data, ignored_records = transform_data(raw_data)
-        # logger.info(f"Total ignored records: {ignored_records}")
-        return [DataCreate(**record) for record in transformed_data]
-    except requests.RequestException as e:
-        logger.error(f"Error fetching data from JSON server: {e}")
-        raise HTTPException(status_code=500, detail="Error fetching data")
-    except ValueError as e:
-        logger.error(f"Error transforming data: {e}")
-        raise HTTPException(status_code=500, detail=f"Error transforming data: {str(e)}")
-    except Exception as e:
-        logger.error(f"Unexpected error: {e}")
-        raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
+# Size of the HTTP body chunks handed to the streaming parser
+STREAM_CHUNK_BYTES = 64 * 1024
 
-def transform_data(raw_data: Any) -> (List[Dict[str, Any]], int):
-    transformed_data = []
-    ignored_records = 0
+# Function to fetch the whole feed as validated records (unconditionally)
+async def fetch_data_from_json_server() -> List[DataCreate]:
+    data: List[DataCreate] = []
+    async for frame in stream_measurements(conditional=False):
+        data.extend(DataCreate(label=label, measured_at=measured_at, value=value)
+                    for label, measured_at, value in frame_rows(frame))
+    return data
 
+def transform_data(raw_data: Any) -> (List[Dict[str, Any]], int):
     try:
         if isinstance(raw_data, list):
+            measurements = []
             for record in raw_data:
-                # logger.info(f"Processing record: {record}")
                 if isinstance(record, dict):
-                    process_record(record, transformed_data, ignored_records)
+                    measurements.extend(record.items())
                 else:
-                    logger.warning(f"Ignored entry with expected dict, got {type(record).__name__}: {record}")
-                    ignored_records += 1
+                    measurements.append((None, record))
         elif isinstance(raw_data, dict):
-            # logger.info(f"Processing raw_data as dict")
-            process_record(raw_data, transformed_data, ignored_records)
+            measurements = list(raw_data.items())
         else:
             logger.error(f"Expected list or dict, got {type(raw_data).__name__}: {raw_data}")
             raise ValueError(f"Expected list or dict, got {type(raw_data)}")
+        frame, ignored_records = transform_measurements(measurements)
     except Exception as e:
         logger.error(f"Error transforming data: {e}")
         raise ValueError(f"Error transforming data: {str(e)}")
 
-    return transformed_data, ignored_records
-
-def process_record(record: Dict[str, Any], transformed_data: List[Dict[str, Any]], ignored_records: int) -> None:
-    for timestamp, values in record.items():
-        # logger.info(f"Timestamp: {timestamp}, Values: {values}")
-        if isinstance(values, dict):
-            for label, value in values.items():
-                # logger.info(f"Label: {label}, Value: {value}")
-                # Ensure that value is a valid float
-                try:
-                    value = float(value)
-                    transformed_data.append({
-                        'label': label,
-                        'measured_at': timestamp,
-                        'value': value
-                    })
-                except (ValueError, TypeError):
-                    logger.warning(f"Ignored entry with invalid value for label {label} at {timestamp}: {value}")
-                    ignored_records += 1
-        else:
-            logger.warning(f"Ignored entry with expected dict, got {type(values).__name__}: {values}")
-            ignored_records += 1
+    return frame.to_dict("records"), ignored_records
+
+# Function to transform one {timestamp: {label: value}} record, returns the updated number of ignored entries
+def process_record(record: Dict[str, Any], transformed_data: List[Dict[str, Any]], ignored_records: int = 0) -> int:
+    frame, ignored = transform_measurements(list(record.items()))
+    transformed_data.extend(frame.to_dict("records"))
+    return ignored_records + ignored
+
+# Function to parse feed timestamps (epoch seconds/milliseconds or ISO 8601) in bulk to naive UTC datetimes (NaT if invalid)
+def parse_timestamps(timestamps: Sequence[str]) -> pd.Series:
+    timestamps = pd.Series(timestamps, dtype=object)
+    epochs = pd.to_numeric(timestamps, errors="coerce")
+    is_epoch = epochs.notna()
+    parsed = pd.Series(pd.NaT, index=timestamps.index, dtype="datetime64[ns]")
+    if is_epoch.any():
+        epochs = epochs[is_epoch].astype("float64")
+        # Same rule as pydantic: values beyond 2e10 are milliseconds, seconds otherwise
+        milliseconds = epochs.where(epochs.abs() > 2e10, epochs * 1000)
+        parsed[is_epoch] = pd.to_datetime(milliseconds, unit="ms", errors="coerce").astype("datetime64[ns]")
+    if not is_epoch.all():
+        iso = pd.to_datetime(timestamps[~is_epoch], format="ISO8601", utc=True, errors="coerce")
+        parsed[~is_epoch] = iso.dt.tz_convert(None).astype("datetime64[ns]")
+    return parsed
 
-@router.post("/", response_model=DataIngestionResponse)
-async def ingest_data(db: AsyncSession = Depends(get_db)) -> DataIngestionResponse:
-    data = fetch_data_from_json_server()
+# Function to convert a feed value to a float like float() does, NaN when float() rejects it
+def _to_float(value: Any) -> float:
     try:
-        await store_data_in_db(data, db)
-    except Exception as e:
-        logger.error(f"Error ingesting data: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Error ingesting data: {str(e)}. Check server logs for more details.")
-    return DataIngestionResponse(message="Data ingested successfully")
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+# Function to transform (timestamp, {label: value}) measurements into label / measured_at / value columns.
+# Values are coerced to floats in bulk and rejected entries are counted with masks instead of per-row checks;
+# labels whose high-water mark is at or after the timestamp are already stored and dropped without being counted.
+# With typed=True, measured_at is parsed to naive UTC datetimes and unparsable timestamps are rejected too, so the
+# frame already satisfies the DataCreate schema as a whole.
+def transform_measurements(measurements: Sequence[Tuple[Optional[str], Any]],
+                           watermarks: Optional[Dict[str, datetime]] = None,
+                           typed: bool = False) -> Tuple[pd.DataFrame, int]:
+    # A mask rather than a filtered list of pairs: it avoids allocating one tuple per measurement
+    valid = [timestamp is not None and isinstance(values, dict) for timestamp, values in measurements]
+    timestamps = [timestamp for timestamp, _ in measurements]
+    values = [values for _, values in measurements]
+    ignored_records = len(valid) - sum(valid)
+    if ignored_records:
+        logger.warning(f"Ignored {ignored_records} entries that were not {{timestamp: {{label: value}}}} objects.")
+        timestamps = list(compress(timestamps, valid))
+        values = list(compress(values, valid))
+    if not values:
+        measured_at = pd.Series([], dtype="datetime64[ns]" if typed else object)
+        return pd.DataFrame({"label": [], "measured_at": measured_at, "value": []}), ignored_records
+
+    counts = np.fromiter(map(len, values), dtype=np.int64, count=len(values))
+    total = int(counts.sum())
+    parsed = None
+    if watermarks or typed:
+        # Timestamps are parsed once per measurement, before being repeated for each of its labels
+        parsed = np.repeat(parse_timestamps(timestamps).to_numpy(), counts)
+    frame = pd.DataFrame({
+        "label": np.fromiter(chain.from_iterable(values), dtype=object, count=total),
+        "measured_at": parsed if typed else np.repeat(np.array(timestamps, dtype=object), counts),
+        "value": pd.Series(list(chain.from_iterable(map(dict.values, values))), dtype=object),
+    })
+
+    if watermarks:
+        limits = frame["label"].map(watermarks).astype("datetime64[ns]").to_numpy()
+        # Unknown labels (NaT limit) and unparsable timestamps (NaT measured_at) are kept
+        keep = np.isnat(limits) | np.isnat(parsed) | (parsed > limits)
+        frame = frame[keep]
+
+    # One rule for every value, float(): numpy's conversion applies it to the whole batch at once, and when one
+    # value fails it the batch is converted value by value, so a value is accepted whatever the rest of its batch
+    try:
+        coerced = np.array(frame["value"].to_numpy(), dtype=np.float64)
+    except (TypeError, ValueError):
+        coerced = np.fromiter(map(_to_float, frame["value"]), dtype=np.float64, count=len(frame))
+    frame = frame.assign(value=coerced)
+    invalid = np.isnan(coerced)
+    if typed:
+        invalid |= np.isnat(frame["measured_at"].to_numpy())
+    rejected = int(invalid.sum())
+    if rejected:
+        logger.warning(f"Ignored {rejected} entries with invalid values or timestamps.")
+        frame = frame[~invalid]
+    return frame.reset_index(drop=True), ignored_records + rejected
 
-async def ingest_data_from_main(db: AsyncSession):
-    data = fetch_data_from_json_server()
+# Function to turn a typed frame into plain rows for the bulk writer
+def frame_rows(frame: pd.DataFrame) -> List[Row]:
+    # datetime64[us] values convert straight to datetime objects, without going through pandas Timestamps
+    measured_at = frame["measured_at"].to_numpy(dtype="datetime64[us]").astype(object)
+    return list(zip(frame["label"].tolist(), measured_at.tolist(), frame["value"].tolist()))
 
-    # Check for duplicates
-    duplicates = await check_duplicate_data(data, db)
-    if duplicates:
-        logger.info("Duplicate data found, skipping ingestion.")
+# Function to parse a stream of feed bytes into typed frames of at most about batch_size rows
+async def _iter_batches(chunks: AsyncIterator[bytes], parser: MeasurementStreamParser, source_name: str,
+                        batch_size: int, watermarks: Optional[Dict[str, datetime]],
+                        progress: Optional[IngestionJob] = None) -> AsyncIterator[pd.DataFrame]:
+    measurements: List[Tuple[Optional[str], Any]] = []
+    pending = 0
+    ignored_records = 0
+
+    def transform() -> pd.DataFrame:
+        nonlocal ignored_records
+        frame, ignored = transform_measurements(measurements, watermarks, typed=True)
+        ignored_records += ignored
+        if progress is not None:
+            progress.fetched += pending
+            progress.transformed += len(frame)
+            progress.rejected += ignored
+        return frame
+
+    async for chunk in chunks:
+        for timestamp, values in parser.feed(chunk):
+            measurements.append((timestamp, values))
+            pending += len(values) if isinstance(values, dict) else 1
+            if pending >= batch_size:
+                frame = transform()
+                if len(frame):
+                    yield frame
+                measurements, pending = [], 0
+    for timestamp, values in parser.close():
+        measurements.append((timestamp, values))
+        pending += len(values) if isinstance(values, dict) else 1
+    frame = transform()
+    if len(frame):
+        yield frame
+    logger.info(f"Total ignored records for {source_name}: {ignored_records}")
+
+# Function to parse a streamed feed response into typed frames
+def _iter_response_batches(response: httpx.Response, batch_size: int, watermarks: Optional[Dict[str, datetime]],
+                           progress: Optional[IngestionJob] = None) -> AsyncIterator[pd.DataFrame]:
+    return _iter_batches(response.aiter_bytes(STREAM_CHUNK_BYTES), MeasurementStreamParser(), str(response.request.url),
+                         batch_size, watermarks, progress)
+
+# Function to stream the measurements of the local db.json, skipped when unchanged since its last ingestion
+async def _stream_local_file(batch_size: int, conditional: bool, watermarks: Optional[Dict[str, datetime]],
+                             progress: Optional[IngestionJob] = None) -> AsyncGenerator[pd.DataFrame, None]:
+    fingerprint = file_source.fingerprint()
+    if conditional and file_source.unchanged(fingerprint):
+        logger.info("Feed file not modified since the last ingestion, nothing to read.")
         return
+    parser = MeasurementStreamParser(root_key="measurements")
+    async for batch in _iter_batches(file_source.chunks(), parser, file_source.path, batch_size, watermarks, progress):
+        yield batch
+    # Reached only once the consumer has stored every batch
+    if conditional:
+        file_source.remember(fingerprint)
+
+# Function to stream the whole feed with a single request
+async def _stream_whole_feed(batch_size: int, conditional: bool, watermarks: Optional[Dict[str, datetime]],
+                             params: Dict[str, str], progress: Optional[IngestionJob] = None) -> AsyncGenerator[pd.DataFrame, None]:
+    async with feed_client.stream(settings.DATA_URL, params=params or None, conditional=conditional) as response:
+        if response is None:
+            logger.info("Feed not modified since the last ingestion, nothing to download.")
+            return
+        async for batch in _iter_response_batches(response, batch_size, watermarks, progress):
+            yield batch
+        # Reached only once the consumer has stored every batch
+        if conditional:
+            feed_client.remember(response)
 
+# Function to stream the feed as json-server slices downloaded concurrently, batches being yielded as they complete
+async def _stream_feed_slices(batch_size: int, conditional: bool, watermarks: Optional[Dict[str, datetime]],
+                              params: Dict[str, str], progress: Optional[IngestionJob] = None) -> AsyncGenerator[pd.DataFrame, None]:
+    total = await feed_client.count(settings.DATA_URL, params)
+    if total is None:
+        logger.warning("The feed does not report its size, falling back to a single request.")
+        async for batch in _stream_whole_feed(batch_size, conditional, watermarks, params, progress):
+            yield batch
+        return
+
+    page_size = settings.FETCH_PAGE_SIZE
+    slices = [(start, min(start + page_size, total)) for start in range(0, total, page_size)]
+    # Slices split the top-level items of the collection: with a single slice, or fewer items than concurrent
+    # downloads (the datalogger feed has two), they only add requests
+    if len(slices) < 2 or total < settings.FETCH_CONCURRENCY:
+        logger.info(f"The feed has {total} items, too few to slice: falling back to a single request.")
+        async for batch in _stream_whole_feed(batch_size, conditional, watermarks, params, progress):
+            yield batch
+        return
+    semaphore = asyncio.Semaphore(settings.FETCH_CONCURRENCY)
+    # Bounded so that downloads wait for the database writer instead of piling batches up in memory
+    queue: asyncio.Queue = asyncio.Queue(maxsize=2 * settings.FETCH_CONCURRENCY)
+    slice_done = object()
+    responses: List[httpx.Response] = []
+
+    async def fetch_slice(start: int, end: int):
+        try:
+            async with semaphore:
+                slice_params = {**params, "_start": str(start), "_end": str(end)}
+                async with feed_client.stream(settings.DATA_URL, params=slice_params,
+                                              conditional=conditional) as response:
+                    if response is not None:
+                        async for batch in _iter_response_batches(response, batch_size, watermarks, progress):
+                            await queue.put(batch)
+                        responses.append(response)
+        except Exception as e:
+            await queue.put(e)
+            return
+        await queue.put(slice_done)
+
+    tasks = [asyncio.create_task(fetch_slice(start, end)) for start, end in slices]
     try:
-        await store_data_in_db(data, db)
-    except Exception as e:
-        logger.error(f"Error ingesting data: {str(e)}")
-        # Display a summary of errors
-        print("----- ERROR LOGS -----")
-        with open('data_ingestion.log', 'r') as log_file:
-            error_logs = log_file.readlines()[-5:]  # Last 5 lines of logs
-        for log in error_logs:
-            if log.strip():  # Ignore empty lines
-                print(log)
-        raise Exception(f"Error ingesting data: {str(e)}. Check server logs for more details.")
+        finished = 0
+        while finished < len(tasks):
+            item = await queue.get()
+            if item is slice_done:
+                finished += 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+        logger.info(f"Fetched {len(slices)} slices of the feed, {len(slices) - len(responses)} not modified.")
+        if conditional:
+            for response in responses:
+                feed_client.remember(response)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+# Function to stream the feed from the configured source as typed label / measured_at / value frames
+async def stream_measurements(batch_size: Optional[int] = None, conditional: bool = True,
+                              watermarks: Optional[Dict[str, datetime]] = None,
+                              progress: Optional[IngestionJob] = None) -> AsyncIterator[pd.DataFrame]:
+    if settings.INGEST_SOURCE not in INGEST_SOURCES:
+        raise HTTPException(status_code=500, detail=f"Invalid INGEST_SOURCE '{settings.INGEST_SOURCE}'. "
+                                                    f"Must be one of {INGEST_SOURCES}.")
+    if settings.INGEST_SOURCE == HTTP_SOURCE:
+        # Fetch and transform errors are already turned into HTTP errors by the JSON server stream
+        batches = stream_data_from_json_server(batch_size, conditional, watermarks, progress)
+    else:
+        batches = _stream_local_file(batch_size or settings.INGEST_CHUNK_SIZE, conditional, watermarks, progress)
+    try:
+        async for batch in batches:
+            yield batch
+    except OSError as e:
+        logger.error(f"Error reading feed file: {e}")
+        raise HTTPException(status_code=500, detail="Error reading data file")
+    except ValueError as e:
+        logger.error(f"Error transforming data: {e}")
+        raise HTTPException(status_code=500, detail=f"Error transforming data: {str(e)}")
+    finally:
+        await batches.aclose()
+
+# Function to stream the JSON server feed as typed label / measured_at / value frames, without loading the whole document
+async def stream_data_from_json_server(batch_size: Optional[int] = None, conditional: bool = True,
+                                       watermarks: Optional[Dict[str, datetime]] = None,
+                                       progress: Optional[IngestionJob] = None) -> AsyncGenerator[pd.DataFrame, None]:
+    batch_size = batch_size or settings.INGEST_CHUNK_SIZE
+    params = {}
+    if watermarks and settings.FETCH_SINCE_PARAM:
+        # The oldest watermark keeps every label complete when the source filters server-side
+        since = min(watermarks.values()).replace(tzinfo=timezone.utc)
+        params[settings.FETCH_SINCE_PARAM] = str(int(since.timestamp() * 1000))
+    if settings.FETCH_PAGE_SIZE > 0:
+        batches = _stream_feed_slices(batch_size, conditional, watermarks, params, progress)
+    else:
+        batches = _stream_whole_feed(batch_size, conditional, watermarks, params, progress)
+    try:
+        async for batch in batches:
+            yield batch
+    except httpx.HTTPError as e:
+        logger.error(f"Error fetching data from JSON server: {e}")
+        raise HTTPException(status_code=500, detail="Error fetching data")
+    except ValueError as e:
+        logger.error(f"Error transforming data: {e}")
+        raise HTTPException(status_code=500, detail=f"Error transforming data: {str(e)}")
+    finally:
+        await batches.aclose()
+
+# Function to run a full ingestion, each batch being stored as soon as it has been parsed
+async def run_ingestion(db: AsyncSession, progress: Optional[IngestionJob] = None) -> int:
+    watermarks = await get_watermarks(db)
+    latest: Dict[str, datetime] = {}
+    stored = 0
+    async for frame in stream_measurements(watermarks=watermarks, progress=progress):
+        # The frame was validated as a whole by the transform: rows go to the bulk writer without a model per row,
+        # and records already stored are skipped by the (label, measured_at) unique key
+        stored += await store_rows(frame_rows(frame), db, on_conflict="ignore")
+        if progress is not None:
+            progress.inserted = stored
+        for label, measured_at in frame.groupby("label", sort=False)["measured_at"].max().items():
+            measured_at = measured_at.to_pydatetime()
+            if label not in latest or measured_at > latest[label]:
+                latest[label] = measured_at
+    # Slices may complete out of order, so watermarks only move once every batch has been stored
+    await update_watermarks(db, latest)
+    logger.info(f"Ingestion finished, {stored} new records processed.")
+    return stored
+
+# Function running one ingestion job with its own session, the request that triggered it being long gone
+async def _run_ingestion_job(job: IngestionJob):
+    async with AsyncSessionLocal() as db:
+        # Data stored before the rollups existed gets them before any new row is added to them
+        await backfill_rollups(db)
+        await run_ingestion(db, progress=job)
+
+# Function to build the status response of a job
+def _job_response(job: IngestionJob) -> IngestionJobResponse:
+    return IngestionJobResponse(
+        job_id=job.id,
+        status=job.status,
+        created_at=job.created_at,
+        started_at=job.started_at,
+        finished_at=job.finished_at,
+        fetched=job.fetched,
+        transformed=job.transformed,
+        rejected=job.rejected,
+        inserted=job.inserted,
+        rows_per_second=round(job.rows_per_second, 1),
+        error=job.error
+    )
+
+# Function to start a background ingestion, or get the one already in progress
+def start_ingestion_job() -> IngestionJob:
+    return ingestion_jobs.submit(_run_ingestion_job)
+
+@router.post("/", response_model=IngestionJobResponse, status_code=202)
+async def ingest_data() -> IngestionJobResponse:
+    # The ingestion runs in the background; a trigger received while one is in progress returns that job
+    job = start_ingestion_job()
+    return _job_response(job)
+
+@router.get("/{job_id}", response_model=IngestionJobResponse)
+async def get_ingestion_job(job_id: str) -> IngestionJobResponse:
+    job = ingestion_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Ingestion job not found")
+    return _job_response(job)
@@ -1,37 +1,189 @@
 import logging
-from fastapi import APIRouter, Depends, Query, HTTPException
+from dataclasses import replace
+from fastapi import APIRouter, Depends, Header, Query, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from app.crud import get_data, get_aggregated_data
-from app.db import get_db
+from app.cache import CacheEntry, Flight, data_versions, result_cache
+from app.config import settings
+from app.crud import DataPage, page_range, page_size, query_range, stream_data, get_aggregated_data
+from app.db import get_db, get_session_factory
+from app.responses import DATA_FORMATS, JSON_MEDIA_TYPE, NDJSON_MEDIA_TYPE, TABULAR_MEDIA_TYPES, encode_aggregates, \
+    encode_columns, entity_tag, etag_matches, http_date, negotiate, stream_json, stream_ndjson
 from app.schemas import DataRetrievalResponse, AggregatedDataRetrievalResponse
-from typing import Optional, Literal
+from typing import AsyncGenerator, AsyncIterator, Callable, Dict, Hashable, List, Optional, Literal, Sequence
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
-@router.get("/data", response_model=DataRetrievalResponse)
+@router.get("/data", response_model=DataRetrievalResponse,
+            responses={200: {"content": {media_type: {} for media_type in DATA_FORMATS.values()
+                                         if media_type != JSON_MEDIA_TYPE}},
+                       406: {"description": "Representation not available (pyarrow is not installed)"}})
 async def retrieve_data(
+    request: Request,
     datalogger: str = Query(...),
     since: Optional[str] = Query(None),
     before: Optional[str] = Query(None),
-    db: AsyncSession = Depends(get_db)
-) -> DataRetrievalResponse:
-    logger.info(f"Retrieving data for datalogger: {datalogger}, since: {since}, before: {before}")
+    cursor: Optional[str] = Query(None),
+    limit: Optional[int] = Query(None, ge=1),
+    data_format: Optional[Literal["json", "ndjson", "csv", "arrow", "parquet"]] = Query(None, alias="format"),
+    accept: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None),
+    session_factory: Callable[[], AsyncSession] = Depends(get_session_factory)
+) -> Response:
+    logger.info(f"Retrieving data for datalogger: {datalogger}, since: {since}, before: {before}, cursor: {cursor}")
+    # Pages never exceed DATA_MAX_PAGE_SIZE records, whatever the limit asked for
+    limit = page_size(limit)
+    # format= takes precedence over the Accept header
+    media_type = negotiate(accept, data_format)
+    if media_type is None:
+        logger.error(f"Representation not available: format={data_format}, accept={accept}")
+        raise HTTPException(status_code=406, detail="The requested format requires pyarrow, which is not installed.")
     try:
-        data = await get_data(db, datalogger, since, before)
-        if not data:
-            logger.warning(f"No data found matching the criteria: datalogger={datalogger}, since={since}, before={before}")
-            raise HTTPException(status_code=404, detail="No data found matching the criteria.")
-        logger.info(f"Retrieved {len(data)} records for datalogger: {datalogger}")
-        for record in data:
-            record.measured_at = record.measured_at.isoformat()
-        return DataRetrievalResponse(data=data)
-    except HTTPException as e:
-        logger.error(f"HTTP error retrieving data: {e.detail}")
-        raise e
+        low, high = page_range(datalogger, since, before, cursor)
+    except ValueError as ve:
+        logger.error(f"Invalid query bound: {ve}")
+        raise HTTPException(status_code=400, detail=str(ve))
+    key = ("data", datalogger, low, high, limit, media_type)
+    # Pages are revalidated at each use: a write can extend any range
+    headers = {**_validators(key, datalogger, "no-cache"), "Vary": "Accept"}
+    if etag_matches(if_none_match, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    cached = result_cache.lookup(key) or await result_cache.wait(key)
+    if cached is not None:
+        if etag_matches(if_none_match, headers["ETag"], exists=True):
+            return Response(status_code=304, headers=headers)
+        return Response(cached.body, media_type=cached.media_type, headers={**headers, **cached.headers})
+    flight = result_cache.start(key)
+    try:
+        return await _stream_page(request, datalogger, since, before, cursor, limit, media_type, if_none_match,
+                                  session_factory, flight, CacheEntry(b"", media_type, datalogger, low, high), headers)
+    except BaseException:
+        result_cache.finish(flight, None)
+        raise
+
+# Function to stream a page that is not cached, a copy of its bytes being cached once sent
+async def _stream_page(request: Request, datalogger: str, since: Optional[str], before: Optional[str],
+                       cursor: Optional[str], limit: int, media_type: str, if_none_match: Optional[str],
+                       session_factory: Callable[[], AsyncSession], flight: Flight, entry: CacheEntry,
+                       headers: Dict[str, str]) -> Response:
+    # The rows are streamed after this function has returned, so the response has its own session
+    db = session_factory()
+    page = DataPage(stream_data(db, datalogger, since, before, cursor=cursor, limit=limit + 1), datalogger, limit)
+    batches = page.records()
+    # The first batch is read before answering: an empty range is still a 404 and a bad bound a 400
+    try:
+        first = await batches.__anext__()
+    except StopAsyncIteration:
+        first = None
+    except ValueError as ve:
+        await _close(batches, db)
+        logger.error(f"Invalid query bound: {ve}")
+        raise HTTPException(status_code=400, detail=str(ve))
     except Exception as e:
+        await _close(batches, db)
         logger.error(f"Error retrieving data: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
+    if first is None:
+        await _close(batches, db)
+        logger.warning(f"No data found matching the criteria: datalogger={datalogger}, since={since}, before={before}")
+        raise HTTPException(status_code=404, detail="No data found matching the criteria.")
+    if etag_matches(if_none_match, headers["ETag"], exists=True):
+        await _close(batches, db)
+        result_cache.finish(flight, None)
+        return Response(status_code=304, headers=headers)
+
+    async def rows():
+        yield first
+        async for batch in batches:
+            yield batch
+
+    if media_type in TABULAR_MEDIA_TYPES:
+        try:
+            return await _tabular_page(request, rows(), page, media_type, flight, entry, headers)
+        except Exception as e:
+            logger.error(f"Error encoding data: {e}")
+            raise HTTPException(status_code=500, detail="Internal server error")
+        finally:
+            await _close(batches, db)
+    if media_type == NDJSON_MEDIA_TYPE:
+        body = stream_ndjson(rows(), lambda: page.next_cursor)
+    else:
+        body = stream_json(rows(), lambda: page.next_cursor)
+    return _CachingStreamingResponse(_closing(_caching(body, flight, entry), batches, db), flight,
+                                     media_type=media_type, headers=headers)
+
+# Function to answer a page as CSV, Arrow or Parquet: these formats have no room for a trailing cursor, so the
+# page is gathered in columns straight from the cursor batches, then encoded with its next link in the headers
+async def _tabular_page(request: Request, batches: AsyncIterator[Sequence], page: DataPage, media_type: str,
+                        flight: Flight, entry: CacheEntry, headers: Dict[str, str]) -> Response:
+    labels: List[str] = []
+    measured_ats: List = []
+    values: List[float] = []
+    async for batch in batches:
+        for label, measured_at, value in batch:
+            labels.append(label)
+            measured_ats.append(measured_at)
+            values.append(value)
+    page_headers = {}
+    if page.next_cursor is not None:
+        # The headers are cached with the body and shared by every request of the same key, whatever its host or
+        # the spelling of its query: the link is relative and names its format rather than relying on Accept
+        data_format = next(name for name, candidate in DATA_FORMATS.items() if candidate == media_type)
+        next_url = request.url.include_query_params(cursor=page.next_cursor, format=data_format)
+        page_headers["Link"] = f'<{next_url.path}?{next_url.query}>; rel="next"'
+    entry = replace(entry, body=encode_columns(media_type, labels, measured_ats, values), headers=page_headers)
+    result_cache.finish(flight, entry)
+    return Response(entry.body, media_type=media_type, headers={**headers, **page_headers})
+
+# Function to build the validators of a response: its entity tag changes with the data version of its label, so
+# a client polling an unchanged label gets a 304 without any query or serialization
+def _validators(key: Hashable, datalogger: str, cache_control: str) -> Dict[str, str]:
+    return {
+        "ETag": entity_tag(data_versions.epoch, data_versions.version(datalogger), key),
+        "Last-Modified": http_date(data_versions.last_modified(datalogger)),
+        "Cache-Control": cache_control,
+    }
+
+# Function to release the cursor and the session of a streamed response
+async def _close(batches: AsyncGenerator, db: AsyncSession):
+    await batches.aclose()
+    await db.close()
+
+# Function to send a streamed body while keeping a copy for the result cache, up to its size limit
+async def _caching(body: AsyncIterator[bytes], flight: Flight, entry: CacheEntry) -> AsyncIterator[bytes]:
+    chunks: Optional[List[bytes]] = []
+    size = 0
+    async for chunk in body:
+        size += len(chunk)
+        if chunks is not None and size > settings.RESULT_CACHE_MAX_BYTES:
+            chunks = None
+        elif chunks is not None:
+            chunks.append(chunk)
+        yield chunk
+    result_cache.finish(flight, replace(entry, body=b"".join(chunks)) if chunks is not None else None)
+
+class _CachingStreamingResponse(StreamingResponse):
+    """Streaming response ending its cache flight however the response ends (the identical requests waiting for
+    it would hang otherwise): a response cancelled before its body was read is not cached."""
+
+    def __init__(self, content: AsyncIterator[bytes], flight: Flight, media_type: str, headers: Dict[str, str]):
+        super().__init__(content, media_type=media_type, headers=headers)
+        self.flight = flight
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            result_cache.finish(self.flight, None)
+
+# Function to send a streamed body, then release its cursor and session (also when the client goes away)
+async def _closing(body: AsyncIterator[bytes], batches: AsyncGenerator, db: AsyncSession) -> AsyncIterator[bytes]:
+    try:
+        async for chunk in body:
+            yield chunk
+    finally:
+        await _close(batches, db)
 
 @router.get("/summary", response_model=AggregatedDataRetrievalResponse)
 async def retrieve_aggregated_data(
@@ -39,16 +191,31 @@ async def retrieve_aggregated_data(
     span: Literal["hour", "day", "month"] = Query("day"),
     since: Optional[str] = Query(None),
     before: Optional[str] = Query(None),
+    if_none_match: Optional[str] = Header(None),
     db: AsyncSession = Depends(get_db)
-) -> AggregatedDataRetrievalResponse:
+) -> Response:
     logger.info(f"Retrieving aggregated data for datalogger: {datalogger}, span: {span}, since: {since}, before: {before}")
-    try:
+
+    async def load() -> CacheEntry:
         data = await get_aggregated_data(db, datalogger, span, since, before)
         if not data:
             logger.warning(f"No aggregated data found matching the criteria: datalogger={datalogger}, span={span}, since={since}, before={before}")
             raise HTTPException(status_code=404, detail="No data found matching the criteria.")
         logger.info(f"Retrieved {len(data)} aggregated records for datalogger: {datalogger} with span: {span}")
-        return AggregatedDataRetrievalResponse(data=data)
+        return CacheEntry(encode_aggregates(data), JSON_MEDIA_TYPE, datalogger, low, high)
+
+    try:
+        # Keyed on the parsed bounds, so equivalent spellings of a date share an entry
+        low, high = query_range(since, before)
+        key = ("summary", datalogger, span, low, high)
+        # Summaries may be reused by clients and reverse proxies for SUMMARY_MAX_AGE seconds
+        headers = _validators(key, datalogger, f"public, max-age={settings.SUMMARY_MAX_AGE}")
+        if etag_matches(if_none_match, headers["ETag"]):
+            return Response(status_code=304, headers=headers)
+        entry = await result_cache.get_or_load(key, load)
+        if etag_matches(if_none_match, headers["ETag"], exists=True):
+            return Response(status_code=304, headers=headers)
+        return Response(entry.body, media_type=entry.media_type, headers=headers)
     except ValueError as ve:
         logger.error(f"Invalid span value: {ve}")
         raise HTTPException(status_code=400, detail=str(ve))
@@ -58,3 +225,8 @@ async def retrieve_aggregated_data(
     except Exception as e:
         logger.error(f"Error retrieving aggregated data: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
+
+# Counters and size of the result cache
+@router.get("/cache")
+async def cache_stats() -> dict:
+    return result_cache.describe()
@@ -0,0 +1,33 @@
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+from sqlalchemy import text
+from app.bootstrap import bootstrap
+from app.db import AsyncSessionLocal
+from app.logger import get_logger
+
+router = APIRouter()
+logger = get_logger("health")
+
+# Function to describe the progress of the startup bootstrap
+def _bootstrap_status() -> dict:
+    return {
+        "stage": bootstrap.stage,
+        "attempts": bootstrap.attempts,
+        "error": bootstrap.error,
+        "ingestion_job_id": bootstrap.ingestion_job_id,
+    }
+
+@router.get("/live")
+async def liveness() -> dict:
+    return {"status": "alive"}
+
+# The API is ready as soon as the database answers: existing data is served while the bootstrap runs
+@router.get("/ready")
+async def readiness():
+    try:
+        async with AsyncSessionLocal() as db:
+            await db.execute(text("SELECT 1"))
+    except Exception as e:
+        logger.error(f"Readiness check failed: {e}")
+        return JSONResponse(status_code=503, content={"status": "unavailable", "bootstrap": _bootstrap_status()})
+    return {"status": "ready", "bootstrap": _bootstrap_status()}
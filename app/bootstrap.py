@@ -0,0 +1,139 @@
+import asyncio
+import functools
+import logging
+import subprocess
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, List, Optional, TypeVar
+from app.config import settings
+from app.data_validation import extract_files, validate_json_or_yaml, DATALOGGER_DB_MEMBER
+from app.fetch import feed_client
+from app.jobs import FAILED
+from app.sources import HTTP_SOURCE
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+DATA_TAR_GZ_PATH = 'data/202212-datalogger.tar.gz'
+EXTRACTED_DATA_PATH = 'data/extracted'
+JSON_SERVER_DB_PATH = 'data/extracted/datalogger/db.json'
+FILE_PATHS = [
+    JSON_SERVER_DB_PATH,
+    'data/202212_api_requirements.json',
+    'data/202212_openapi_spec_v1.json'
+]
+
+# Bootstrap stages, in order
+PENDING = "pending"
+EXTRACTING = "extracting"
+VALIDATING = "validating"
+STARTING_JSON_SERVER = "starting_json_server"
+INGESTING = "ingesting"
+DONE = "done"
+FAILED_STAGE = "failed"
+
+
+# Function to run a blocking call in the default thread pool (asyncio.to_thread only exists from Python 3.9)
+async def _in_thread(func: Callable[..., T], *args: Any) -> T:
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args))
+
+
+class Bootstrap:
+    """Supervised background bootstrap of the data: extraction, validation, json-server and first ingestion.
+
+    It runs after the API has started serving, so existing data stays available while it progresses.
+    Blocking steps run in a worker thread, json-server is polled until it answers instead of waiting a
+    fixed delay (it is not started at all when ingesting from the local file), and a failed attempt is
+    retried with backoff up to ``BOOTSTRAP_RETRIES`` times.
+    """
+
+    def __init__(self):
+        self.stage = PENDING
+        self.attempts = 0
+        self.error: Optional[str] = None
+        self.started_at: Optional[datetime] = None
+        self.finished_at: Optional[datetime] = None
+        self.ingestion_job_id: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+        self._json_server: Optional[subprocess.Popen] = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._supervise())
+
+    async def stop(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self._json_server is not None and self._json_server.poll() is None:
+            logger.info("Stopping JSON Server.")
+            self._json_server.terminate()
+            await _in_thread(self._json_server.wait)
+
+    async def _supervise(self):
+        self.started_at = datetime.now(timezone.utc)
+        while True:
+            self.attempts += 1
+            try:
+                await self._run()
+                self.stage = DONE
+                self.error = None
+                break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Bootstrap attempt {self.attempts} failed during '{self.stage}': {e}")
+                self.error = f"{self.stage}: {e}"
+                if self.attempts > settings.BOOTSTRAP_RETRIES:
+                    self.stage = FAILED_STAGE
+                    break
+                await asyncio.sleep(settings.FETCH_BACKOFF * 2 ** (self.attempts - 1))
+        self.finished_at = datetime.now(timezone.utc)
+        logger.info(f"Bootstrap finished with status '{self.stage}' after {self.attempts} attempt(s).")
+
+    async def _run(self):
+        self.stage = EXTRACTING
+        # json-server is installed globally, so the archived node_modules tree is left out
+        await _in_thread(extract_files, DATA_TAR_GZ_PATH, EXTRACTED_DATA_PATH, [DATALOGGER_DB_MEMBER])
+
+        self.stage = VALIDATING
+        await _in_thread(validate_json_or_yaml, FILE_PATHS)
+
+        if settings.INGEST_SOURCE == HTTP_SOURCE:
+            self.stage = STARTING_JSON_SERVER
+            self._start_json_server()
+            await wait_for_json_server()
+
+        self.stage = INGESTING
+        # Imported here: the ingestion endpoint module depends on the whole API stack
+        from app.api.endpoints.data_ingestion import start_ingestion_job
+        job = start_ingestion_job()
+        self.ingestion_job_id = job.id
+        await asyncio.shield(job.task)
+        if job.status == FAILED:
+            raise RuntimeError(f"Ingestion job {job.id} failed: {job.error}")
+
+    def _start_json_server(self):
+        if self._json_server is not None and self._json_server.poll() is None:
+            return
+        logger.info("Starting JSON Server.")
+        command: List[str] = [settings.JSON_SERVER_PATH, "--watch", JSON_SERVER_DB_PATH, "--port", "3000"]
+        self._json_server = subprocess.Popen(command)
+
+
+# Function to poll the JSON server until it answers, instead of sleeping a fixed delay
+async def wait_for_json_server(url: Optional[str] = None, timeout: Optional[float] = None,
+                               interval: Optional[float] = None):
+    url = url or settings.DATA_URL
+    timeout = timeout if timeout is not None else settings.JSON_SERVER_READY_TIMEOUT
+    interval = interval if interval is not None else settings.JSON_SERVER_POLL_INTERVAL
+    start_time = time.perf_counter()
+    while not await feed_client.is_ready(url):
+        if time.perf_counter() - start_time > timeout:
+            raise TimeoutError(f"JSON server at {url} not ready after {timeout:.0f}s.")
+        await asyncio.sleep(interval)
+    logger.info(f"JSON server ready after {time.perf_counter() - start_time:.2f}s.")
+
+
+bootstrap = Bootstrap()
@@ -0,0 +1,214 @@
+import asyncio
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, Hashable, Iterable, Optional, Tuple
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CacheEntry:
+    """Encoded body of a cached response, with the (label, [low, high)) range of measurements it was computed from.
+
+    A write of measurements of that label inside the range invalidates the entry; ``None`` bounds are open.
+    ``headers`` are the response headers that depend on the body, such as the link to the next page.
+    """
+
+    body: bytes
+    media_type: str
+    label: str
+    low: Optional[datetime]
+    high: Optional[datetime]
+    expires_at: float = 0.0
+    headers: Dict[str, str] = field(default_factory=dict)
+
+    def overlaps(self, label: str, first: datetime, last: datetime) -> bool:
+        return (label == self.label and (self.low is None or last >= self.low)
+                and (self.high is None or first < self.high))
+
+
+@dataclass
+class Flight:
+    """A cache miss being computed: identical misses arriving meanwhile wait for its result instead of querying."""
+
+    key: Hashable
+    writes: int
+    future: asyncio.Future = field(default_factory=lambda: asyncio.get_running_loop().create_future())
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    coalesced: int = 0
+    evictions: int = 0
+    expirations: int = 0
+    invalidations: int = 0
+
+
+class ResultCache:
+    """In-process LRU cache of encoded /api responses, bounded in entries, bytes and age.
+
+    The ingestion reports every committed chunk through ``invalidate``, which drops the entries whose range
+    overlaps the written measurements. A result computed while a write was committed is not stored, since it
+    may predate the write. The limits are read from the settings at each use, like the storage layout.
+    """
+
+    def __init__(self):
+        self._entries: "OrderedDict[Hashable, CacheEntry]" = OrderedDict()
+        self._flights: Dict[Hashable, Flight] = {}
+        self._bytes = 0
+        # Number of invalidations so far: a flight started before the last one may hold stale data
+        self._writes = 0
+        self.stats = CacheStats()
+
+    @property
+    def enabled(self) -> bool:
+        return settings.RESULT_CACHE_MAX_ENTRIES > 0 and settings.RESULT_CACHE_MAX_BYTES > 0
+
+    def lookup(self, key: Hashable) -> Optional[CacheEntry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.monotonic():
+            self._remove(key)
+            self.stats.expirations += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats.hits += 1
+        return entry
+
+    # Waits for the flight computing the same key, if any, up to timeout seconds (RESULT_CACHE_WAIT_TIMEOUT by
+    # default). None when there is none, its result wasn't cacheable or it took too long: the caller loads the data
+    async def wait(self, key: Hashable, timeout: Optional[float] = None) -> Optional[CacheEntry]:
+        flight = self._flights.get(key)
+        if flight is None:
+            return None
+        self.stats.coalesced += 1
+        timeout = settings.RESULT_CACHE_WAIT_TIMEOUT if timeout is None else timeout
+        try:
+            return await asyncio.wait_for(asyncio.shield(flight.future), timeout)
+        except asyncio.TimeoutError:
+            logger.info(f"Identical request still in progress after {timeout:.1f}s, running the query instead.")
+            return None
+
+    def start(self, key: Hashable) -> Flight:
+        self.stats.misses += 1
+        flight = Flight(key, self._writes)
+        self._flights[key] = flight
+        return flight
+
+    # Ends a flight with its entry (None when the result is not to be cached) and wakes up its waiters. A result
+    # that may predate a write is neither cached nor handed to the waiters, which load the data again
+    def finish(self, flight: Flight, entry: Optional[CacheEntry]):
+        if flight.future.done():
+            return
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+        if flight.writes != self._writes:
+            entry = None
+        if entry is not None and self.enabled:
+            self._store(flight.key, entry)
+        flight.future.set_result(entry)
+
+    # Function to serve a key from the cache, from an identical miss in progress, or from loader, once per key
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[CacheEntry]]) -> CacheEntry:
+        entry = self.lookup(key) or await self.wait(key)
+        if entry is not None:
+            return entry
+        flight = self.start(key)
+        try:
+            entry = await loader()
+        except BaseException:
+            self.finish(flight, None)
+            raise
+        self.finish(flight, entry)
+        return entry
+
+    def invalidate(self, rows: Iterable[Tuple[str, datetime, float]]):
+        ranges: Dict[str, Tuple[datetime, datetime]] = {}
+        for label, measured_at, _ in rows:
+            first, last = ranges.get(label, (measured_at, measured_at))
+            ranges[label] = (min(first, measured_at), max(last, measured_at))
+        if not ranges:
+            return
+        self._writes += 1
+        # Identical misses arriving from now on must not wait for a flight that may miss the write
+        self._flights.clear()
+        stale = [key for key, entry in self._entries.items()
+                 if any(entry.overlaps(label, first, last) for label, (first, last) in ranges.items())]
+        for key in stale:
+            self._remove(key)
+        self.stats.invalidations += len(stale)
+        if stale:
+            logger.info(f"Invalidated {len(stale)} cached results after a write to {sorted(ranges)}.")
+
+    def clear(self):
+        self._writes += 1
+        self._flights.clear()
+        self._entries.clear()
+        self._bytes = 0
+
+    def reset(self):
+        self.clear()
+        self.stats = CacheStats()
+
+    def describe(self) -> dict:
+        return {**vars(self.stats), "entries": len(self._entries), "bytes": self._bytes}
+
+    def _store(self, key: Hashable, entry: CacheEntry):
+        if len(entry.body) > settings.RESULT_CACHE_MAX_BYTES:
+            return
+        if key in self._entries:
+            self._remove(key)
+        entry.expires_at = time.monotonic() + settings.RESULT_CACHE_TTL
+        self._entries[key] = entry
+        self._bytes += len(entry.body)
+        # Least recently used entries go first
+        while len(self._entries) > settings.RESULT_CACHE_MAX_ENTRIES or self._bytes > settings.RESULT_CACHE_MAX_BYTES:
+            self._remove(next(iter(self._entries)))
+            self.stats.evictions += 1
+
+    def _remove(self, key: Hashable):
+        self._bytes -= len(self._entries.pop(key).body)
+
+
+class DataVersions:
+    """Per-label counters of the writes committed by this process, the validators of the HTTP responses.
+
+    Counters restart with the process, so validators also carry a random epoch drawn at start-up (and when
+    all the data is deleted): a version number can't match a validator issued by an earlier epoch. Writes of
+    other processes are not counted, so the app must be the single writer of the database (one worker).
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.epoch = uuid.uuid4().hex
+        self.started_at = datetime.now(timezone.utc)
+        self._versions: Dict[str, int] = {}
+        self._modified: Dict[str, datetime] = {}
+
+    def version(self, label: str) -> int:
+        return self._versions.get(label, 0)
+
+    # Time of the last write to a label, or of the start of the epoch when there was none
+    def last_modified(self, label: str) -> datetime:
+        return self._modified.get(label, self.started_at)
+
+    def bump(self, rows: Iterable[Tuple[str, datetime, float]]):
+        now = datetime.now(timezone.utc)
+        for label in {row[0] for row in rows}:
+            self._versions[label] = self.version(label) + 1
+            self._modified[label] = now
+
+
+result_cache = ResultCache()
+data_versions = DataVersions()
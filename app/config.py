@@ -1,3 +1,4 @@
+from typing import Optional
 from pydantic_settings import BaseSettings
 
 
@@ -5,10 +6,56 @@ class Settings(BaseSettings):
     DATABASE_URL: str
     DATA_URL: str
     JSON_SERVER_PATH: str
+    # Number of records written per bulk statement / transaction during ingestion
+    INGEST_CHUNK_SIZE: int = 5000
+    # Where ingestion reads the measurements from: "http" downloads DATA_URL (json-server), "file" reads the
+    # extracted db.json at INGEST_FILE_PATH directly, without starting json-server
+    INGEST_SOURCE: str = "http"
+    INGEST_FILE_PATH: str = "data/extracted/datalogger/db.json"
+    # Table layout of the measurements: "row" stores (label, measured_at, value) rows in the data table,
+    # "compact" stores (datalogger id, epoch-millisecond timestamp, value) rows in data_compact, "wide" stores
+    # one data_wide row per timestamp with a temp, hum and precip column
+    STORAGE_LAYOUT: str = "row"
+    # Number of rows fetched from the database cursor per batch when streaming /api/data responses
+    DATA_STREAM_BATCH_SIZE: int = 2000
+    # Maximum (and default) number of records of an /api/data page, further records being reached via next_cursor
+    DATA_MAX_PAGE_SIZE: int = 10000
+    # In-process cache of encoded /api/data and /api/summary responses: maximum number of entries, total size of
+    # the cached bodies and age in seconds. Writes invalidate the entries they overlap; 0 entries disables it
+    RESULT_CACHE_MAX_ENTRIES: int = 256
+    RESULT_CACHE_MAX_BYTES: int = 32 * 1024 * 1024
+    RESULT_CACHE_TTL: float = 300.0
+    # Seconds an identical request waits for the response being computed before running the query itself: a
+    # streamed /api/data response is only complete once its client has read it, however slowly
+    RESULT_CACHE_WAIT_TIMEOUT: float = 5.0
+    # Seconds during which clients and reverse proxies may reuse an /api/summary response without revalidating it
+    # (/api/data responses are always revalidated through their ETag)
+    SUMMARY_MAX_AGE: int = 60
+    # Opt-in fast path of the /api responses: rows are encoded straight to bytes with orjson (plain json when it
+    # is not installed), summaries without a pydantic model per row. The bodies are the same bytes either way
+    FAST_JSON_RESPONSES: bool = False
+    # HTTP client settings used to fetch the datalogger feed
+    FETCH_TIMEOUT: float = 30.0
+    FETCH_RETRIES: int = 3
+    FETCH_BACKOFF: float = 0.5
+    # Number of collection items per json-server slice (_start/_end), 0 fetches the collection in one request (as
+    # do collections of a single slice or of fewer items than FETCH_CONCURRENCY)
+    FETCH_PAGE_SIZE: int = 0
+    # Maximum number of slices downloaded at the same time
+    FETCH_CONCURRENCY: int = 4
+    # Query parameter through which the feed can filter measurements newer than an epoch-millisecond
+    # timestamp (e.g. "measured_at_gt"), unset when the source cannot filter server-side
+    FETCH_SINCE_PARAM: Optional[str] = None
+    # Startup bootstrap: how long to wait for json-server to answer, how often to poll it, and how many
+    # times a failed bootstrap is retried before giving up
+    JSON_SERVER_READY_TIMEOUT: float = 60.0
+    JSON_SERVER_POLL_INTERVAL: float = 0.2
+    BOOTSTRAP_RETRIES: int = 3
 
     class Config:
         env_file = ".env"
         env_file_encoding = 'utf-8'
 
 
-settings = Settings()
+# The required settings come from the environment or the .env file
+settings = Settings()  # type: ignore[call-arg]
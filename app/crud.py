@@ -1,59 +1,291 @@
+import base64
+import json
 import logging
+import time
+from collections import namedtuple
+from itertools import islice
+import pandas as pd
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from sqlalchemy import func, delete
-from app.models import Data
+from sqlalchemy import delete
+from app.cache import data_versions, result_cache
+from app.config import settings
+from app.fetch import feed_client
+from app.models import Data, DataRollup, IngestionWatermark
+from app.rollups import add_to_rollups, refresh_rollups, has_rollups, get_rolled_up_aggregates
 from app.schemas import DataCreate
-from typing import List, Optional
+from app.sources import file_source
+from app.storage import LAYOUTS, ROW_LAYOUT, Record, Row, dialect_insert, get_layout
+from datetime import datetime, timedelta, timezone
+from typing import Any, AsyncGenerator, Awaitable, Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple
 
 logger = logging.getLogger(__name__)
 
+# Number of incoming records looked up per deduplication query (keeps bound parameters under SQLite's limit)
+DEDUP_CHUNK_SIZE = 500
+# Supported behaviours when a record hits the (label, measured_at) unique key
+ON_CONFLICT_MODES = ("ignore", "update")
+# Rows of the per-day / per-hour average helpers
+LabelDayAverage = namedtuple("LabelDayAverage", "label day average_value")
+LabelHourAverage = namedtuple("LabelHourAverage", "label hour average_value")
+DayAverage = namedtuple("DayAverage", "day average_value")
+HourAverage = namedtuple("HourAverage", "hour average_value")
+
 # Function to store data in the database
-async def store_data_in_db(data: List[DataCreate], db: AsyncSession):
+async def store_data_in_db(data: Iterable[DataCreate], db: AsyncSession, on_conflict: Optional[str] = None,
+                           chunk_size: Optional[int] = None, use_orm: bool = False) -> int:
+    if use_orm and on_conflict is not None:
+        raise ValueError("The ORM write path does not support on_conflict.")
+    if use_orm and settings.STORAGE_LAYOUT != ROW_LAYOUT:
+        raise ValueError(f"The ORM write path only supports the '{ROW_LAYOUT}' storage layout.")
+    if not use_orm:
+        rows = ((record.label, _to_naive_utc(record.measured_at), record.value) for record in data)
+        return await store_rows(rows, db, on_conflict=on_conflict, chunk_size=chunk_size)
+
+    async def write(chunk: List[DataCreate]) -> Sequence[Row]:
+        db.add_all([Data(**record.dict()) for record in chunk])
+        await db.flush()
+        rows = [(record.label, _to_naive_utc(record.measured_at), record.value) for record in chunk]
+        await add_to_rollups(db, rows)
+        return rows
+    return await _store_in_chunks(data, db, chunk_size, write)
+
+# Function to store trusted (label, measured_at, value) rows with the bulk writer, without building a model per row.
+# measured_at must already be a naive UTC datetime.
+async def store_rows(rows: Iterable[Row], db: AsyncSession, on_conflict: Optional[str] = None,
+                     chunk_size: Optional[int] = None) -> int:
+    if on_conflict is not None and on_conflict not in ON_CONFLICT_MODES:
+        raise ValueError(f"Invalid on_conflict value. Must be one of {ON_CONFLICT_MODES}. Received '{on_conflict}'.")
+    layout = get_layout()
+
+    async def write(chunk: List[Row]) -> Sequence[Row]:
+        if on_conflict is not None:
+            # Keep one row per natural key (last one wins): PostgreSQL refuses to update a row twice in one statement
+            chunk = list({(label, measured_at): (label, measured_at, value)
+                          for label, measured_at, value in chunk}.values())
+        inserted = await layout.write(db, chunk, on_conflict)
+        # Rollups are kept in step within the chunk's transaction: inserted rows are added to their buckets, while
+        # replaced values can't be subtracted (min / max) so the touched buckets are recomputed
+        if on_conflict == "update":
+            await refresh_rollups(db, chunk)
+            return chunk
+        await add_to_rollups(db, inserted)
+        return inserted
+    return await _store_in_chunks(rows, db, chunk_size, write)
+
+# Function to write items chunk by chunk, each chunk being committed on its own. write returns the rows it changed,
+# whose cached results are invalidated once committed
+async def _store_in_chunks(items: Iterable[Any], db: AsyncSession, chunk_size: Optional[int],
+                           write: Callable[[List[Any]], Awaitable[Sequence[Row]]]) -> int:
+    chunk_size = chunk_size or settings.INGEST_CHUNK_SIZE
     try:
-        db_data = [Data(**record.dict()) for record in data]
-        db.add_all(db_data)
-        await db.commit()
-        logger.info("Data stored in the database successfully.")
+        stored = 0
+        items = iter(items)
+        # Memory and transaction size stay bounded by chunk_size whatever the size of the input
+        while True:
+            chunk = list(islice(items, chunk_size))
+            if not chunk:
+                break
+            start_time = time.perf_counter()
+            written = await write(chunk)
+            await db.commit()
+            result_cache.invalidate(written)
+            data_versions.bump(written)
+            elapsed = time.perf_counter() - start_time
+            # Only the rows written count: those skipped by ON CONFLICT DO NOTHING are not returned
+            stored += len(written)
+            logger.info(f"Stored chunk of {len(chunk)} records ({len(written)} written) in {elapsed:.3f}s "
+                        f"({len(chunk) / max(elapsed, 1e-9):.0f} rows/s).")
+        logger.info(f"Data stored in the database successfully ({stored} records).")
+        return stored
     except Exception as e:
         logger.error(f"Error storing data in database: {e}")
         raise
 
+# Function to normalize a timestamp to the naive UTC form stored in the database
+def _to_naive_utc(value: datetime) -> datetime:
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+# Function to find the (label, measured_at, value) keys of a batch that already exist in the database
+async def _find_existing_keys(data: List[DataCreate], db: AsyncSession) -> Set[Tuple[str, datetime, float]]:
+    layout = get_layout()
+    existing = set()
+    for start in range(0, len(data), DEDUP_CHUNK_SIZE):
+        chunk = data[start:start + DEDUP_CHUNK_SIZE]
+        # One round-trip per chunk
+        existing.update(await layout.fetch_existing(db, list({
+            (record.label, _to_naive_utc(record.measured_at)) for record in chunk
+        })))
+    return existing
+
 # Function to check for duplicate data in the database
 async def check_duplicate_data(data: List[DataCreate], db: AsyncSession):
     try:
-        duplicates = []
-        for record in data:
-            query = select(Data).where(
-                Data.label == record.label,
-                Data.measured_at == record.measured_at,
-                Data.value == record.value
-            )
-            result = await db.execute(query)
-            if result.scalars().first():
-                duplicates.append(record)
+        existing = await _find_existing_keys(data, db)
+        duplicates = [
+            record for record in data
+            if (record.label, _to_naive_utc(record.measured_at), record.value) in existing
+        ]
         logger.info(f"Checked for duplicates, found {len(duplicates)} duplicate records.")
         return duplicates
     except Exception as e:
         logger.error(f"Error checking for duplicate data: {e}")
         raise
 
-# Function to get data with filters
-async def get_data(db: AsyncSession, datalogger: str, since: Optional[str] = None, before: Optional[str] = None):
+# Function to get the ingestion high-water mark of every label
+async def get_watermarks(db: AsyncSession) -> Dict[str, datetime]:
     try:
-        query = select(Data).where(Data.label == datalogger)
-        if since:
-            query = query.where(Data.measured_at >= since)
-        if before:
-            query = query.where(Data.measured_at <= before)
-        result = await db.execute(query)
-        data = result.scalars().all()
+        result = await db.execute(select(IngestionWatermark.label, IngestionWatermark.measured_at))
+        watermarks = {row.label: row.measured_at for row in result}
+        if not watermarks:
+            # Databases filled before watermarks existed: start from what is already stored
+            watermarks = await get_layout().latest(db)
+        logger.info(f"Retrieved ingestion watermarks for {len(watermarks)} labels.")
+        return watermarks
+    except Exception as e:
+        logger.error(f"Error retrieving ingestion watermarks: {e}")
+        raise
+
+# Function to move the ingestion high-water marks forward (a watermark never goes back)
+async def update_watermarks(db: AsyncSession, watermarks: Dict[str, datetime]):
+    if not watermarks:
+        return
+    try:
+        statement = dialect_insert(db)(IngestionWatermark)
+        statement = statement.on_conflict_do_update(
+            index_elements=["label"],
+            set_={"measured_at": statement.excluded.measured_at},
+            where=IngestionWatermark.measured_at < statement.excluded.measured_at
+        )
+        await db.execute(statement, [
+            {"label": label, "measured_at": _to_naive_utc(measured_at)} for label, measured_at in watermarks.items()
+        ])
+        await db.commit()
+        logger.info(f"Updated ingestion watermarks for {len(watermarks)} labels.")
+    except Exception as e:
+        logger.error(f"Error updating ingestion watermarks: {e}")
+        raise
+
+# Function to get data with filters, as (label, measured_at, value) rows ordered by measured_at
+async def get_data(db: AsyncSession, datalogger: str, since: Optional[str] = None, before: Optional[str] = None,
+                   cursor: Optional[str] = None, limit: Optional[int] = None):
+    low, high = page_range(datalogger, since, before, cursor)
+    try:
+        data = await get_layout().fetch_rows(db, datalogger, low, high, page_size(limit))
         logger.info(f"Retrieved {len(data)} records from the database.")
         return data
     except Exception as e:
         logger.error(f"Error retrieving data: {e}")
         raise
 
+# Function to stream the rows of get_data batch by batch from a server-side cursor, memory staying bounded by
+# the batch size whatever the range
+async def stream_data(db: AsyncSession, datalogger: str, since: Optional[str] = None, before: Optional[str] = None,
+                      batch_size: Optional[int] = None, cursor: Optional[str] = None,
+                      limit: Optional[int] = None) -> AsyncGenerator[Sequence[Record], None]:
+    low, high = page_range(datalogger, since, before, cursor)
+    try:
+        streamed = 0
+        async for batch in get_layout().stream_rows(db, datalogger, low, high,
+                                                     batch_size or settings.DATA_STREAM_BATCH_SIZE, limit):
+            streamed += len(batch)
+            yield batch
+        logger.info(f"Streamed {streamed} records from the database.")
+    except Exception as e:
+        logger.error(f"Error streaming data: {e}")
+        raise
+
+class DataPage:
+    """A keyset page of /api/data, streamed batch by batch.
+
+    The batches are read with a limit of one record past the page: that record is not sent, it only tells that
+    another page follows. next_cursor is set once the records have been consumed (None on the last page).
+    """
+    def __init__(self, batches: AsyncGenerator[Sequence[Record], None], datalogger: str, limit: int):
+        self._batches = batches
+        self._datalogger = datalogger
+        self._limit = limit
+        self.next_cursor: Optional[str] = None
+
+    async def records(self) -> AsyncGenerator[Sequence[Record], None]:
+        remaining = self._limit
+        last: Optional[Record] = None
+        try:
+            async for batch in self._batches:
+                if len(batch) > remaining:
+                    batch = batch[:remaining]
+                    if batch:
+                        last = batch[-1]
+                        yield batch
+                    # The limit is positive, so the page has a last record
+                    if last is not None:
+                        self.next_cursor = encode_cursor(self._datalogger, last.measured_at)
+                    return
+                remaining -= len(batch)
+                if batch:
+                    last = batch[-1]
+                yield batch
+        finally:
+            await self._batches.aclose()
+
+# Function to clamp a requested page size to the server maximum (which is also the default)
+def page_size(limit: Optional[int] = None) -> int:
+    if limit is not None and limit < 1:
+        raise ValueError(f"Invalid limit value. Must be a positive integer. Received '{limit}'.")
+    return min(limit or settings.DATA_MAX_PAGE_SIZE, settings.DATA_MAX_PAGE_SIZE)
+
+# Function to encode the position after the last record of a page as an opaque cursor token
+def encode_cursor(datalogger: str, measured_at: datetime) -> str:
+    position = json.dumps({"label": datalogger, "after": measured_at.isoformat()}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(position.encode("utf-8")).decode("ascii").rstrip("=")
+
+# Function to decode a cursor token back to the measured_at the next page starts after
+def decode_cursor(cursor: str, datalogger: str) -> datetime:
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        after = datetime.fromisoformat(position["after"])
+        label = position["label"]
+    except (ValueError, TypeError, KeyError):
+        raise ValueError(f"Invalid cursor value. Received '{cursor}'.")
+    if label != datalogger:
+        raise ValueError(f"Invalid cursor value. The cursor belongs to datalogger '{label}'.")
+    return after
+
+# Function to turn the since / before query bounds into the half-open [low, high) range of the layouts
+def query_range(since: Optional[str], before: Optional[str]) -> Tuple[Optional[datetime], Optional[datetime]]:
+    start_at = _parse_bound(since, "since")
+    end_at = _parse_bound(before, "before")
+    # before is inclusive, the layout ranges are half-open
+    high = end_at + timedelta(microseconds=1) if end_at is not None else None
+    return start_at, high
+
+# Function to turn the query bounds and cursor of a page into the range of the layouts. measured_at is unique per
+# label in every layout, so it alone orders the records and keys the pages: the next page is the range seek
+# measured_at > after
+def page_range(datalogger: str, since: Optional[str], before: Optional[str],
+               cursor: Optional[str]) -> Tuple[Optional[datetime], Optional[datetime]]:
+    low, high = query_range(since, before)
+    if cursor:
+        # Timestamps have a microsecond resolution, so >= after + 1µs is > after
+        after = decode_cursor(cursor, datalogger) + timedelta(microseconds=1)
+        low = after if low is None else max(low, after)
+    return low, high
+
+# Function to parse a since / before query bound to a naive UTC datetime. The ISO 8601 parser of pandas, as for the
+# feed timestamps: before Python 3.11, datetime.fromisoformat rejects "Z" and most ISO 8601 forms
+def _parse_bound(value: Optional[str], name: str) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        parsed = pd.to_datetime(value, format="ISO8601")
+        if pd.isna(parsed):
+            raise ValueError(value)
+        return _to_naive_utc(parsed.to_pydatetime(warn=False))
+    except ValueError:
+        raise ValueError(f"Invalid {name} value. Must be an ISO 8601 date or datetime. Received '{value}'.")
+
 # Function to get aggregated data
 async def get_aggregated_data(db: AsyncSession, datalogger: str, span: str, since: Optional[str] = None,
                               before: Optional[str] = None):
@@ -61,40 +293,24 @@ async def get_aggregated_data(db: AsyncSession, datalogger: str, span: str, sinc
     if span not in valid_spans:
         raise ValueError(f"Invalid span value. Must be one of {valid_spans}. Received '{span}'.")
 
+    low, high = query_range(since, before)
+
     try:
-        if span == "hour":
-            timespan_format = "%Y-%m-%d %H:00:00"
-        elif span == "day":
-            timespan_format = "%Y-%m-%d"
-        elif span == "month":
-            timespan_format = "%Y-%m"
-
-        query = select(
-            Data.label,
-            func.strftime(timespan_format, Data.measured_at).label('measured_at'),
-            func.avg(Data.value).label('value'),
-            func.min(Data.value).label('min_value'),
-            func.max(Data.value).label('max_value')
-        ).where(Data.label == datalogger)
-
-        if since:
-            query = query.where(Data.measured_at >= since)
-        if before:
-            query = query.where(Data.measured_at <= before)
-
-        query = query.group_by(Data.label, 'measured_at')
-        result = await db.execute(query)
-        aggregated_data = result.fetchall()
+        if await has_rollups(db, datalogger, span):
+            response = await get_rolled_up_aggregates(db, datalogger, span, low, high)
+            logger.info(f"Retrieved {len(response)} aggregated records from the rollups.")
+            return response
 
+        aggregated_data = await get_layout().aggregate(db, datalogger, span, low, high)
         response = [
             {
-                "label": record.label,
-                "measured_at": record.measured_at,
-                "value": record.value,
-                "min_value": record.min_value,
-                "max_value": record.max_value
+                "label": label,
+                "measured_at": bucket,
+                "value": total / count,
+                "min_value": minimum,
+                "max_value": maximum
             }
-            for record in aggregated_data
+            for label, bucket, count, total, minimum, maximum in aggregated_data
         ]
 
         logger.info(f"Retrieved {len(response)} aggregated records from the database.")
@@ -106,13 +322,10 @@ async def get_aggregated_data(db: AsyncSession, datalogger: str, span: str, sinc
 # Function to get aggregated data by day
 async def get_daily_aggregates(db: AsyncSession):
     try:
-        query = select(
-            Data.label,
-            func.strftime("%Y-%m-%d", Data.measured_at).label('day'),
-            func.avg(Data.value).label('average_value')
-        ).group_by(Data.label, 'day')
-        result = await db.execute(query)
-        daily_aggregates = result.fetchall()
+        daily_aggregates = [
+            LabelDayAverage(label, bucket, total / count)
+            for label, bucket, count, total, _, _ in await get_layout().aggregate(db, None, "day", None, None)
+        ]
         logger.info(f"Retrieved {len(daily_aggregates)} daily aggregated records from the database.")
         return daily_aggregates
     except Exception as e:
@@ -122,13 +335,10 @@ async def get_daily_aggregates(db: AsyncSession):
 # Function to get aggregated data by hour
 async def get_hourly_aggregates(db: AsyncSession):
     try:
-        query = select(
-            Data.label,
-            func.strftime("%Y-%m-%d %H:00:00", Data.measured_at).label('hour'),
-            func.avg(Data.value).label('average_value')
-        ).group_by(Data.label, 'hour')
-        result = await db.execute(query)
-        hourly_aggregates = result.fetchall()
+        hourly_aggregates = [
+            LabelHourAverage(label, bucket, total / count)
+            for label, bucket, count, total, _, _ in await get_layout().aggregate(db, None, "hour", None, None)
+        ]
         logger.info(f"Retrieved {len(hourly_aggregates)} hourly aggregated records from the database.")
         return hourly_aggregates
     except Exception as e:
@@ -138,12 +348,10 @@ async def get_hourly_aggregates(db: AsyncSession):
 # Function to get aggregated data by label and day
 async def get_aggregated_data_by_label_and_day(db: AsyncSession, label: str):
     try:
-        query = select(
-            func.strftime("%Y-%m-%d", Data.measured_at).label('day'),
-            func.avg(Data.value).label('average_value')
-        ).where(Data.label == label).group_by('day')
-        result = await db.execute(query)
-        aggregated_data_by_day = result.fetchall()
+        aggregated_data_by_day = [
+            DayAverage(bucket, total / count)
+            for _, bucket, count, total, _, _ in await get_layout().aggregate(db, label, "day", None, None)
+        ]
         logger.info(f"Retrieved {len(aggregated_data_by_day)} aggregated records by day for label '{label}' from the database.")
         return aggregated_data_by_day
     except Exception as e:
@@ -153,12 +361,10 @@ async def get_aggregated_data_by_label_and_day(db: AsyncSession, label: str):
 # Function to get aggregated data by label and hour
 async def get_aggregated_data_by_label_and_hour(db: AsyncSession, label: str):
     try:
-        query = select(
-            func.strftime("%Y-%m-%d %H:00:00", Data.measured_at).label('hour'),
-            func.avg(Data.value).label('average_value')
-        ).where(Data.label == label).group_by('hour')
-        result = await db.execute(query)
-        aggregated_data_by_hour = result.fetchall()
+        aggregated_data_by_hour = [
+            HourAverage(bucket, total / count)
+            for _, bucket, count, total, _, _ in await get_layout().aggregate(db, label, "hour", None, None)
+        ]
         logger.info(f"Retrieved {len(aggregated_data_by_hour)} aggregated records by hour for label '{label}' from the database.")
         return aggregated_data_by_hour
     except Exception as e:
@@ -168,8 +374,16 @@ async def get_aggregated_data_by_label_and_hour(db: AsyncSession, label: str):
 # Function to delete all data
 async def delete_all_data(db: AsyncSession):
     try:
-        await db.execute(delete(Data))
+        for layout in LAYOUTS.values():
+            await layout.delete_all(db)
+        await db.execute(delete(IngestionWatermark))
+        await db.execute(delete(DataRollup))
         await db.commit()
+        result_cache.clear()
+        data_versions.reset()
+        # The feed has to be read again: an unchanged feed or file must not be skipped as already ingested
+        feed_client.forget()
+        file_source.forget()
         logger.info("All data deleted from the database successfully.")
     except Exception as e:
         logger.error(f"Error deleting all data: {e}")
@@ -1,10 +1,13 @@
 import os
 import json
+import hashlib
+import multiprocessing
 import tarfile
 import time
 import yaml
-from tqdm import tqdm
 import logging
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
 
 logging.basicConfig(level=logging.ERROR)
 logger = logging.getLogger(__name__)
@@ -17,69 +20,189 @@ FILE_PATHS = [
     'data/202212_api_requirements.json',
     'data/202212_openapi_spec_v1.json'
 ]
+# Archive member served by json-server, the only one the application needs
+DATALOGGER_DB_MEMBER = 'datalogger/db.json'
 
-# Function to extract files
-def extract_files(tar_gz_path: str, extract_path: str):
-    if not os.path.exists(extract_path):
-        os.makedirs(extract_path)
-    with tarfile.open(tar_gz_path, 'r:gz') as tar:
-        tar.extractall(path=extract_path)
+# Extraction manifest written next to the extracted files, and read size used to hash the archive
+MANIFEST_NAME = '.extraction_manifest.json'
+HASH_CHUNK_SIZE = 1024 * 1024
+# Files from this size on are worth a worker process of their own during validation
+PARALLEL_MIN_BYTES = 16 * 1024 * 1024
+# Bytes read to sniff the format of a file without a conclusive extension
+SNIFF_BYTES = 64
+# libyaml's parser when PyYAML was built with it
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Function to extract files, skipped when the extraction recorded in the manifest is still current.
+# With members, only those archive members are extracted (e.g. ['datalogger/db.json']). Returns True if files were extracted.
+def extract_files(tar_gz_path: str, extract_path: str, members: Optional[List[str]] = None) -> bool:
+    os.makedirs(extract_path, exist_ok=True)
+    manifest_path = os.path.join(extract_path, MANIFEST_NAME)
+    manifest = _load_manifest(manifest_path)
+    archive = _archive_fingerprint(tar_gz_path, manifest.get("archive"))
+    same_archive = manifest.get("archive", {}).get("sha256") == archive["sha256"]
+
+    if same_archive and _extraction_current(extract_path, manifest, members):
+        if manifest["archive"] != archive:
+            # Archive touched but unchanged: only refresh its recorded size / mtime
+            manifest["archive"] = archive
+            _save_manifest(manifest_path, manifest)
+        logger.info(f"Files in {extract_path} are up to date, extraction skipped")
+        return False
+
+    extracted = _extract_members(tar_gz_path, extract_path, members)
+    recorded = manifest.get("members", {}) if same_archive else {}
+    recorded.update(extracted)
+    _save_manifest(manifest_path, {
+        "archive": archive,
+        "complete": members is None or (same_archive and manifest.get("complete", False)),
+        "members": recorded,
+    })
     logger.info(f"Files extracted to {extract_path}")
+    return True
 
-# Function to load and validate JSON or YAML data with progress bar and elapsed time
-def validate_json_or_yaml(file_paths: list):
-    chunk_size = 8192  # Read the file in chunks of 8 KB
-    for file_path in file_paths:
-        start_time = time.time()
+# Function to read the extraction manifest, empty if missing or unreadable
+def _load_manifest(manifest_path: str) -> Dict[str, Any]:
+    try:
+        with open(manifest_path, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+def _save_manifest(manifest_path: str, manifest: Dict[str, Any]):
+    with open(manifest_path, 'w') as file:
+        json.dump(manifest, file)
+
+# Function to fingerprint the archive; the hash is only recomputed when its size or mtime changed
+def _archive_fingerprint(tar_gz_path: str, previous: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    stat = os.stat(tar_gz_path)
+    if previous and previous.get("size") == stat.st_size and previous.get("mtime_ns") == stat.st_mtime_ns:
+        return previous
+    sha256 = hashlib.sha256()
+    with open(tar_gz_path, 'rb') as file:
+        for block in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            sha256.update(block)
+    return {"sha256": sha256.hexdigest(), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+# Function to check that the wanted members (all of them if None) are on disk as they were extracted
+def _extraction_current(extract_path: str, manifest: Dict[str, Any], members: Optional[List[str]]) -> bool:
+    recorded = manifest.get("members", {})
+    if members is None:
+        if not manifest.get("complete"):
+            return False
+        members = list(recorded)
+    for name in members:
+        if name not in recorded:
+            return False
         try:
-            file_size = os.path.getsize(file_path)
+            stat = os.stat(os.path.join(extract_path, name))
+        except OSError:
+            return False
+        if stat.st_size != recorded[name]["size"] or int(stat.st_mtime) != recorded[name]["mtime"]:
+            return False
+    return True
+
+# Function to extract the wanted members (all of them if None), returns the size / mtime of the extracted files
+def _extract_members(tar_gz_path: str, extract_path: str, members: Optional[List[str]]) -> Dict[str, Dict[str, int]]:
+    extract_options: Dict[str, Any] = {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+    extracted = {}
+    with tarfile.open(tar_gz_path, 'r:gz') as tar:
+        if members is None:
+            tar.extractall(path=extract_path, **extract_options)
+            return {member.name: {"size": member.size, "mtime": int(member.mtime)}
+                    for member in tar.getmembers() if member.isfile()}
+        remaining = set(members)
+        # The gzip stream is read sequentially and left as soon as every wanted member is out
+        for member in tar:
+            if member.name in remaining:
+                tar.extract(member, path=extract_path, **extract_options)
+                extracted[member.name] = {"size": member.size, "mtime": int(member.mtime)}
+                remaining.discard(member.name)
+                if not remaining:
+                    break
+    if remaining:
+        raise KeyError(f"Members not found in {tar_gz_path}: {sorted(remaining)}")
+    return extracted
+
+# Function to validate JSON or YAML files and log their parsing throughput. Large files are validated in parallel
+# across a process pool, small ones inline. Returns whether each file is valid.
+def validate_json_or_yaml(file_paths: list, workers: Optional[int] = None) -> Dict[str, bool]:
+    sizes = {file_path: _file_size(file_path) for file_path in file_paths}
+    large = [file_path for file_path in file_paths if sizes[file_path] >= PARALLEL_MIN_BYTES]
+    workers = workers or min(len(large), os.cpu_count() or 1)
+    results = {}
+    if len(large) > 1 and workers > 1:
+        # Spawned workers: the validation may run from a thread of the server's event loop, where forking is unsafe
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            for result in executor.map(_validate_file, large):
+                results[result[0]] = result
+    for file_path in file_paths:
+        if file_path not in results:
+            results[file_path] = _validate_file(file_path)
+
+    valid = {}
+    for file_path in file_paths:
+        _, file_format, size, elapsed_time, error, context = results[file_path]
+        name = os.path.basename(file_path)
+        if error is None:
+            logger.info(f"{name} : Data OK ({file_format}, {size / 1e6:.2f} MB in {elapsed_time:.2f} s, "
+                        f"{size / 1e6 / max(elapsed_time, 1e-9):.1f} MB/s)")
+        else:
+            logger.error(f"{name} : Data Error => {error}")
+            if context is not None:
+                logger.error(f"Context around the error: '{context}'")
+        valid[file_path] = error is None
+    return valid
+
+def _file_size(file_path: str) -> int:
+    try:
+        return os.path.getsize(file_path)
+    except OSError:
+        return 0
+
+# Function to pick the parser from the first significant byte (extensions are not reliable: the OpenAPI spec is
+# YAML in a .json file), so each file is parsed once instead of falling back from JSON to YAML
+def _sniff_format(file_path: str) -> str:
+    with open(file_path, 'rb') as file:
+        head = file.read(SNIFF_BYTES).lstrip(b' \t\r\n\xef\xbb\xbf')
+    return 'json' if head[:1] in (b'{', b'[') else 'yaml'
+
+# Function to parse one file in a single pass (runs in pool workers, so it returns its results instead of logging them):
+# (path, format, size, elapsed time, error, error context)
+def _validate_file(file_path: str) -> Tuple[str, Optional[str], int, float, Optional[str], Optional[str]]:
+    start_time = time.perf_counter()
+    file_format = None
+    size = 0
+    try:
+        size = os.path.getsize(file_path)
+        file_format = _sniff_format(file_path)
+        if file_format == 'json':
+            with open(file_path, 'rb') as file:
+                # One read of the whole file and a single parse, instead of growing a string chunk by chunk
+                json.loads(file.read())
+        else:
             with open(file_path, 'r') as file:
-                progress_bar = tqdm(total=file_size, unit='iB', unit_scale=True, desc=os.path.basename(file_path))
-                data = ''
-                while True:
-                    chunk = file.read(chunk_size)
-                    if not chunk:
-                        break
-                    data += chunk
-                    progress_bar.update(len(chunk))
-                    elapsed_time = time.time() - start_time
-                    progress_bar.set_postfix({'Elapsed Time (s)': f'{elapsed_time:.2f}'})
-                progress_bar.close()
-                # Try loading as JSON
-                try:
-                    json_data = json.loads(data)
-                    elapsed_time = time.time() - start_time
-                    logger.info(f"{os.path.basename(file_path)} : Data OK")
-                    logger.info(f"Elapsed Time : {elapsed_time:.2f} seconds")
-                    continue  # Move to the next file
-                except json.JSONDecodeError:
-                    # If JSON loading fails, try loading as YAML
-                    try:
-                        yaml_data = yaml.safe_load(data)
-                        elapsed_time = time.time() - start_time
-                        logger.info(f"{os.path.basename(file_path)} : Data OK")
-                        logger.info(f"Elapsed Time : {elapsed_time:.2f} seconds")
-                    except yaml.YAMLError as e:
-                        elapsed_time = time.time() - start_time
-                        logger.error(f"{os.path.basename(file_path)} : Data Error => {e}")
-                        logger.info(f"Elapsed Time : {elapsed_time:.2f} seconds")
-                        display_error_context(data, e)
-        except FileNotFoundError as e:
-            elapsed_time = time.time() - start_time
-            logger.error(f"{os.path.basename(file_path)} : Data Error => {e}")
-            logger.info(f"Elapsed Time : {elapsed_time:.2f} seconds")
+                # The YAML reader pulls the document from the handle incrementally
+                yaml.load(file, Loader=YAML_LOADER)
+    except json.JSONDecodeError as e:
+        return file_path, file_format, size, time.perf_counter() - start_time, str(e), _error_context(e.doc, e.pos)
+    except (OSError, yaml.YAMLError, UnicodeDecodeError) as e:
+        return file_path, file_format, size, time.perf_counter() - start_time, str(e), None
+    return file_path, file_format, size, time.perf_counter() - start_time, None, None
 
 # Function to display the context around the error
 def display_error_context(data: str, error: Exception):
     error_pos = error.pos if hasattr(error, 'pos') else None
     if error_pos is not None:
-        start = max(0, error_pos - 20)
-        end = min(len(data), error_pos + 20)
-        context = data[start:end]
-        logger.error(f"Context around the error: '{context}'")
+        logger.error(f"Context around the error: '{_error_context(data, error_pos)}'")
     else:
         logger.error("Could not determine the exact position of the error.")
 
+def _error_context(data: str, error_pos: int) -> str:
+    start = max(0, error_pos - 20)
+    end = min(len(data), error_pos + 20)
+    return data[start:end]
+
 # Main function for standalone execution
 def main():
     # Extract files
@@ -1,6 +1,7 @@
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from app.config import settings
+from app.migrations import run_migrations
 from app.models import Base
 
 engine = create_async_engine(settings.DATABASE_URL, echo=True)
@@ -15,7 +16,14 @@ AsyncSessionLocal = sessionmaker(
 async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        # create_all skips indexes of tables that already exist, the migrations bring older databases up to date
+        await conn.run_sync(run_migrations)
 
 async def get_db():
     async with AsyncSessionLocal() as session:
         yield session
+
+# Function to get the session factory, for responses streamed after the endpoint has returned: they open and close
+# their own session instead of the request's
+def get_session_factory():
+    return AsyncSessionLocal
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+import httpx
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Statuses worth retrying: the JSON server may be starting up or momentarily overloaded
+RETRY_STATUSES = {429, 502, 503, 504}
+
+
+class FeedClient:
+    """Async HTTP client for the datalogger feed.
+
+    A single pooled keep-alive ``httpx.AsyncClient`` is shared by every fetch. Requests are retried
+    with exponential backoff on transport errors and transient statuses, and are made conditional
+    (``If-None-Match`` / ``If-Modified-Since``) once a feed has been fully ingested, so an unchanged
+    feed is answered with a body-less 304.
+    """
+
+    def __init__(self, timeout: Optional[float] = None, retries: Optional[int] = None,
+                 backoff: Optional[float] = None, transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.timeout = timeout if timeout is not None else settings.FETCH_TIMEOUT
+        self.retries = retries if retries is not None else settings.FETCH_RETRIES
+        self.backoff = backoff if backoff is not None else settings.FETCH_BACKOFF
+        self._transport = transport
+        self._client: Optional[httpx.AsyncClient] = None
+        # Cache validators (ETag / Last-Modified) of the last successfully ingested response, per full URL
+        self._validators: Dict[str, Dict[str, str]] = {}
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=10, max_keepalive_connections=10),
+                transport=self._transport
+            )
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _conditional_headers(self, url: str) -> Dict[str, str]:
+        validators = self._validators.get(url, {})
+        headers = {}
+        if "etag" in validators:
+            headers["If-None-Match"] = validators["etag"]
+        if "last-modified" in validators:
+            headers["If-Modified-Since"] = validators["last-modified"]
+        return headers
+
+    def remember(self, response: httpx.Response):
+        # Only called once the response has been fully ingested, so a failed ingestion is never skipped later
+        validators = {name: response.headers[name] for name in ("etag", "last-modified") if name in response.headers}
+        if validators:
+            self._validators[str(response.request.url)] = validators
+
+    def forget(self):
+        self._validators.clear()
+
+    async def _send(self, url: str, params: Optional[Dict[str, str]], conditional: bool,
+                    method: str = "GET") -> httpx.Response:
+        client = self._get_client()
+        attempt = 0
+        while True:
+            request = client.build_request(method, url, params=params)
+            if conditional:
+                request.headers.update(self._conditional_headers(str(request.url)))
+            try:
+                response = await client.send(request, stream=True)
+            except httpx.TransportError as e:
+                if attempt >= self.retries:
+                    raise
+                logger.warning(f"Feed request to {request.url} failed ({e!r}), retrying.")
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt >= self.retries:
+                    if response.is_error:
+                        await response.aclose()
+                        response.raise_for_status()
+                    return response
+                await response.aclose()
+                logger.warning(f"Feed request to {request.url} answered {response.status_code}, retrying.")
+            await asyncio.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+
+    async def is_ready(self, url: str) -> bool:
+        # Single probe without retries: any non-5xx answer means the server is up and serving the feed
+        try:
+            response = await self._get_client().head(url, params={"_start": "0", "_end": "1"})
+        except httpx.TransportError:
+            return False
+        return response.status_code < 500
+
+    async def count(self, url: str, params: Optional[Dict[str, str]] = None) -> Optional[int]:
+        # Size of a json-server collection, read from the X-Total-Count header of a one-item slice
+        params = {**(params or {}), "_start": "0", "_end": "1"}
+        response = await self._send(url, params, conditional=False, method="HEAD")
+        await response.aclose()
+        total = response.headers.get("x-total-count")
+        return int(total) if total is not None and total.isdigit() else None
+
+    @asynccontextmanager
+    async def stream(self, url: str, params: Optional[Dict[str, str]] = None,
+                     conditional: bool = True) -> AsyncIterator[Optional[httpx.Response]]:
+        # Yields the streamed response, or None when the server reports the feed as not modified
+        response = await self._send(url, params, conditional)
+        try:
+            yield None if response.status_code == 304 else response
+        finally:
+            await response.aclose()
+
+
+feed_client = FeedClient()
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Job states
+PENDING = "pending"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+# Number of finished jobs kept for status queries
+JOB_HISTORY_SIZE = 50
+
+
+@dataclass
+class IngestionJob:
+    """State and progress counters of one background ingestion.
+
+    The pipeline updates the counters as batches go through it: ``fetched`` measurement values read
+    from the feed, ``transformed`` rows ready to be stored, ``rejected`` entries with an invalid
+    timestamp or value and ``inserted`` rows written to the database.
+    """
+
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    status: str = PENDING
+    created_at: datetime = field(default_factory=lambda: datetime.now(timezone.utc))
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    fetched: int = 0
+    transformed: int = 0
+    rejected: int = 0
+    inserted: int = 0
+    error: Optional[str] = None
+    task: Optional[asyncio.Task] = field(default=None, repr=False)
+    _started: float = field(default=0.0, repr=False)
+    _finished: Optional[float] = field(default=None, repr=False)
+
+    @property
+    def active(self) -> bool:
+        return self.status in (PENDING, RUNNING)
+
+    @property
+    def rows_per_second(self) -> float:
+        if not self._started:
+            return 0.0
+        elapsed = (self._finished or time.perf_counter()) - self._started
+        return self.inserted / max(elapsed, 1e-9)
+
+
+class IngestionJobManager:
+    """Runs ingestions as in-process background tasks, one at a time.
+
+    A trigger received while an ingestion is pending or running is coalesced into it: the active
+    job is returned instead of starting a second ingestion racing on the same data.
+    """
+
+    def __init__(self, history_size: int = JOB_HISTORY_SIZE):
+        self.history_size = history_size
+        self._jobs: "OrderedDict[str, IngestionJob]" = OrderedDict()
+        self._active: Optional[IngestionJob] = None
+
+    def get(self, job_id: str) -> Optional[IngestionJob]:
+        return self._jobs.get(job_id)
+
+    @property
+    def active(self) -> Optional[IngestionJob]:
+        return self._active if self._active is not None and self._active.active else None
+
+    def submit(self, runner: Callable[[IngestionJob], Awaitable[None]]) -> IngestionJob:
+        active = self.active
+        if active is not None:
+            logger.info(f"Ingestion job {active.id} already in progress, trigger coalesced into it.")
+            return active
+        job = IngestionJob()
+        self._jobs[job.id] = job
+        while len(self._jobs) > self.history_size:
+            self._jobs.popitem(last=False)
+        self._active = job
+        job.task = asyncio.create_task(self._run(job, runner))
+        return job
+
+    async def _run(self, job: IngestionJob, runner: Callable[[IngestionJob], Awaitable[None]]):
+        job.status = RUNNING
+        job.started_at = datetime.now(timezone.utc)
+        job._started = time.perf_counter()
+        try:
+            await runner(job)
+            job.status = SUCCEEDED
+        except asyncio.CancelledError:
+            job.status = FAILED
+            job.error = "Ingestion cancelled"
+            raise
+        except Exception as e:
+            logger.error(f"Ingestion job {job.id} failed: {e}")
+            job.status = FAILED
+            job.error = str(e)
+        finally:
+            job._finished = time.perf_counter()
+            job.finished_at = datetime.now(timezone.utc)
+            logger.info(f"Ingestion job {job.id} {job.status}: {job.inserted} rows inserted, "
+                        f"{job.rejected} rejected ({job.rows_per_second:.0f} rows/s).")
+
+    async def shutdown(self):
+        active = self.active
+        if active is not None and active.task is not None:
+            active.task.cancel()
+            await asyncio.gather(active.task, return_exceptions=True)
+
+
+ingestion_jobs = IngestionJobManager()
@@ -0,0 +1,67 @@
+import logging
+from datetime import datetime, timezone
+from typing import Callable, List, Tuple
+from sqlalchemy import Connection, inspect, select, text
+from app.models import Data, SchemaMigration
+
+logger = logging.getLogger(__name__)
+
+NATURAL_KEY_INDEX = "uq_data_label_measured_at"
+# Single-column indexes of the first schema: the primary key is already indexed, every query filters on
+# label and a measured_at range (served by the natural key index) and nothing filters on value
+LEGACY_DATA_INDEXES = ("ix_data_id", "ix_data_label", "ix_data_measured_at", "ix_data_value")
+
+
+# Function to create the (label, measured_at) natural key index of tables created before it existed. The first
+# ingestion stored every run again, so the duplicates of a natural key are deleted first (the oldest row is kept)
+def _create_natural_key_index(conn: Connection):
+    deleted = conn.execute(text(
+        "DELETE FROM data WHERE id NOT IN (SELECT MIN(id) FROM data GROUP BY label, measured_at)"
+    )).rowcount
+    if deleted:
+        logger.info(f"Deleted {deleted} duplicate rows of the data table.")
+    for index in Data.__table__.indexes:
+        if index.unique:
+            index.create(conn, checkfirst=True)
+
+# Function to drop the single-column indexes no query uses, and to make the natural key index covering
+def _drop_unused_data_indexes(conn: Connection):
+    existing = {index["name"] for index in inspect(conn).get_indexes(Data.__tablename__)}
+    for name in LEGACY_DATA_INDEXES:
+        if name in existing:
+            conn.execute(text(f"DROP INDEX {name}"))
+            logger.info(f"Dropped index {name}.")
+    if conn.dialect.name == "postgresql":
+        # INCLUDE (value) lets /api/data and the summaries read the index only; an index created without it
+        # is rebuilt (SQLite has no INCLUDE, its rowid lookups stay)
+        covering = conn.execute(text(
+            "SELECT indnatts > indnkeyatts FROM pg_index WHERE indexrelid = to_regclass(:name)"
+        ), {"name": NATURAL_KEY_INDEX}).scalar()
+        if covering is False:
+            index = next(index for index in Data.__table__.indexes if index.name == NATURAL_KEY_INDEX)
+            index.drop(conn)
+            index.create(conn)
+            logger.info(f"Rebuilt index {NATURAL_KEY_INDEX} with INCLUDE (value).")
+
+
+# Schema migrations in order: applied once each, their version being recorded in schema_migration
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "Create the (label, measured_at) natural key index", _create_natural_key_index),
+    (2, "Drop unused data indexes, covering natural key index", _drop_unused_data_indexes),
+]
+
+
+# Function to apply the migrations not yet recorded, in one transaction with the caller's
+def run_migrations(conn: Connection) -> List[int]:
+    applied = set(conn.execute(select(SchemaMigration.version)).scalars())
+    done = []
+    for version, description, migrate in MIGRATIONS:
+        if version in applied:
+            continue
+        logger.info(f"Applying migration {version}: {description}.")
+        migrate(conn)
+        conn.execute(SchemaMigration.__table__.insert().values(
+            version=version, description=description, applied_at=datetime.now(timezone.utc).replace(tzinfo=None)
+        ))
+        done.append(version)
+    return done
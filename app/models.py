@@ -1,12 +1,98 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime
-from sqlalchemy.ext.declarative import declarative_base
+from datetime import datetime
+from typing import ClassVar, Optional
+from sqlalchemy import Integer, SmallInteger, BigInteger, String, Float, DateTime, Index, ForeignKey, \
+    PrimaryKeyConstraint, Table
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
+
+
+class Base(DeclarativeBase):
+    # Every model is mapped to a Table (not just any FROM clause), used as such by Core inserts
+    __table__: ClassVar[Table]
 
-Base = declarative_base()
 
 class Data(Base):
     __tablename__ = "data"
 
-    id = Column(Integer, primary_key=True, index=True)
-    label = Column(String, index=True)
-    measured_at = Column(DateTime, index=True)
-    value = Column(Float, index=True)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    label: Mapped[Optional[str]] = mapped_column(String)
+    measured_at: Mapped[Optional[datetime]] = mapped_column(DateTime)
+    value: Mapped[Optional[float]] = mapped_column(Float)
+
+    __table_args__ = (
+        # Natural key of a measurement, also the conflict target of upsert ingestion. Every query filters on
+        # label then a measured_at range, so it is the only index; on PostgreSQL it also covers value.
+        Index("uq_data_label_measured_at", "label", "measured_at", unique=True, postgresql_include=["value"]),
+    )
+
+
+class Datalogger(Base):
+    __tablename__ = "datalogger"
+
+    # Labels of the compact layout, referenced by a small integer instead of being repeated on every row
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    label: Mapped[str] = mapped_column(String, unique=True, nullable=False)
+
+
+class DataCompact(Base):
+    __tablename__ = "data_compact"
+
+    # Compact layout of Data: measured_at is an epoch-millisecond UTC timestamp, the feed's native format.
+    # The 8-byte columns come first so PostgreSQL does not pad the row for the smallint.
+    measured_at: Mapped[int] = mapped_column(BigInteger, nullable=False, autoincrement=False)
+    value: Mapped[float] = mapped_column(Float, nullable=False)
+    datalogger_id: Mapped[int] = mapped_column(SmallInteger, ForeignKey("datalogger.id"), nullable=False)
+
+    __table_args__ = (
+        # The natural key is the primary key; on SQLite the table is clustered on it (no rowid, no separate index)
+        PrimaryKeyConstraint("datalogger_id", "measured_at"),
+        {"sqlite_with_rowid": False},
+    )
+
+
+class DataWide(Base):
+    __tablename__ = "data_wide"
+
+    # Wide layout of Data: one row per station and timestamp with a column per metric, as in the feed. A metric
+    # missing from a reading is NULL.
+    station: Mapped[str] = mapped_column(String, nullable=False)
+    measured_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    temp: Mapped[Optional[float]] = mapped_column(Float)
+    hum: Mapped[Optional[float]] = mapped_column(Float)
+    precip: Mapped[Optional[float]] = mapped_column(Float)
+
+    __table_args__ = (
+        PrimaryKeyConstraint("station", "measured_at"),
+        {"sqlite_with_rowid": False},
+    )
+
+
+class IngestionWatermark(Base):
+    __tablename__ = "ingestion_watermark"
+
+    # Latest measured_at stored for each datalogger label, used to skip already ingested history
+    label: Mapped[str] = mapped_column(String, primary_key=True)
+    measured_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+
+class DataRollup(Base):
+    __tablename__ = "data_rollup"
+
+    # Pre-aggregated measurements of a label over one hour / day / month bucket, maintained at ingest time.
+    # bucket is the formatted start of the bucket, as returned by /api/summary ("2022-12", "2022-12-31",
+    # "2022-12-31 01:00:00"), so buckets of a span sort and compare as strings.
+    label: Mapped[str] = mapped_column(String, primary_key=True)
+    span: Mapped[str] = mapped_column(String, primary_key=True)
+    bucket: Mapped[str] = mapped_column(String, primary_key=True)
+    count: Mapped[int] = mapped_column(Integer, nullable=False)
+    total: Mapped[float] = mapped_column(Float, nullable=False)
+    min_value: Mapped[float] = mapped_column(Float, nullable=False)
+    max_value: Mapped[float] = mapped_column(Float, nullable=False)
+
+
+class SchemaMigration(Base):
+    __tablename__ = "schema_migration"
+
+    # Versions of the migrations of app.migrations applied to the database
+    version: Mapped[int] = mapped_column(Integer, primary_key=True)
+    description: Mapped[str] = mapped_column(String, nullable=False)
+    applied_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
@@ -0,0 +1,202 @@
+import csv
+import hashlib
+import io
+import json
+from datetime import datetime
+from email.utils import format_datetime
+from types import ModuleType
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, List, Optional, Sequence
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from app.config import settings
+from app.schemas import AggregatedDataRetrievalResponse
+from app.storage import Record
+
+orjson: Optional[ModuleType]
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Media types of the /api/data representations
+JSON_MEDIA_TYPE = "application/json"
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+CSV_MEDIA_TYPE = "text/csv"
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+PARQUET_MEDIA_TYPE = "application/vnd.apache.parquet"
+# Media type of each value of the format parameter, in order of preference when the Accept header ranks them equally
+DATA_FORMATS = {
+    "json": JSON_MEDIA_TYPE,
+    "ndjson": NDJSON_MEDIA_TYPE,
+    "csv": CSV_MEDIA_TYPE,
+    "arrow": ARROW_MEDIA_TYPE,
+    "parquet": PARQUET_MEDIA_TYPE,
+}
+# Representations encoded from the columns of a whole page rather than streamed, and those needing pyarrow
+TABULAR_MEDIA_TYPES = (CSV_MEDIA_TYPE, ARROW_MEDIA_TYPE, PARQUET_MEDIA_TYPE)
+PYARROW_MEDIA_TYPES = (ARROW_MEDIA_TYPE, PARQUET_MEDIA_TYPE)
+CSV_HEADER = ("label", "measured_at", "value")
+
+
+# Function to tell whether a representation can be produced (pyarrow is an optional dependency)
+def available(media_type: str) -> bool:
+    return pyarrow is not None or media_type not in PYARROW_MEDIA_TYPES
+
+# Function to parse an Accept header into (media range, quality) pairs
+def _media_ranges(accept: str) -> List[tuple]:
+    ranges = []
+    for media_range in accept.split(","):
+        media_type, *params = [part.strip() for part in media_range.split(";")]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if media_type:
+            ranges.append((media_type.lower(), quality))
+    return ranges
+
+# Function to pick the /api/data media type from the format parameter, else from the Accept header. None when only
+# representations that can't be produced are acceptable; an Accept header matching none of them gets JSON
+def negotiate(accept: Optional[str], data_format: Optional[str] = None) -> Optional[str]:
+    if data_format:
+        media_type = DATA_FORMATS[data_format]
+        return media_type if available(media_type) else None
+    ranges = _media_ranges(accept or "")
+    candidates = []
+    for preference, media_type in enumerate(DATA_FORMATS.values()):
+        main_type = media_type.split("/")[0]
+        # The most specific range matching a media type sets its quality
+        matches = [(specificity, quality, position) for position, (media_range, quality) in enumerate(ranges)
+                   for specificity, pattern in ((2, media_type), (1, f"{main_type}/*"), (0, "*/*"))
+                   if media_range == pattern]
+        if matches:
+            specificity, quality, position = max(matches, key=lambda match: match[0])
+            if quality > 0:
+                candidates.append((-quality, -specificity, position, preference, media_type))
+    if not candidates:
+        return JSON_MEDIA_TYPE
+    producible = [candidate[-1] for candidate in sorted(candidates) if available(candidate[-1])]
+    return producible[0] if producible else None
+
+
+# Function to build a strong entity tag from the parts identifying a representation
+def entity_tag(*parts: Any) -> str:
+    return '"' + hashlib.sha256(repr(parts).encode("utf-8")).hexdigest()[:32] + '"'
+
+# Function to tell whether an If-None-Match header matches an entity tag (weak comparison, as GET requires). "*"
+# matches any current representation, so it only counts once the representation is known to exist
+def etag_matches(if_none_match: Optional[str], etag: str, exists: bool = False) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return (exists and "*" in tags) or etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
+
+# Function to format a Last-Modified header value
+def http_date(value: datetime) -> str:
+    return format_datetime(value, usegmt=True)
+
+# Function to serialize like FastAPI's JSONResponse, so streamed bodies match the buffered ones byte for byte
+def _dumps(content: Any) -> str:
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":"))
+
+def _record_dicts(batch: Sequence[Record]) -> List[Dict[str, Any]]:
+    return [{"label": record.label, "measured_at": record.measured_at.isoformat(), "value": record.value}
+            for record in batch]
+
+# Function to tell whether content holding these numbers can go through orjson: it writes the floats json puts in
+# exponent notation (below 1e-4 or from 1e16) differently, and NaN / infinity as null where json refuses them
+def _fast(numbers: Iterable[Optional[float]]) -> bool:
+    return (settings.FAST_JSON_RESPONSES
+            and all(number is None or number == 0 or 1e-4 <= abs(number) < 1e16 for number in numbers))
+
+# Function to encode a batch of records as a JSON list (orjson writes naive datetimes as isoformat does)
+def _encode_records(batch: Sequence[Record]) -> bytes:
+    if orjson is not None and _fast(record.value for record in batch):
+        return orjson.dumps([{"label": label, "measured_at": measured_at, "value": value}
+                             for label, measured_at, value in batch])
+    return _dumps(_record_dicts(batch)).encode("utf-8")
+
+# Function to encode the body of an /api/summary response. The fast path serializes the aggregates without
+# instantiating AggregatedDataRecord, doing the float conversion of its fields itself
+def encode_aggregates(data: List[Dict[str, Any]]) -> bytes:
+    if not settings.FAST_JSON_RESPONSES:
+        response = AggregatedDataRetrievalResponse.model_validate({"data": data})
+        return bytes(JSONResponse(jsonable_encoder(response)).body)
+    rows = [{
+        "label": row["label"],
+        "measured_at": row["measured_at"],
+        "value": float(row["value"]),
+        "min_value": None if row.get("min_value") is None else float(row["min_value"]),
+        "max_value": None if row.get("max_value") is None else float(row["max_value"]),
+    } for row in data]
+    content = {"data": rows}
+    if orjson is not None and _fast(number for row in rows for number in (row["value"], row["min_value"],
+                                                                          row["max_value"])):
+        return orjson.dumps(content)
+    return _dumps(content).encode("utf-8")
+
+# Function to encode the columns of a page as CSV, the values being spelled as in JSON
+def _encode_csv(labels: List[str], measured_ats: List[datetime], values: List[float]) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_HEADER)
+    writer.writerows(zip(labels, (measured_at.isoformat() for measured_at in measured_ats), values))
+    return buffer.getvalue().encode("utf-8")
+
+# Function to build the Arrow table of a page: timestamps are stored as naive UTC, so they are typed as UTC
+def _arrow_table(labels: List[str], measured_ats: List[datetime], values: List[float]):
+    return pyarrow.table({
+        "label": pyarrow.array(labels, pyarrow.string()).dictionary_encode(),
+        "measured_at": pyarrow.array(measured_ats, pyarrow.timestamp("us", tz="UTC")),
+        "value": pyarrow.array(values, pyarrow.float64()),
+    })
+
+# Function to encode the columns of a page as CSV, an Arrow IPC stream or Parquet
+def encode_columns(media_type: str, labels: List[str], measured_ats: List[datetime], values: List[float]) -> bytes:
+    if media_type == CSV_MEDIA_TYPE:
+        return _encode_csv(labels, measured_ats, values)
+    table = _arrow_table(labels, measured_ats, values)
+    sink = pyarrow.BufferOutputStream()
+    if media_type == ARROW_MEDIA_TYPE:
+        with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+    else:
+        pyarrow.parquet.write_table(table, sink)
+    return sink.getvalue().to_pybytes()
+
+# Function to encode batches of records as the {"data": [...], "next_cursor": ...} document of
+# DataRetrievalResponse, batch by batch. next_cursor is called once the batches are exhausted
+async def stream_json(batches: AsyncIterator[Sequence[Record]],
+                      next_cursor: Callable[[], Optional[str]] = lambda: None) -> AsyncIterator[bytes]:
+    separator = b""
+    yield b'{"data":['
+    async for batch in batches:
+        if batch:
+            # One dumps per batch, the brackets of the list being dropped
+            yield separator + _encode_records(batch)[1:-1]
+            separator = b","
+    yield f'],"next_cursor":{_dumps(next_cursor())}}}'.encode("utf-8")
+
+# Function to encode batches of records as newline-delimited JSON, one record per line. When another page
+# follows, a last {"next_cursor": ...} line carries its cursor
+async def stream_ndjson(batches: AsyncIterator[Sequence[Record]],
+                        next_cursor: Callable[[], Optional[str]] = lambda: None) -> AsyncIterator[bytes]:
+    async for batch in batches:
+        if batch and orjson is not None and _fast(record.value for record in batch):
+            yield b"".join(orjson.dumps({"label": label, "measured_at": measured_at, "value": value},
+                                        option=orjson.OPT_APPEND_NEWLINE) for label, measured_at, value in batch)
+        elif batch:
+            yield "".join(_dumps(record) + "\n" for record in _record_dicts(batch)).encode("utf-8")
+    cursor = next_cursor()
+    if cursor is not None:
+        yield (_dumps({"next_cursor": cursor}) + "\n").encode("utf-8")
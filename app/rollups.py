@@ -0,0 +1,206 @@
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+from sqlalchemy import case, delete, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.models import DataRollup
+from app.storage import Aggregate as BucketAggregate, get_layout
+from app.time_buckets import SPANS, BUCKET_FORMATS, BUCKET_LENGTHS
+
+logger = logging.getLogger(__name__)
+
+
+# (count, total, min, max) of the measurements of a bucket
+Aggregate = List[float]
+# (span, low, high) part of a range: whole buckets of the span, or raw data when the span is None
+RangePart = Tuple[Optional[str], Optional[datetime], Optional[datetime]]
+
+
+# Function to get the INSERT construct able to merge rollups, None on dialects without rollup support
+def _rollup_insert(db: AsyncSession):
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        return postgresql.insert
+    if dialect == "sqlite":
+        return sqlite.insert
+    return None
+
+# Function to aggregate (label, measured_at, value) rows per label and bucket for every span, as rollup records
+def _aggregate_rows(rows: Sequence[Tuple[str, datetime, float]]) -> List[Dict[str, object]]:
+    hours: Dict[Tuple[str, datetime], Aggregate] = {}
+    for label, measured_at, value in rows:
+        key = (label, measured_at.replace(minute=0, second=0, microsecond=0))
+        aggregate = hours.get(key)
+        if aggregate is None:
+            hours[key] = [1, value, value, value]
+        else:
+            aggregate[0] += 1
+            aggregate[1] += value
+            if value < aggregate[2]:
+                aggregate[2] = value
+            if value > aggregate[3]:
+                aggregate[3] = value
+    # Only one timestamp per hour is formatted
+    return _rollup_records((label, start.strftime(BUCKET_FORMATS["hour"]), int(count), total, minimum, maximum)
+                           for (label, start), (count, total, minimum, maximum) in hours.items())
+
+# Function to build the rollup records of every span from the (label, bucket, count, total, min, max) aggregates of
+# hour buckets: days and months are merged from the hours, their buckets being prefixes of the hour buckets
+def _rollup_records(hours: Iterable[BucketAggregate]) -> List[Dict[str, object]]:
+    buckets: Dict[str, Dict[Tuple[str, str], Aggregate]] = {span: {} for span in SPANS}
+    for label, bucket, count, total, minimum, maximum in hours:
+        for span in SPANS:
+            _merge(buckets[span], (label, bucket[:BUCKET_LENGTHS[span]]), count, total, minimum, maximum)
+    return [
+        {"label": label, "span": span, "bucket": bucket, "count": count, "total": total,
+         "min_value": minimum, "max_value": maximum}
+        for span in SPANS
+        for (label, bucket), (count, total, minimum, maximum) in buckets[span].items()
+    ]
+
+# Function to write rollup records, merged into the existing buckets (replace=False) or overwriting them
+async def _write_rollups(db: AsyncSession, records: List[Dict[str, object]], replace: bool = False):
+    # Executed with bound parameters: one cached statement whatever the number of buckets
+    statement = _rollup_insert(db)(DataRollup.__table__)
+    excluded = statement.excluded
+    table = DataRollup.__table__.c
+    if replace:
+        merged = {"count": excluded.count, "total": excluded.total,
+                  "min_value": excluded.min_value, "max_value": excluded.max_value}
+    else:
+        merged = {
+            "count": table.count + excluded.count,
+            "total": table.total + excluded.total,
+            "min_value": case((excluded.min_value < table.min_value, excluded.min_value), else_=table.min_value),
+            "max_value": case((excluded.max_value > table.max_value, excluded.max_value), else_=table.max_value),
+        }
+    await db.execute(statement.on_conflict_do_update(index_elements=["label", "span", "bucket"], set_=merged), records)
+
+# Function to add newly inserted rows to the rollups (in the caller's transaction)
+async def add_to_rollups(db: AsyncSession, rows: Sequence[Tuple[str, datetime, float]]):
+    if not rows or _rollup_insert(db) is None:
+        return
+    await _write_rollups(db, _aggregate_rows(rows))
+
+# Function to recompute from the raw data the rollups of the months touched by rows whose values may have been replaced
+async def refresh_rollups(db: AsyncSession, rows: Sequence[Tuple[str, datetime, float]]):
+    if not rows or _rollup_insert(db) is None:
+        return
+    ranges: Dict[str, Tuple[datetime, datetime]] = {}
+    for label, measured_at, _ in rows:
+        low, high = ranges.get(label, (measured_at, measured_at))
+        ranges[label] = (min(low, measured_at), max(high, measured_at))
+    for label, (low, high) in ranges.items():
+        await rebuild_rollups(db, label, _floor(low, "month"), _next(_floor(high, "month"), "month"))
+
+# Function to rebuild rollups from the raw data, for one label and/or a month-aligned [start, end) range
+async def rebuild_rollups(db: AsyncSession, label: Optional[str] = None, start: Optional[datetime] = None,
+                          end: Optional[datetime] = None):
+    if _rollup_insert(db) is None:
+        return
+    clear = delete(DataRollup)
+    if label is not None:
+        clear = clear.where(DataRollup.label == label)
+    if start is not None:
+        clear = clear.where(DataRollup.bucket >= start.strftime(BUCKET_FORMATS["month"]))
+    if end is not None:
+        clear = clear.where(DataRollup.bucket < end.strftime(BUCKET_FORMATS["month"]))
+    await db.execute(clear)
+    # The hours are aggregated by the database (GROUP BY), so the raw rows are never loaded
+    hours = await get_layout().aggregate(db, label, "hour", start, end)
+    if hours:
+        await _write_rollups(db, _rollup_records(hours), replace=True)
+    logger.info(f"Rebuilt rollups from {sum(hour[2] for hour in hours)} records.")
+
+# Function to build the rollups of a database ingested before they existed (rollup table empty, data present).
+# Run by the ingestion jobs before they write: they run one at a time, so no ingestion adds to the rollups first
+async def backfill_rollups(db: AsyncSession) -> bool:
+    if _rollup_insert(db) is None:
+        return False
+    if (await db.execute(select(DataRollup.label).limit(1))).first() is not None:
+        return False
+    if not await get_layout().has_data(db):
+        return False
+    await rebuild_rollups(db)
+    await db.commit()
+    return True
+
+# Function to tell whether summaries of a label can be served from its rollups
+async def has_rollups(db: AsyncSession, label: str, span: str) -> bool:
+    if _rollup_insert(db) is None:
+        return False
+    query = select(DataRollup.bucket).where(DataRollup.label == label, DataRollup.span == span).limit(1)
+    return (await db.execute(query)).first() is not None
+
+def _floor(value: datetime, span: str) -> datetime:
+    value = value.replace(minute=0, second=0, microsecond=0)
+    if span in ("day", "month"):
+        value = value.replace(hour=0)
+    if span == "month":
+        value = value.replace(day=1)
+    return value
+
+def _next(value: datetime, span: str) -> datetime:
+    if span == "hour":
+        return value + timedelta(hours=1)
+    if span == "day":
+        return value + timedelta(days=1)
+    return value.replace(year=value.year + value.month // 12, month=value.month % 12 + 1)
+
+def _ceil(value: datetime, span: str) -> datetime:
+    floor = _floor(value, span)
+    return floor if floor == value else _next(floor, span)
+
+# Function to split a [low, high) range (None bounds being open) into whole buckets of the coarsest possible
+# spans, and the sub-hour edges left to the raw data: a list of (span or None, low, high) parts
+def _plan_range(low: Optional[datetime], high: Optional[datetime],
+                spans: Sequence[str]) -> List[RangePart]:
+    if not spans:
+        return [(None, low, high)]
+    span = spans[0]
+    start = _ceil(low, span) if low is not None else None
+    end = _floor(high, span) if high is not None else None
+    if start is not None and end is not None and start >= end:
+        return _plan_range(low, high, spans[1:])
+    parts: List[RangePart] = [(span, start, end)]
+    # start (end) is only None when low (high) is
+    if low is not None and start is not None and low < start:
+        parts += _plan_range(low, start, spans[1:])
+    if high is not None and end is not None and end < high:
+        parts += _plan_range(end, high, spans[1:])
+    return parts
+
+def _merge(aggregates: Dict, key, count: int, total: float, minimum: float, maximum: float):
+    current = aggregates.get(key)
+    if current is None:
+        aggregates[key] = [count, total, minimum, maximum]
+    else:
+        current[0] += count
+        current[1] += total
+        current[2] = min(current[2], minimum)
+        current[3] = max(current[3], maximum)
+
+# Function to aggregate a label per span bucket over [low, high) from the coarsest rollups able to answer it
+async def get_rolled_up_aggregates(db: AsyncSession, label: str, span: str, low: Optional[datetime],
+                                   high: Optional[datetime]) -> List[Dict[str, object]]:
+    key_length = BUCKET_LENGTHS[span]
+    aggregates: Dict[str, Aggregate] = {}
+    for part_span, start, end in _plan_range(low, high, SPANS[SPANS.index(span):]):
+        if part_span is None:
+            # Edge shorter than an hour: aggregated from its raw rows
+            for _, measured_at, value in await get_layout().fetch_rows(db, label, start, end):
+                _merge(aggregates, measured_at.strftime(BUCKET_FORMATS[span]), 1, value, value, value)
+            continue
+        query = select(DataRollup.bucket, DataRollup.count, DataRollup.total, DataRollup.min_value,
+                       DataRollup.max_value).where(DataRollup.label == label, DataRollup.span == part_span)
+        if start is not None:
+            query = query.where(DataRollup.bucket >= start.strftime(BUCKET_FORMATS[part_span]))
+        if end is not None:
+            query = query.where(DataRollup.bucket < end.strftime(BUCKET_FORMATS[part_span]))
+        for bucket, count, total, minimum, maximum in (await db.execute(query)).all():
+            _merge(aggregates, bucket[:key_length], count, total, minimum, maximum)
+    return [
+        {"label": label, "measured_at": key, "value": total / count, "min_value": minimum, "max_value": maximum}
+        for key, (count, total, minimum, maximum) in sorted(aggregates.items())
+    ]
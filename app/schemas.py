@@ -28,6 +28,8 @@ class DataRecord(BaseModel):
 
 class DataRetrievalResponse(BaseModel):
     data: List[DataRecord]
+    # Cursor of the next page, None on the last one
+    next_cursor: Optional[str] = None
 
     class Config:
         model_config = ConfigDict(arbitrary_types_allowed=True)
@@ -52,8 +54,18 @@ class AggregatedDataRecord(BaseModel):
             max_value=obj.max_value
         )
 
-class DataIngestionResponse(BaseModel):
-    message: str
+class IngestionJobResponse(BaseModel):
+    job_id: str
+    status: str
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    fetched: int = 0
+    transformed: int = 0
+    rejected: int = 0
+    inserted: int = 0
+    rows_per_second: float = 0.0
+    error: Optional[str] = None
 
 class AggregatedDataRetrievalResponse(BaseModel):
     data: List[AggregatedDataRecord]
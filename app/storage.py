@@ -0,0 +1,501 @@
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+from typing import AsyncGenerator, Dict, Iterable, List, NamedTuple, Optional, Sequence, Set, Tuple
+from sqlalchemy import Column, Select, case, delete, func, insert as core_insert, literal, select, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.config import settings
+from app.models import Data, DataCompact, DataWide, Datalogger
+from app.time_buckets import BUCKET_FORMATS, time_bucket
+
+# Storage layouts
+ROW_LAYOUT = "row"
+COMPACT_LAYOUT = "compact"
+WIDE_LAYOUT = "wide"
+
+# A trusted (label, measured_at, value) row, measured_at being a naive UTC datetime
+Row = Tuple[str, datetime, float]
+# (label, bucket, count, total, min, max) of the measurements of a label in one summary bucket
+Aggregate = Tuple[str, str, int, float, float, float]
+
+EPOCH = datetime(1970, 1, 1)
+MILLISECOND = timedelta(milliseconds=1)
+# Width of the integer buckets of the compact layout (months are merged from days)
+BUCKET_MS = {"hour": 3_600_000, "day": 86_400_000, "month": 86_400_000}
+# Metric columns of the wide layout, and the station of its rows (the feed comes from a single datalogger)
+WIDE_METRICS = ("hum", "precip", "temp")
+WIDE_STATION = "datalogger"
+# Number of timestamps looked up per query by the wide layout's writes (keeps bound parameters under SQLite's limit)
+WIDE_LOOKUP_CHUNK_SIZE = 500
+
+
+class Record(NamedTuple):
+    label: str
+    measured_at: datetime
+    value: float
+
+
+# Function to pick the dialect-specific INSERT construct supporting ON CONFLICT
+def dialect_insert(db: AsyncSession):
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        return postgresql.insert
+    if dialect == "sqlite":
+        return sqlite.insert
+    raise ValueError(f"Upsert ingestion is not supported on the '{dialect}' dialect.")
+
+
+# Function to copy rows into a PostgreSQL table with COPY through the asyncpg driver connection
+async def _copy_records(db: AsyncSession, table: str, columns: List[str], records: Sequence[tuple]):
+    connection = await db.connection()
+    raw_connection = await connection.get_raw_connection()
+    driver_connection = raw_connection.driver_connection
+    if driver_connection is None:
+        raise ValueError("The asyncpg connection of the session is closed.")
+    await driver_connection.copy_records_to_table(table, records=records, columns=columns)
+
+
+# Function to tell whether a write goes through COPY: plain inserts (no conflict handling) on asyncpg
+def _use_copy(db: AsyncSession, on_conflict: Optional[str]) -> bool:
+    return on_conflict is None and db.get_bind().dialect.driver == "asyncpg"
+
+
+class StorageLayout(ABC):
+    """Table layout of the measurements, hidden behind the functions of ``app.crud``.
+
+    Rows come in and go out as (label, measured_at, value) with naive UTC datetimes whatever the layout;
+    ranges are half-open ``[low, high)``, ``None`` bounds being open. Summaries are returned as
+    ``Aggregate`` tuples sorted by bucket then label.
+    """
+
+    name: str
+
+    @abstractmethod
+    async def write(self, db: AsyncSession, rows: List[Row], on_conflict: Optional[str]) -> Sequence[Row]:
+        """Write one chunk of rows and return the inserted ones (all of them in "update" mode)."""
+        raise NotImplementedError
+
+    # Queries of the (label, measured_at, value) rows of a label (or of every label) over a range, whose results
+    # in turn are ordered by label then measured_at
+    @abstractmethod
+    def _range_queries(self, label: Optional[str], low: Optional[datetime],
+                       high: Optional[datetime]) -> List[Select]:
+        raise NotImplementedError
+
+    # Converts result rows of the range queries to records
+    def _decode(self, rows: Sequence) -> Sequence[Record]:
+        return rows
+
+    # The queries follow the key order, so a LIMIT stops the index range scan early
+    async def fetch_rows(self, db: AsyncSession, label: Optional[str], low: Optional[datetime],
+                         high: Optional[datetime], limit: Optional[int] = None) -> Sequence[Record]:
+        """Read at most limit rows of a label (or of every label) over a range, by label then measured_at."""
+        records: List[Record] = []
+        for query in self._range_queries(label, low, high):
+            if limit is not None:
+                if len(records) >= limit:
+                    break
+                query = query.limit(limit - len(records))
+            records.extend(self._decode((await db.execute(query)).all()))
+        return records
+
+    async def stream_rows(self, db: AsyncSession, label: Optional[str], low: Optional[datetime],
+                          high: Optional[datetime], batch_size: int,
+                          limit: Optional[int] = None) -> AsyncGenerator[Sequence[Record], None]:
+        """Read the same rows as fetch_rows, batch by batch from a server-side cursor."""
+        streamed = 0
+        for query in self._range_queries(label, low, high):
+            if limit is not None:
+                if streamed >= limit:
+                    break
+                query = query.limit(limit - streamed)
+            result = await db.stream(query.execution_options(yield_per=batch_size))
+            async for partition in result.partitions():
+                streamed += len(partition)
+                yield self._decode(partition)
+
+    @abstractmethod
+    async def fetch_existing(self, db: AsyncSession, keys: List[Tuple[str, datetime]]) -> Set[Row]:
+        """Read the stored rows among a list of (label, measured_at) keys."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def latest(self, db: AsyncSession) -> Dict[str, datetime]:
+        """Return the latest measured_at stored per label."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def aggregate(self, db: AsyncSession, label: Optional[str], span: str, low: Optional[datetime],
+                        high: Optional[datetime]) -> List[Aggregate]:
+        """Aggregate a label (or every label) per span bucket over a range."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def has_data(self, db: AsyncSession) -> bool:
+        """Whether any measurement is stored."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def delete_all(self, db: AsyncSession):
+        """Delete every stored measurement."""
+        raise NotImplementedError
+
+
+class RowLayout(StorageLayout):
+    """One ``data`` row per measurement: label text, ``DateTime`` timestamp and value."""
+
+    name = ROW_LAYOUT
+
+    async def write(self, db: AsyncSession, rows: List[Row], on_conflict: Optional[str]) -> Sequence[Row]:
+        """Insert the rows into ``data``, with COPY on asyncpg when there is no conflict handling."""
+        if _use_copy(db, on_conflict):
+            await _copy_records(db, Data.__tablename__, ["label", "measured_at", "value"], rows)
+            return rows
+        mappings = [{"label": label, "measured_at": measured_at, "value": value} for label, measured_at, value in rows]
+        if on_conflict is None:
+            await db.execute(core_insert(Data.__table__), mappings)
+            return rows
+
+        # The table rather than the mapped class: plain Core executemany, without the ORM bulk-insert bookkeeping
+        statement = dialect_insert(db)(Data.__table__)
+        if on_conflict == "ignore":
+            # Rows skipped by the conflict are not returned
+            statement = statement.on_conflict_do_nothing(index_elements=["label", "measured_at"]).returning(
+                Data.label, Data.measured_at, Data.value
+            )
+            return (await db.execute(statement, mappings)).all()
+        statement = statement.on_conflict_do_update(
+            index_elements=["label", "measured_at"],
+            set_={"value": statement.excluded.value}
+        )
+        await db.execute(statement, mappings)
+        return rows
+
+    @staticmethod
+    def _where(query, label: Optional[str], low: Optional[datetime], high: Optional[datetime]):
+        if label is not None:
+            query = query.where(Data.label == label)
+        if low is not None:
+            query = query.where(Data.measured_at >= low)
+        if high is not None:
+            query = query.where(Data.measured_at < high)
+        return query
+
+    def _range_queries(self, label: Optional[str], low: Optional[datetime],
+                       high: Optional[datetime]) -> List[Select]:
+        query = self._where(select(Data.label, Data.measured_at, Data.value), label, low, high)
+        # The order of the (label, measured_at) index
+        return [query.order_by(Data.label, Data.measured_at)]
+
+    async def fetch_existing(self, db: AsyncSession, keys: List[Tuple[str, datetime]]) -> Set[Row]:
+        """Read the ``data`` rows of the keys."""
+        # One round-trip: the keys are joined as a VALUES list on both SQLite and PostgreSQL
+        query: Select = select(Data.label, Data.measured_at, Data.value).where(tuple_(Data.label, Data.measured_at).in_(keys))
+        return {(row.label, row.measured_at, row.value) for row in await db.execute(query)}
+
+    async def latest(self, db: AsyncSession) -> Dict[str, datetime]:
+        """Return the latest ``data`` measured_at per label."""
+        query: Select = select(Data.label, func.max(Data.measured_at)).group_by(Data.label)
+        return {label: measured_at for label, measured_at in await db.execute(query) if measured_at is not None}
+
+    async def aggregate(self, db: AsyncSession, label: Optional[str], span: str, low: Optional[datetime],
+                        high: Optional[datetime]) -> List[Aggregate]:
+        """Aggregate the ``data`` rows grouped by label and formatted time bucket."""
+        bucket = time_bucket(span, Data.measured_at)
+        query = self._where(select(
+            Data.label, bucket, func.count(), func.sum(Data.value), func.min(Data.value), func.max(Data.value)
+        ), label, low, high)
+        # Grouped by the expression: SQLite resolves a bare 'measured_at' to the column rather than the alias.
+        # The ORDER BY repeats the GROUP BY keys so the grouping sort also orders the result
+        query = query.group_by(bucket, Data.label).order_by(bucket, Data.label)
+        return [tuple(row) for row in await db.execute(query)]
+
+    async def has_data(self, db: AsyncSession) -> bool:
+        """Whether ``data`` holds a row."""
+        return (await db.execute(select(Data.id).limit(1))).first() is not None
+
+    async def delete_all(self, db: AsyncSession):
+        """Delete every ``data`` row."""
+        await db.execute(delete(Data))
+
+
+# Function to convert a naive UTC datetime to an epoch-millisecond timestamp (sub-millisecond digits dropped)
+def to_epoch_ms(value: datetime) -> int:
+    return (value - EPOCH) // MILLISECOND
+
+
+# Function to convert a range bound to the first epoch-millisecond timestamp not before it
+def _bound_epoch_ms(value: datetime) -> int:
+    return -((EPOCH - value) // MILLISECOND)
+
+
+# Function to convert an epoch-millisecond timestamp back to a naive UTC datetime
+def from_epoch_ms(value: int) -> datetime:
+    return EPOCH + value * MILLISECOND
+
+
+class CompactLayout(StorageLayout):
+    """``data_compact`` rows of a small datalogger id, an epoch-millisecond timestamp and the value.
+
+    Labels live once in the ``datalogger`` table and the natural key is the (clustered on SQLite)
+    primary key, so rows and index are a fraction of the ``row`` layout's. Summaries group on integer
+    hour / day numbers instead of formatting timestamps.
+    """
+
+    name = COMPACT_LAYOUT
+
+    # Function to map labels to their datalogger ids, registering the unknown ones when create is set
+    async def _datalogger_ids(self, db: AsyncSession, labels: Iterable[str], create: bool = False) -> Dict[str, int]:
+        labels = set(labels)
+        query: Select = select(Datalogger.label, Datalogger.id).where(Datalogger.label.in_(labels))
+        ids = dict((await db.execute(query)).all())
+        missing = labels - ids.keys()
+        if missing and create:
+            statement = dialect_insert(db)(Datalogger.__table__).on_conflict_do_nothing(index_elements=["label"])
+            await db.execute(statement, [{"label": label} for label in sorted(missing)])
+            ids = dict((await db.execute(query)).all())
+        return ids
+
+    async def write(self, db: AsyncSession, rows: List[Row], on_conflict: Optional[str]) -> Sequence[Row]:
+        """Insert the rows into ``data_compact``, registering their unknown dataloggers first."""
+        ids = await self._datalogger_ids(db, {label for label, _, _ in rows}, create=True)
+        if _use_copy(db, on_conflict):
+            records = [(to_epoch_ms(measured_at), value, ids[label]) for label, measured_at, value in rows]
+            await _copy_records(db, DataCompact.__tablename__, ["measured_at", "value", "datalogger_id"], records)
+            return rows
+        mappings = [{"datalogger_id": ids[label], "measured_at": to_epoch_ms(measured_at), "value": value}
+                    for label, measured_at, value in rows]
+        if on_conflict is None:
+            await db.execute(core_insert(DataCompact.__table__), mappings)
+            return rows
+
+        statement = dialect_insert(db)(DataCompact.__table__)
+        if on_conflict == "ignore":
+            statement = statement.on_conflict_do_nothing(index_elements=["datalogger_id", "measured_at"]).returning(
+                DataCompact.datalogger_id, DataCompact.measured_at, DataCompact.value
+            )
+            labels = {datalogger_id: label for label, datalogger_id in ids.items()}
+            return [(labels[datalogger_id], from_epoch_ms(measured_at), value)
+                    for datalogger_id, measured_at, value in await db.execute(statement, mappings)]
+        statement = statement.on_conflict_do_update(
+            index_elements=["datalogger_id", "measured_at"],
+            set_={"value": statement.excluded.value}
+        )
+        await db.execute(statement, mappings)
+        return rows
+
+    @staticmethod
+    def _where(query, label: Optional[str], low: Optional[datetime], high: Optional[datetime]):
+        query = query.join(Datalogger, Datalogger.id == DataCompact.datalogger_id)
+        if label is not None:
+            query = query.where(Datalogger.label == label)
+        if low is not None:
+            query = query.where(DataCompact.measured_at >= _bound_epoch_ms(low))
+        if high is not None:
+            query = query.where(DataCompact.measured_at < _bound_epoch_ms(high))
+        return query
+
+    def _range_queries(self, label: Optional[str], low: Optional[datetime],
+                       high: Optional[datetime]) -> List[Select]:
+        query = self._where(select(Datalogger.label, DataCompact.measured_at, DataCompact.value), label, low, high)
+        return [query.order_by(DataCompact.datalogger_id, DataCompact.measured_at)]
+
+    def _decode(self, rows: Sequence) -> Sequence[Record]:
+        return [Record(label, from_epoch_ms(measured_at), value) for label, measured_at, value in rows]
+
+    async def fetch_existing(self, db: AsyncSession, keys: List[Tuple[str, datetime]]) -> Set[Row]:
+        """Read the ``data_compact`` rows of the keys whose labels are registered."""
+        ids = await self._datalogger_ids(db, {label for label, _ in keys})
+        id_keys = [(ids[label], to_epoch_ms(measured_at)) for label, measured_at in keys if label in ids]
+        if not id_keys:
+            return set()
+        query: Select = select(Datalogger.label, DataCompact.measured_at, DataCompact.value).join(
+            Datalogger, Datalogger.id == DataCompact.datalogger_id
+        ).where(tuple_(DataCompact.datalogger_id, DataCompact.measured_at).in_(id_keys))
+        return {(label, from_epoch_ms(measured_at), value) for label, measured_at, value in await db.execute(query)}
+
+    async def latest(self, db: AsyncSession) -> Dict[str, datetime]:
+        """Return the latest ``data_compact`` measured_at per datalogger label."""
+        query = self._where(select(Datalogger.label, func.max(DataCompact.measured_at)), None, None, None)
+        result = await db.execute(query.group_by(Datalogger.label))
+        return {label: from_epoch_ms(measured_at) for label, measured_at in result if measured_at is not None}
+
+    async def aggregate(self, db: AsyncSession, label: Optional[str], span: str, low: Optional[datetime],
+                        high: Optional[datetime]) -> List[Aggregate]:
+        """Aggregate the ``data_compact`` rows per integer bucket, then format (and merge) the buckets."""
+        width = BUCKET_MS[span]
+        # Integer division: hour / day numbers since the epoch, no timestamp parsing or formatting per row
+        number = DataCompact.measured_at // width
+        query = self._where(select(
+            Datalogger.label, number, func.count(), func.sum(DataCompact.value),
+            func.min(DataCompact.value), func.max(DataCompact.value)
+        ), label, low, high).group_by(number, Datalogger.label)
+        buckets: Dict[Tuple[str, str], List] = {}
+        bucket_format = BUCKET_FORMATS[span]
+        for row_label, bucket_number, count, total, minimum, maximum in await db.execute(query):
+            key = (from_epoch_ms(bucket_number * width).strftime(bucket_format), row_label)
+            current = buckets.get(key)
+            if current is None:
+                buckets[key] = [count, total, minimum, maximum]
+            else:
+                # Days merged into their month
+                current[0] += count
+                current[1] += total
+                current[2] = min(current[2], minimum)
+                current[3] = max(current[3], maximum)
+        return [(row_label, bucket, *values) for (bucket, row_label), values in sorted(buckets.items())]
+
+    async def has_data(self, db: AsyncSession) -> bool:
+        """Whether ``data_compact`` holds a row."""
+        return (await db.execute(select(DataCompact.datalogger_id).limit(1))).first() is not None
+
+    async def delete_all(self, db: AsyncSession):
+        """Delete every ``data_compact`` row (the datalogger labels are kept)."""
+        await db.execute(delete(DataCompact))
+
+
+class WideLayout(StorageLayout):
+    """``data_wide`` rows of one reading: station, timestamp and a column per metric (label).
+
+    Ingestion writes a third of the rows of the narrow layouts and a single-metric range reads one row
+    per reading. The metrics of a timestamp can come in separate chunks, so every write merges into the
+    existing row: a metric already stored is kept (plain and "ignore" writes) or replaced ("update").
+    Labels other than the metric columns are rejected on write and have no data on read.
+    """
+
+    name = WIDE_LAYOUT
+
+    @staticmethod
+    def _column(label: str) -> Column[Optional[float]]:
+        return DataWide.__table__.c[label]
+
+    async def write(self, db: AsyncSession, rows: List[Row], on_conflict: Optional[str]) -> Sequence[Row]:
+        """Merge the rows into one ``data_wide`` row per timestamp, rejecting labels without a metric column."""
+        unknown = {label for label, _, _ in rows} - set(WIDE_METRICS)
+        if unknown:
+            raise ValueError(f"The '{WIDE_LAYOUT}' storage layout only stores {list(WIDE_METRICS)}. "
+                             f"Received {sorted(unknown)}.")
+        # Metric values of each timestamp of the chunk
+        readings: Dict[datetime, Dict[str, Optional[float]]] = {}
+        for label, measured_at, value in rows:
+            reading = readings.get(measured_at)
+            if reading is None:
+                reading = readings[measured_at] = dict.fromkeys(WIDE_METRICS)
+            if on_conflict == "update" or reading[label] is None:
+                reading[label] = value
+
+        inserted = rows
+        if on_conflict != "update":
+            # Metrics already stored are kept, so they are not new rows for the rollups. Within the chunk the
+            # first value of a key is the one written
+            existing = await self.fetch_existing(db, [(label, measured_at) for label, measured_at, _ in rows])
+            stored = {(label, measured_at) for label, measured_at, _ in existing}
+            new_rows: Dict[Tuple[str, datetime], Row] = {}
+            for label, measured_at, value in rows:
+                if (label, measured_at) not in stored:
+                    new_rows.setdefault((label, measured_at), (label, measured_at, value))
+            inserted = list(new_rows.values())
+
+        statement = dialect_insert(db)(DataWide.__table__)
+        if on_conflict == "update":
+            merged = {label: func.coalesce(statement.excluded[label], self._column(label)) for label in WIDE_METRICS}
+        else:
+            merged = {label: func.coalesce(self._column(label), statement.excluded[label]) for label in WIDE_METRICS}
+        statement = statement.on_conflict_do_update(index_elements=["station", "measured_at"], set_=merged)
+        await db.execute(statement, [{"station": WIDE_STATION, "measured_at": measured_at, **metrics}
+                                     for measured_at, metrics in readings.items()])
+        return inserted
+
+    @staticmethod
+    def _where(query, low: Optional[datetime], high: Optional[datetime]):
+        query = query.where(DataWide.station == WIDE_STATION)
+        if low is not None:
+            query = query.where(DataWide.measured_at >= low)
+        if high is not None:
+            query = query.where(DataWide.measured_at < high)
+        return query
+
+    @staticmethod
+    def _labels(label: Optional[str]) -> Tuple[str, ...]:
+        if label is None:
+            return WIDE_METRICS
+        return (label,) if label in WIDE_METRICS else ()
+
+    def _range_queries(self, label: Optional[str], low: Optional[datetime],
+                       high: Optional[datetime]) -> List[Select]:
+        # One query per metric, the label being a constant of its rows
+        queries = []
+        for metric in self._labels(label):
+            column = self._column(metric)
+            query = self._where(select(literal(metric).label("label"), DataWide.measured_at, column.label("value")),
+                                low, high)
+            queries.append(query.where(column.isnot(None)).order_by(DataWide.measured_at))
+        return queries
+
+    async def fetch_existing(self, db: AsyncSession, keys: List[Tuple[str, datetime]]) -> Set[Row]:
+        """Read the stored metric values of the keys from their ``data_wide`` rows."""
+        timestamps = list({measured_at for label, measured_at in keys if label in WIDE_METRICS})
+        readings: Dict[datetime, Dict[str, Optional[float]]] = {}
+        for start in range(0, len(timestamps), WIDE_LOOKUP_CHUNK_SIZE):
+            query: Select = self._where(select(DataWide.measured_at, *map(self._column, WIDE_METRICS)), None, None)
+            query = query.where(DataWide.measured_at.in_(timestamps[start:start + WIDE_LOOKUP_CHUNK_SIZE]))
+            for measured_at, *values in await db.execute(query):
+                readings[measured_at] = dict(zip(WIDE_METRICS, values))
+        existing: Set[Row] = set()
+        for label, measured_at in keys:
+            value = readings.get(measured_at, {}).get(label)
+            if value is not None:
+                existing.add((label, measured_at, value))
+        return existing
+
+    async def latest(self, db: AsyncSession) -> Dict[str, datetime]:
+        """Return the latest measured_at of each metric column holding a value."""
+        query = self._where(select(*(
+            func.max(case((self._column(metric).isnot(None), DataWide.measured_at))) for metric in WIDE_METRICS
+        )), None, None)
+        latest = (await db.execute(query)).one()
+        return {metric: measured_at for metric, measured_at in zip(WIDE_METRICS, latest) if measured_at is not None}
+
+    async def aggregate(self, db: AsyncSession, label: Optional[str], span: str, low: Optional[datetime],
+                        high: Optional[datetime]) -> List[Aggregate]:
+        """Aggregate every requested metric column of the ``data_wide`` rows in a single query grouped by bucket."""
+        metrics = self._labels(label)
+        if not metrics:
+            return []
+        bucket = time_bucket(span, DataWide.measured_at)
+        columns = []
+        for metric in metrics:
+            column = self._column(metric)
+            columns += [func.count(column), func.sum(column), func.min(column), func.max(column)]
+        query = self._where(select(bucket, *columns), low, high).group_by(bucket).order_by(bucket)
+        aggregates = []
+        for row in await db.execute(query):
+            for index, metric in enumerate(metrics):
+                count, total, minimum, maximum = row[1 + 4 * index:5 + 4 * index]
+                # A bucket where this metric was never measured
+                if count:
+                    aggregates.append((metric, row[0], count, total, minimum, maximum))
+        return aggregates
+
+    async def has_data(self, db: AsyncSession) -> bool:
+        """Whether ``data_wide`` holds a row."""
+        return (await db.execute(select(DataWide.station).limit(1))).first() is not None
+
+    async def delete_all(self, db: AsyncSession):
+        """Delete every ``data_wide`` row."""
+        await db.execute(delete(DataWide))
+
+
+LAYOUTS: Dict[str, StorageLayout] = {
+    layout.name: layout for layout in (RowLayout(), CompactLayout(), WideLayout())
+}
+STORAGE_LAYOUTS = tuple(LAYOUTS)
+
+
+# Function to get the storage layout selected by STORAGE_LAYOUT
+def get_layout() -> StorageLayout:
+    layout = LAYOUTS.get(settings.STORAGE_LAYOUT)
+    if layout is None:
+        raise ValueError(f"Invalid STORAGE_LAYOUT value. Must be one of {list(STORAGE_LAYOUTS)}. "
+                         f"Received '{settings.STORAGE_LAYOUT}'.")
+    return layout
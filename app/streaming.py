@@ -0,0 +1,285 @@
+"""Incremental parsing of the datalogger measurements feed, as its bytes arrive."""
+import codecs
+import json
+import re
+from typing import Any, List, Optional, Tuple
+
+# Whitespace allowed between JSON tokens
+WHITESPACE = " \t\n\r"
+
+# A plain (escape-free) object key followed by its colon, the common case of the feed
+_PLAIN_KEY = re.compile(r'[ \t\n\r]*"([^"\\]*)"[ \t\n\r]*:[ \t\n\r]*')
+# Separator following an object member
+_MEMBER_END = re.compile(r'[ \t\n\r]*([,}])')
+# Characters changing the nesting of a skipped value, outside and inside its strings
+_SKIP_STRUCTURE = re.compile(r'["\[\]{}]')
+_SKIP_STRING = re.compile(r'["\\]')
+# Closing bracket of each opening one
+_CLOSERS = {"{": "}", "[": "]"}
+
+# Parser states
+_START = "start"
+_ROOT_KEY = "root_key"
+_ROOT_VALUE = "root_value"
+_ROOT_SKIP = "root_skip"
+_ARRAY_ITEM = "array_item"
+_ARRAY_NEXT = "array_next"
+_OBJECT_KEY = "object_key"
+_OBJECT_VALUE = "object_value"
+_OBJECT_NEXT = "object_next"
+_DONE = "done"
+
+
+class MeasurementStreamParser:
+    """Incremental parser for the datalogger measurements feed.
+
+    The feed is a JSON array of ``{timestamp: {label: value}}`` objects (a single such object is
+    accepted too). Bytes are pushed with :meth:`feed` as they arrive and every complete
+    ``(timestamp, values)`` pair is returned as soon as it has been read, so only the pair being
+    parsed is held in memory rather than the whole document. Array entries that are not objects
+    are returned as ``(None, entry)`` so callers can count them as rejected.
+
+    When ``root_key`` is given, the document is expected to be an object and the measurements are
+    read from that key (e.g. ``"measurements"`` for json-server's ``db.json``).
+    """
+
+    def __init__(self, root_key: Optional[str] = None):
+        """Parse a document whose measurements are at its root, or under ``root_key`` of a root object."""
+        self.root_key = root_key
+        self._decoder = json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._pos = 0
+        self._state = _START
+        self._in_array = False
+        self._key: Optional[str] = None
+        # Closing brackets still expected by the unrelated top-level value being skipped, and whether the scan is
+        # inside one of its strings
+        self._skip_closers: List[str] = []
+        self._skip_in_string = False
+
+    @property
+    def done(self) -> bool:
+        """Whether the whole measurements array (or object) has been read."""
+        return self._state == _DONE
+
+    def feed(self, chunk: bytes) -> List[Tuple[Optional[str], Any]]:
+        """Push the next bytes of the document and return the pairs they complete."""
+        self._buffer = self._buffer[self._pos:] + self._text_decoder.decode(chunk)
+        self._pos = 0
+        return self._parse(final=False)
+
+    def close(self) -> List[Tuple[Optional[str], Any]]:
+        """Return the pairs left at the end of the document, raising ValueError if it is truncated."""
+        self._buffer = self._buffer[self._pos:] + self._text_decoder.decode(b"", final=True)
+        self._pos = 0
+        pairs = self._parse(final=True)
+        if self._state != _DONE:
+            raise ValueError("Unexpected end of the measurements document.")
+        return pairs
+
+    def _skip_whitespace(self) -> Optional[str]:
+        buffer = self._buffer
+        pos = self._pos
+        while pos < len(buffer) and buffer[pos] in WHITESPACE:
+            pos += 1
+        self._pos = pos
+        return buffer[pos] if pos < len(buffer) else None
+
+    def _decode_value(self, final: bool) -> Tuple[bool, Any]:
+        try:
+            value, end = self._decoder.raw_decode(self._buffer, self._pos)
+        except json.JSONDecodeError:
+            if final:
+                raise ValueError(f"Invalid JSON value at offset {self._pos} of the measurements document.")
+            return False, None
+        # A scalar ending exactly at the end of the buffer may be truncated (e.g. "12" of "123")
+        if end == len(self._buffer) and not final:
+            return False, None
+        self._pos = end
+        return True, value
+
+    def _expect(self, char: str, expected: str):
+        if char not in expected:
+            raise ValueError(
+                f"Unexpected character {char!r} at offset {self._pos} of the measurements document, "
+                f"expected one of {expected!r}."
+            )
+        self._pos += 1
+
+    # Scans the unrelated top-level value being skipped up to the end of the buffer, each character once whatever the
+    # number of chunks it spans: the consumed text is dropped at the next feed instead of being decoded again.
+    # Returns whether the value has ended
+    def _skip_value(self) -> bool:
+        buffer = self._buffer
+        pos = self._pos
+        closers = self._skip_closers
+        while True:
+            if self._skip_in_string:
+                match = _SKIP_STRING.search(buffer, pos)
+                if match is None:
+                    pos = len(buffer)
+                    break
+                if match.group() == "\\":
+                    # An escape cut by the end of the buffer is scanned again with the next chunk
+                    if match.end() == len(buffer):
+                        pos = match.start()
+                        break
+                    pos = match.end() + 1
+                    continue
+                self._skip_in_string = False
+                pos = match.end()
+            else:
+                match = _SKIP_STRUCTURE.search(buffer, pos)
+                if match is None:
+                    pos = len(buffer)
+                    break
+                char = match.group()
+                pos = match.end()
+                if char == '"':
+                    self._skip_in_string = True
+                    continue
+                if char in _CLOSERS:
+                    closers.append(_CLOSERS[char])
+                    continue
+                if not closers or closers.pop() != char:
+                    raise ValueError(f"Unexpected character {char!r} at offset {match.start()} of the measurements "
+                                     f"document.")
+            if not closers:
+                self._pos = pos
+                return True
+        self._pos = pos
+        return False
+
+    def _read_members(self, pairs: List[Tuple[Optional[str], Any]]) -> bool:
+        # Fast path reading consecutive `"key": value,` members in one go; anything unusual (escaped
+        # keys, a member cut by the end of the buffer) is left to the generic states
+        buffer = self._buffer
+        raw_decode = self._decoder.raw_decode
+        pos = self._pos
+        while True:
+            key_match = _PLAIN_KEY.match(buffer, pos)
+            if key_match is None:
+                break
+            try:
+                values, end = raw_decode(buffer, key_match.end())
+            except json.JSONDecodeError:
+                break
+            end_match = _MEMBER_END.match(buffer, end)
+            if end_match is None:
+                break
+            pairs.append((key_match.group(1), values))
+            pos = end_match.end()
+            if end_match.group(1) == "}":
+                self._state = _ARRAY_NEXT if self._in_array else _DONE
+                break
+        consumed = pos != self._pos
+        self._pos = pos
+        return consumed
+
+    def _parse(self, final: bool) -> List[Tuple[Optional[str], Any]]:
+        pairs: List[Tuple[Optional[str], Any]] = []
+        while self._state != _DONE:
+            char = self._skip_whitespace()
+            if char is None:
+                break
+
+            if self._state == _START:
+                if self.root_key is not None:
+                    self._expect(char, "{")
+                    self._state = _ROOT_KEY
+                elif char == "[":
+                    self._pos += 1
+                    self._in_array = True
+                    self._state = _ARRAY_ITEM
+                else:
+                    self._expect(char, "{")
+                    self._state = _OBJECT_KEY
+
+            elif self._state == _ROOT_KEY:
+                if char == "}":
+                    raise ValueError(f"Key '{self.root_key}' not found in the measurements document.")
+                if char == ",":
+                    self._pos += 1
+                    continue
+                complete, key = self._decode_value(final)
+                if not complete:
+                    break
+                self._key = key
+                self._state = _ROOT_VALUE
+
+            elif self._state == _ROOT_VALUE:
+                if char == ":":
+                    self._pos += 1
+                    continue
+                if self._key == self.root_key:
+                    self._expect(char, "[{")
+                    self._in_array = char == "["
+                    self._state = _ARRAY_ITEM if self._in_array else _OBJECT_KEY
+                elif char in _CLOSERS or char == '"':
+                    # Unrelated top-level objects, arrays and strings are scanned and dropped as they arrive
+                    self._pos += 1
+                    self._skip_closers = [_CLOSERS[char]] if char in _CLOSERS else []
+                    self._skip_in_string = char == '"'
+                    self._state = _ROOT_SKIP
+                else:
+                    complete, _ = self._decode_value(final)
+                    if not complete:
+                        break
+                    self._state = _ROOT_KEY
+
+            elif self._state == _ROOT_SKIP:
+                if not self._skip_value():
+                    break
+                self._state = _ROOT_KEY
+
+            elif self._state == _ARRAY_ITEM:
+                if char == "]":
+                    self._pos += 1
+                    self._state = _DONE
+                elif char == "{":
+                    self._pos += 1
+                    self._state = _OBJECT_KEY
+                else:
+                    complete, entry = self._decode_value(final)
+                    if not complete:
+                        break
+                    pairs.append((None, entry))
+                    self._state = _ARRAY_NEXT
+
+            elif self._state == _ARRAY_NEXT:
+                self._expect(char, ",]")
+                self._state = _ARRAY_ITEM if char == "," else _DONE
+
+            elif self._state == _OBJECT_KEY:
+                if char == '"' and self._read_members(pairs):
+                    continue
+                if char == "}":
+                    self._pos += 1
+                    self._state = _ARRAY_NEXT if self._in_array else _DONE
+                    continue
+                complete, key = self._decode_value(final)
+                if not complete:
+                    break
+                if not isinstance(key, str):
+                    raise ValueError(f"Expected an object key at offset {self._pos} of the measurements document.")
+                self._key = key
+                self._state = _OBJECT_VALUE
+
+            elif self._state == _OBJECT_VALUE:
+                if char == ":":
+                    self._pos += 1
+                    continue
+                complete, values = self._decode_value(final)
+                if not complete:
+                    break
+                pairs.append((self._key, values))
+                self._state = _OBJECT_NEXT
+
+            elif self._state == _OBJECT_NEXT:
+                self._expect(char, ",}")
+                if char == ",":
+                    self._state = _OBJECT_KEY
+                else:
+                    self._state = _ARRAY_NEXT if self._in_array else _DONE
+        return pairs
@@ -0,0 +1,61 @@
+"""Hour / day / month buckets of the summaries, compiled to the native SQL of each dialect."""
+from sqlalchemy import String, func, literal, literal_column
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+from sqlalchemy.sql.visitors import InternalTraversal
+
+# Summary spans from the coarsest to the finest, with the format of their buckets (the /api/summary measured_at)
+SPANS = ("month", "day", "hour")
+BUCKET_FORMATS = {"month": "%Y-%m", "day": "%Y-%m-%d", "hour": "%Y-%m-%d %H:00:00"}
+# Length of the bucket strings: the bucket of a coarser span is a prefix of the bucket of a finer one
+BUCKET_LENGTHS = {"month": 7, "day": 10, "hour": 19}
+# PostgreSQL to_char patterns producing the same strings
+POSTGRESQL_FORMATS = {"month": "YYYY-MM", "day": "YYYY-MM-DD", "hour": "YYYY-MM-DD HH24:00:00"}
+
+
+class time_bucket(FunctionElement):
+    """Hour / day / month bucket of a timestamp column, formatted as in ``/api/summary``.
+
+    Compiled per dialect so grouping does not parse and re-format every row: SQLite stores
+    timestamps as ``YYYY-MM-DD HH:MM:SS.ffffff`` text and the bucket is a prefix of it, PostgreSQL
+    truncates with ``date_trunc`` before formatting. Other dialects fall back to ``strftime``.
+    """
+
+    type = String()
+    name = "time_bucket"
+    inherit_cache = True
+    # The span changes the SQL, so it is part of the statement cache key
+    _traverse_internals = FunctionElement._traverse_internals + [("span", InternalTraversal.dp_string)]
+
+    def __init__(self, span: str, column):
+        """Bucket the timestamp column per span ("hour", "day" or "month")."""
+        if span not in BUCKET_FORMATS:
+            raise ValueError(f"Invalid span value. Must be one of {list(BUCKET_FORMATS)}. Received '{span}'.")
+        self.span = span
+        super().__init__(column)
+
+
+@compiles(time_bucket)
+def _compile_time_bucket(element, compiler, **kw):
+    column = list(element.clauses)[0]
+    return compiler.process(func.strftime(BUCKET_FORMATS[element.span], column), **kw)
+
+
+@compiles(time_bucket, "sqlite")
+def _compile_time_bucket_sqlite(element, compiler, **kw):
+    column = list(element.clauses)[0]
+    if element.span == "hour":
+        # "YYYY-MM-DD HH" completed with the constant minutes and seconds
+        return compiler.process(func.substr(column, 1, 13).concat(literal(":00:00")), **kw)
+    return compiler.process(func.substr(column, 1, BUCKET_LENGTHS[element.span]), **kw)
+
+
+@compiles(time_bucket, "postgresql")
+def _compile_time_bucket_postgresql(element, compiler, **kw):
+    column = list(element.clauses)[0]
+    # The span and pattern are inlined rather than bound: SELECT, GROUP BY and ORDER BY each render the expression,
+    # and PostgreSQL only matches them when they are textually identical (not $1 / $3 / $5). Both come from the
+    # constants above, never from the request
+    span = literal_column(f"'{element.span}'")
+    pattern = literal_column(f"'{POSTGRESQL_FORMATS[element.span]}'")
+    return compiler.process(func.to_char(func.date_trunc(span, column), pattern), **kw)
@@ -0,0 +1,125 @@
+"""Insert throughput and /api/data latency with the legacy single-column indexes and with the current schema.
+
+Usage: python -m benchmarks.indexes [--rows N] [--repeats N] [--url DATABASE_URL]
+
+Each variant starts from empty tables (dropped and recreated) in the given database, a temporary
+SQLite file by default. Synthetic minute-resolution rows of three labels are stored through
+``store_rows``, then ``/api/data`` is queried over one-day, one-week and one-month ranges, each range
+in a single page and without the result cache. The variants run alternately ``--repeats`` times;
+each figure is the median of the runs, with their standard deviation and range.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import httpx
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.config import settings
+from app.crud import store_rows
+from app.db import get_session_factory
+from app.main import app
+from app.migrations import run_migrations
+from app.models import Base
+
+LABELS = ("temp", "hum", "precip")
+START = datetime(2021, 1, 1)
+RANGES = {"day": timedelta(days=1), "week": timedelta(days=7), "month": timedelta(days=30)}
+QUERIES = 20
+# Range query of /api/data on the row layout, whose plan is shown for each variant
+RANGE_QUERY = ("SELECT label, measured_at, value FROM data WHERE label = :label AND measured_at >= :low "
+               "AND measured_at < :high ORDER BY label, measured_at")
+
+
+# Function to create the single-column indexes of the first schema (as DDL: Index objects would be attached
+# to the Data table and created by every later create_all)
+def _create_legacy_indexes(conn):
+    for column in ("id", "label", "measured_at", "value"):
+        conn.exec_driver_sql(f"CREATE INDEX ix_data_{column} ON data ({column})")
+
+
+async def run_variant(url: str, legacy: bool, rows: int) -> dict:
+    engine = create_async_engine(url)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_create_legacy_indexes if legacy else run_migrations)
+    session_factory = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+
+    per_label = rows // len(LABELS)
+    data = [(label, START + timedelta(minutes=i), float(i % 1000) / 10) for label in LABELS for i in range(per_label)]
+    async with session_factory() as db:
+        start_time = time.perf_counter()
+        await store_rows(data, db)
+        insert_seconds = time.perf_counter() - start_time
+        plan = None
+        if db.get_bind().dialect.name == "sqlite":
+            result = await db.execute(text(f"EXPLAIN QUERY PLAN {RANGE_QUERY}"),
+                                      {"label": "temp", "low": START, "high": START + RANGES["month"]})
+            plan = "; ".join(row[-1] for row in result)
+
+    app.dependency_overrides[get_session_factory] = lambda: session_factory
+    latencies = {}
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+            for name, length in RANGES.items():
+                samples = []
+                for i in range(QUERIES):
+                    since = START + timedelta(minutes=(i * 7919) % max(per_label - int(length.total_seconds() // 60), 1))
+                    params = {"datalogger": LABELS[i % len(LABELS)], "since": since.isoformat(),
+                              "before": (since + length).isoformat()}
+                    start_time = time.perf_counter()
+                    response = await client.get("/api/data", params=params)
+                    samples.append(time.perf_counter() - start_time)
+                    response.raise_for_status()
+                latencies[name] = statistics.median(samples)
+    finally:
+        app.dependency_overrides.pop(get_session_factory, None)
+        await engine.dispose()
+    return {"rows_per_second": len(data) / insert_seconds, "latencies": latencies, "plan": plan}
+
+
+# Function to format the median of samples with their standard deviation and range
+def spread(samples, scale: float = 1.0, unit: str = "") -> str:
+    values = [sample * scale for sample in samples]
+    deviation = statistics.stdev(values) if len(values) > 1 else 0.0
+    return (f"{statistics.median(values):,.0f}{unit} ± {deviation:,.0f} "
+            f"[{min(values):,.0f}-{max(values):,.0f}]")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=300_000)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--url", default=None, help="database URL, a temporary SQLite file by default")
+    args = parser.parse_args()
+    # Whole ranges in one response, and every query hitting the database
+    settings.DATA_MAX_PAGE_SIZE = args.rows
+    settings.RESULT_CACHE_MAX_ENTRIES = 0
+
+    with tempfile.TemporaryDirectory() as directory:
+        url = args.url or f"sqlite+aiosqlite:///{os.path.join(directory, 'bench.db')}"
+        results = {"before": [], "after": []}
+        # Alternated, so that a drift of the machine weighs on both variants
+        for _ in range(args.repeats):
+            for name, legacy in (("before", True), ("after", False)):
+                results[name].append(await run_variant(url, legacy, args.rows))
+
+    print(f"{'':8}{'insert rows/s':>28}" + "".join(f"{'/api/data ' + name:>28}" for name in RANGES))
+    for name, runs in results.items():
+        print(f"{name:8}{spread([run['rows_per_second'] for run in runs]):>28}"
+              + "".join(f"{spread([run['latencies'][range_name] for run in runs], 1000, ' ms'):>28}"
+                        for range_name in RANGES))
+    for name, runs in results.items():
+        if runs[0]["plan"]:
+            print(f"{name} plan: {runs[0]['plan']}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,107 @@
+"""Size, insert throughput and read cost of the measurement storage layouts.
+
+Usage: python -m benchmarks.layouts [--readings N] [--url DATABASE_URL]
+
+Each layout starts from empty tables (dropped and recreated) in the given database, a temporary
+SQLite file by default. Synthetic 15-minute readings of temp, hum and precip are stored through
+``store_rows`` as the ingestion does, then a one-month ``get_data`` range and a raw (rollup-less)
+daily summary of a label are timed.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from app import crud
+from app.config import settings
+from app.migrations import run_migrations
+from app.models import Base
+from app.storage import STORAGE_LAYOUTS
+
+LABELS = ("temp", "hum", "precip")
+START = datetime(2021, 1, 1)
+# Tables and indexes holding the measurements of each layout
+RELATIONS = {
+    "row": ("data", "uq_data_label_measured_at"),
+    "compact": ("data_compact", "datalogger", "sqlite_autoindex_datalogger_1"),
+    "wide": ("data_wide",),
+}
+REPEATS = 5
+
+
+async def relation_bytes(db: AsyncSession, layout: str) -> int:
+    if db.get_bind().dialect.name == "postgresql":
+        tables = [name for name in RELATIONS[layout] if not name.startswith(("uq_", "sqlite_"))]
+        query = " + ".join(f"pg_total_relation_size('{name}')" for name in tables)
+        return (await db.execute(text(f"SELECT {query}"))).scalar()
+    names = ", ".join(f"'{name}'" for name in RELATIONS[layout])
+    return (await db.execute(text(f"SELECT sum(pgsize) FROM dbstat WHERE name IN ({names})"))).scalar() or 0
+
+
+async def timed(call, repeats: int = REPEATS) -> float:
+    samples = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        await call()
+        samples.append(time.perf_counter() - start_time)
+    return statistics.median(samples)
+
+
+async def run_layout(url: str, layout: str, readings: int) -> dict:
+    settings.STORAGE_LAYOUT = layout
+    engine = create_async_engine(url)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(run_migrations)
+    session_factory = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+
+    rows = [(label, START + timedelta(minutes=15 * i), float(i % 1000) / 10)
+            for i in range(readings) for label in LABELS]
+
+    async def no_rollups(*args):
+        return False
+
+    try:
+        async with session_factory() as db:
+            start_time = time.perf_counter()
+            await crud.store_rows(rows, db, on_conflict="ignore")
+            insert_seconds = time.perf_counter() - start_time
+            size = await relation_bytes(db, layout)
+            month = (START + timedelta(days=30)).isoformat(), (START + timedelta(days=60)).isoformat()
+            scan = await timed(lambda: crud.get_data(db, "temp", *month))
+            with patch("app.crud.has_rollups", no_rollups):
+                summary = await timed(lambda: crud.get_aggregated_data(db, "temp", "day"))
+    finally:
+        await engine.dispose()
+    return {"bytes": size, "rows_per_second": len(rows) / insert_seconds, "scan": scan, "summary": summary}
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--readings", type=int, default=70_000, help="readings per label")
+    parser.add_argument("--url", default=None, help="database URL, a temporary SQLite file by default")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for layout in STORAGE_LAYOUTS:
+            url = args.url or f"sqlite+aiosqlite:///{os.path.join(directory, f'{layout}.db')}"
+            results[layout] = await run_layout(url, layout, args.readings)
+
+    print(f"{'layout':10}{'table+index':>14}{'insert rows/s':>15}{'get_data month':>16}{'raw day summary':>17}")
+    for layout, result in results.items():
+        print(f"{layout:10}{result['bytes'] / 1e6:>12.1f}MB{result['rows_per_second']:>15,.0f}"
+              f"{result['scan'] * 1000:>14.1f}ms{result['summary'] * 1000:>15.1f}ms")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
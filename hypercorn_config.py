@@ -3,4 +3,3 @@ workers = 1
 worker_class = "asyncio"
 loglevel = "error"
 timeout = 120
-startup_timeout = 1800
@@ -3,7 +3,8 @@ import asyncio
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import delete, select, func
-from app.models import Base, Data
+from app.cache import data_versions, result_cache
+from app.models import Base, Data, DataCompact, DataRollup, DataWide, IngestionWatermark
 from app.schemas import DataCreate
 from datetime import datetime
 
@@ -44,7 +45,13 @@ async def async_session(async_session_factory):
 @pytest.fixture(scope="function", autouse=True)
 async def cleanup_db(async_session: AsyncSession):
     await async_session.execute(delete(Data))
+    await async_session.execute(delete(DataCompact))
+    await async_session.execute(delete(DataWide))
+    await async_session.execute(delete(IngestionWatermark))
+    await async_session.execute(delete(DataRollup))
     await async_session.commit()
+    result_cache.reset()
+    data_versions.reset()
     # Ajoutez un log pour confirmer le nettoyage de la base de données
     count_result = await async_session.execute(select(func.count(Data.id)))
     count = count_result.scalar()
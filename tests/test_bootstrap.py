@@ -0,0 +1,65 @@
+import pytest
+import httpx
+from unittest.mock import patch
+from app.bootstrap import Bootstrap, wait_for_json_server, DONE, FAILED_STAGE, INGESTING
+from app.fetch import FeedClient
+from app.main import app
+
+@pytest.mark.asyncio
+async def test_wait_for_json_server_polls_until_ready():
+    probes = []
+
+    def handler(request):
+        probes.append(request.method)
+        if len(probes) < 3:
+            raise httpx.ConnectError("Connection refused")
+        return httpx.Response(200)
+
+    client = FeedClient(transport=httpx.MockTransport(handler))
+    with patch("app.bootstrap.feed_client", client):
+        await wait_for_json_server("http://json-server/measurements", timeout=5, interval=0)
+    assert probes == ["HEAD", "HEAD", "HEAD"]
+
+@pytest.mark.asyncio
+async def test_wait_for_json_server_times_out():
+    client = FeedClient(transport=httpx.MockTransport(lambda request: httpx.Response(503)))
+    with patch("app.bootstrap.feed_client", client):
+        with pytest.raises(TimeoutError):
+            await wait_for_json_server("http://json-server/measurements", timeout=0, interval=0)
+
+@pytest.mark.asyncio
+async def test_bootstrap_retries_failed_attempts(monkeypatch):
+    monkeypatch.setattr("app.bootstrap.settings.FETCH_BACKOFF", 0)
+    monkeypatch.setattr("app.bootstrap.settings.BOOTSTRAP_RETRIES", 1)
+    bootstrap = Bootstrap()
+    attempts = []
+
+    async def run():
+        attempts.append(len(attempts))
+        bootstrap.stage = INGESTING
+        if len(attempts) == 1:
+            raise RuntimeError("json-server not reachable")
+
+    with patch.object(bootstrap, "_run", run):
+        bootstrap.start()
+        await bootstrap._task
+    assert (bootstrap.stage, bootstrap.attempts, bootstrap.error) == (DONE, 2, None)
+
+    failing = Bootstrap()
+    with patch.object(failing, "_run", side_effect=RuntimeError("boom")):
+        failing.start()
+        await failing._task
+    assert failing.stage == FAILED_STAGE
+    assert failing.attempts == 2
+
+@pytest.mark.asyncio
+async def test_health_endpoints():
+    async with httpx.AsyncClient(app=app, base_url="http://testserver") as ac:
+        response = await ac.get("/health/live")
+        assert response.status_code == 200
+        assert response.json() == {"status": "alive"}
+
+        response = await ac.get("/health/ready")
+        assert response.status_code == 200
+        assert response.json()["status"] == "ready"
+        assert "stage" in response.json()["bootstrap"]
@@ -0,0 +1,107 @@
+import asyncio
+import pytest
+from datetime import datetime
+from app.cache import CacheEntry, ResultCache
+from app.config import settings
+
+DAY = datetime(2022, 12, 1)
+
+def entry(body: bytes = b"{}", label: str = "temp", low=None, high=None) -> CacheEntry:
+    return CacheEntry(body, "application/json", label, low, high)
+
+async def load(cache: ResultCache, key, value: CacheEntry) -> CacheEntry:
+    async def loader():
+        return value
+    return await cache.get_or_load(key, loader)
+
+@pytest.mark.asyncio
+async def test_lru_and_size_limits(monkeypatch):
+    monkeypatch.setattr(settings, "RESULT_CACHE_MAX_ENTRIES", 2)
+    monkeypatch.setattr(settings, "RESULT_CACHE_MAX_BYTES", 10)
+    cache = ResultCache()
+    await load(cache, "a", entry(b"aaaa"))
+    await load(cache, "b", entry(b"bbbb"))
+    assert cache.lookup("a") is not None
+    # "b" is the least recently used entry
+    await load(cache, "c", entry(b"cccc"))
+    assert cache.lookup("b") is None
+    await load(cache, "d", entry(b"dddddddd"))
+    assert [key for key in ("a", "c", "d") if cache.lookup(key)] == ["d"]
+    # Bodies larger than the whole cache are not kept
+    await load(cache, "e", entry(b"e" * 11))
+    assert cache.lookup("e") is None
+    assert cache.describe() == {"hits": 2, "misses": 5, "coalesced": 0, "evictions": 3, "expirations": 0,
+                                "invalidations": 0, "entries": 1, "bytes": 8}
+
+@pytest.mark.asyncio
+async def test_ttl(monkeypatch):
+    monkeypatch.setattr(settings, "RESULT_CACHE_TTL", 0.0)
+    cache = ResultCache()
+    await load(cache, "a", entry())
+    assert cache.lookup("a") is None
+    assert cache.stats.expirations == 1
+
+@pytest.mark.asyncio
+async def test_invalidation_by_overlap():
+    cache = ResultCache()
+    await load(cache, "all", entry())
+    await load(cache, "december", entry(low=DAY, high=datetime(2023, 1, 1)))
+    await load(cache, "november", entry(high=DAY))
+    await load(cache, "hum", entry(label="hum"))
+    cache.invalidate([("temp", datetime(2022, 12, 5), 1.0), ("temp", datetime(2022, 12, 2), 2.0)])
+    assert [key for key in ("all", "december", "november", "hum") if cache.lookup(key)] == ["november", "hum"]
+    # The upper bound is exclusive
+    cache.invalidate([("temp", DAY, 1.0)])
+    assert cache.lookup("november") is not None
+    assert cache.stats.invalidations == 2
+
+@pytest.mark.asyncio
+async def test_single_flight():
+    cache = ResultCache()
+    calls = []
+    release = asyncio.Event()
+
+    async def loader():
+        calls.append(1)
+        await release.wait()
+        return entry()
+
+    tasks = [asyncio.create_task(cache.get_or_load("a", loader)) for _ in range(5)]
+    await asyncio.sleep(0)
+    release.set()
+    results = await asyncio.gather(*tasks)
+    assert len(calls) == 1 and all(result is results[0] for result in results)
+    assert (cache.stats.misses, cache.stats.coalesced) == (1, 4)
+
+@pytest.mark.asyncio
+async def test_result_computed_during_a_write_is_not_cached():
+    cache = ResultCache()
+
+    async def loader():
+        cache.invalidate([("hum", DAY, 1.0)])
+        return entry()
+
+    await cache.get_or_load("a", loader)
+    assert cache.lookup("a") is None
+
+@pytest.mark.asyncio
+async def test_waiters_reload_after_a_write():
+    cache = ResultCache()
+    calls = []
+    release = asyncio.Event()
+
+    async def loader():
+        calls.append(1)
+        if len(calls) == 1:
+            await release.wait()
+        return entry(str(len(calls)).encode())
+
+    first = asyncio.create_task(cache.get_or_load("a", loader))
+    await asyncio.sleep(0)
+    waiter = asyncio.create_task(cache.get_or_load("a", loader))
+    await asyncio.sleep(0)
+    # The first result may predate the write: the waiter loads its own
+    cache.invalidate([("temp", DAY, 1.0)])
+    release.set()
+    assert ((await first).body, (await waiter).body) == (b"1", b"2")
+    assert cache.lookup("a").body == b"2"
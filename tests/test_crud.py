@@ -1,9 +1,13 @@
+import httpx
 import pytest
 from sqlalchemy.future import select
 from sqlalchemy.ext.asyncio import AsyncSession
+from app.fetch import feed_client
 from app.models import Data
-from app.crud import store_data_in_db, check_duplicate_data, get_data, get_aggregated_data, get_daily_aggregates, \
-    get_hourly_aggregates, get_aggregated_data_by_label_and_day, get_aggregated_data_by_label_and_hour, delete_all_data
+from app.sources import file_source
+from app.schemas import DataCreate
+from app.crud import store_data_in_db, store_rows, check_duplicate_data, get_watermarks, update_watermarks, get_data, get_aggregated_data, get_daily_aggregates, \
+    get_hourly_aggregates, get_aggregated_data_by_label_and_day, get_aggregated_data_by_label_and_hour, delete_all_data, query_range
 import logging
 import datetime
 
@@ -17,6 +21,63 @@ async def test_store_data_in_db(async_session: AsyncSession, sample_data):
     records = result.scalars().all()
     assert len(records) == len(sample_data)
 
+@pytest.mark.asyncio
+async def test_store_data_in_db_in_chunks(async_session: AsyncSession, sample_data):
+    # A generator is consumed chunk by chunk, the last chunk being partial
+    stored = await store_data_in_db((record for record in sample_data), async_session, chunk_size=2)
+    assert stored == len(sample_data)
+    result = await async_session.execute(select(Data))
+    records = result.scalars().all()
+    assert len(records) == len(sample_data)
+
+@pytest.mark.asyncio
+async def test_store_rows(async_session: AsyncSession):
+    rows = [
+        ("temp", datetime.datetime(2022, 12, 31, 1, 0, 0), 35.0),
+        ("temp", datetime.datetime(2022, 12, 31, 1, 0, 0), 36.0),
+        ("hum", datetime.datetime(2022, 12, 31, 1, 0, 0), 70.0),
+    ]
+    # The duplicated key is collapsed (last one wins) before the upsert, so two rows are written
+    stored = await store_rows(iter(rows), async_session, on_conflict="update")
+    assert stored == 2
+    result = await async_session.execute(select(Data.label, Data.value).order_by(Data.label))
+    assert result.all() == [("hum", 70.0), ("temp", 36.0)]
+
+@pytest.mark.asyncio
+async def test_store_data_in_db_orm_fallback(async_session: AsyncSession, sample_data):
+    stored = await store_data_in_db(sample_data, async_session, use_orm=True)
+    assert stored == len(sample_data)
+    result = await async_session.execute(select(Data))
+    records = result.scalars().all()
+    assert len(records) == len(sample_data)
+
+@pytest.mark.asyncio
+async def test_store_data_in_db_upsert_ignore(async_session: AsyncSession, sample_data):
+    await store_data_in_db(sample_data, async_session, on_conflict="ignore")
+    # Re-ingesting the same snapshot must not create any new row
+    await store_data_in_db(sample_data, async_session, on_conflict="ignore")
+    result = await async_session.execute(select(Data))
+    records = result.scalars().all()
+    assert len(records) == len(sample_data)
+
+@pytest.mark.asyncio
+async def test_store_data_in_db_upsert_update(async_session: AsyncSession, sample_data):
+    await store_data_in_db(sample_data, async_session, on_conflict="update")
+    updated = DataCreate(label="temp", measured_at=datetime.datetime(2022, 12, 31, 1, 0, 0), value=99.0)
+    await store_data_in_db([updated], async_session, on_conflict="update")
+
+    result = await async_session.execute(
+        select(Data).where(Data.label == "temp", Data.measured_at == updated.measured_at)
+    )
+    records = result.scalars().all()
+    assert len(records) == 1
+    assert records[0].value == 99.0
+
+@pytest.mark.asyncio
+async def test_store_data_in_db_invalid_on_conflict(async_session: AsyncSession, sample_data):
+    with pytest.raises(ValueError):
+        await store_data_in_db(sample_data, async_session, on_conflict="replace")
+
 @pytest.mark.asyncio
 async def test_check_duplicate_data(async_session: AsyncSession, sample_data):
     assert isinstance(async_session, AsyncSession), f"Expected AsyncSession, got {type(async_session)}"
@@ -26,6 +87,30 @@ async def test_check_duplicate_data(async_session: AsyncSession, sample_data):
     duplicates = await check_duplicate_data(sample_data, async_session)
     assert len(duplicates) == len(sample_data), "Expected to find duplicates equal to sample data length"
 
+@pytest.mark.asyncio
+async def test_check_duplicate_data_across_chunks(async_session: AsyncSession, sample_data, monkeypatch):
+    monkeypatch.setattr("app.crud.DEDUP_CHUNK_SIZE", 2)
+    await store_data_in_db(sample_data[:3], async_session)
+
+    duplicates = await check_duplicate_data(sample_data, async_session)
+    assert duplicates == sample_data[:3]
+
+@pytest.mark.asyncio
+async def test_watermarks(async_session: AsyncSession, sample_data):
+    await store_data_in_db(sample_data, async_session)
+    # Without persisted watermarks, they are derived from the stored data
+    watermarks = await get_watermarks(async_session)
+    assert watermarks == {
+        "temp": datetime.datetime(2022, 12, 31, 3, 0, 0),
+        "hum": datetime.datetime(2022, 12, 31, 2, 0, 0),
+    }
+
+    await update_watermarks(async_session, {"temp": datetime.datetime(2023, 1, 1), "hum": datetime.datetime(2023, 1, 1)})
+    # A watermark never moves back
+    await update_watermarks(async_session, {"temp": datetime.datetime(2022, 1, 1)})
+    watermarks = await get_watermarks(async_session)
+    assert watermarks == {"temp": datetime.datetime(2023, 1, 1), "hum": datetime.datetime(2023, 1, 1)}
+
 @pytest.mark.asyncio
 async def test_get_data(async_session: AsyncSession, sample_data):
     assert isinstance(async_session, AsyncSession), f"Expected AsyncSession, got {type(async_session)}"
@@ -129,8 +214,31 @@ async def test_get_aggregated_data_by_label_and_hour(async_session: AsyncSession
 async def test_delete_all_data(async_session: AsyncSession, sample_data):
     assert isinstance(async_session, AsyncSession), f"Expected AsyncSession, got {type(async_session)}"
     await store_data_in_db(sample_data, async_session)
+    feed_url = "http://feed/data"
+    feed_client.remember(httpx.Response(200, headers={"etag": '"v1"'}, request=httpx.Request("GET", feed_url)))
+    fingerprint = ("db.json", 1, 1)
+    file_source.remember(fingerprint)
 
     await delete_all_data(async_session)
     result = await async_session.execute(select(Data))
     records = result.scalars().all()
     assert len(records) == 0, "Expected all records to be deleted"
+    # The next ingestion reads the feed again instead of skipping it as unchanged
+    assert feed_client._conditional_headers(feed_url) == {}
+    assert not file_source.unchanged(fingerprint)
+
+@pytest.mark.parametrize("since, expected", [
+    ("2023-07-25", datetime.datetime(2023, 7, 25)),
+    ("2023-07-25T12:00:00Z", datetime.datetime(2023, 7, 25, 12)),
+    ("2023-07-25T14:00:00.5+0200", datetime.datetime(2023, 7, 25, 12, 0, 0, 500000)),
+    ("2023-07-25 12:00", datetime.datetime(2023, 7, 25, 12)),
+    ("20230725T120000Z", datetime.datetime(2023, 7, 25, 12)),
+])
+def test_query_range_iso_8601(since, expected):
+    # Same bounds whatever the Python version (fromisoformat only accepts these forms from 3.11)
+    assert query_range(since, since) == (expected, expected + datetime.timedelta(microseconds=1))
+
+@pytest.mark.parametrize("since", ["bad", "1690000000", "NaT"])
+def test_query_range_invalid(since):
+    with pytest.raises(ValueError, match="Invalid since value"):
+        query_range(since, None)
@@ -1,13 +1,19 @@
+import asyncio
 import pytest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, AsyncMock, MagicMock
 from sqlalchemy.ext.asyncio import AsyncSession
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
 from fastapi.testclient import TestClient
-from app.api.endpoints.data_ingestion import fetch_data_from_json_server, transform_data, ingest_data
+from app.api.endpoints.data_ingestion import fetch_data_from_json_server, transform_data, ingest_data, \
+    stream_data_from_json_server, transform_measurements, parse_timestamps, run_ingestion, frame_rows
 from app.db import get_db
+from app.fetch import FeedClient
+from app.jobs import IngestionJob, ingestion_jobs
+from app.sources import LocalFileSource
 from app.schemas import DataCreate
 from datetime import datetime
 import httpx
+import json
 
 from app.main import app
 
@@ -25,19 +31,167 @@ def sample_data():
         {"2023-07-25T13:00:00": {"test_label2": 20.5}}
     ]
 
-def test_fetch_data_from_json_server(sample_data):
-    with patch("requests.get") as mock_get:
-        mock_response = MagicMock()
-        mock_response.json.return_value = sample_data
-        mock_response.raise_for_status.return_value = None
-        mock_get.return_value = mock_response
+def feed_transport(body: bytes, chunk_size: int = 7) -> httpx.MockTransport:
+    # Serve the body in small pieces so that measurements are split across chunks
+    def handler(request):
+        chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+        return httpx.Response(200, stream=httpx.ByteStream(b"".join(chunks)), headers={"ETag": 'W/"1"'})
+    return httpx.MockTransport(handler)
 
-        data = fetch_data_from_json_server()
+@pytest.mark.asyncio
+async def test_fetch_data_from_json_server(sample_data):
+    client = FeedClient(transport=feed_transport(json.dumps(sample_data).encode()))
+    with patch("app.api.endpoints.data_ingestion.feed_client", client):
+        data = await fetch_data_from_json_server()
         assert len(data) == 2
         assert data[0].label == "test_label"
         assert data[0].measured_at == datetime(2023, 7, 25, 12, 0, 0)
         assert data[0].value == 10.5
 
+@pytest.mark.asyncio
+async def test_stream_data_from_json_server(sample_data):
+    body = json.dumps(sample_data + ["not a measurement"]).encode()
+    client = FeedClient(transport=feed_transport(body))
+    with patch("app.api.endpoints.data_ingestion.feed_client", client):
+        batches = [frame_rows(frame) async for frame in stream_data_from_json_server(batch_size=1)]
+        assert batches == [
+            [("test_label", datetime(2023, 7, 25, 12, 0, 0), 10.5)],
+            [("test_label2", datetime(2023, 7, 25, 13, 0, 0), 20.5)],
+        ]
+
+@pytest.mark.asyncio
+async def test_stream_data_from_json_server_in_slices(sample_data, monkeypatch):
+    collection = sample_data * 3
+    requested_slices = []
+
+    # Mimic json-server slicing: _start/_end select items and X-Total-Count reports the collection size
+    def handler(request):
+        start, end = int(request.url.params["_start"]), int(request.url.params["_end"])
+        headers = {"X-Total-Count": str(len(collection))}
+        if request.method == "HEAD":
+            return httpx.Response(200, headers=headers)
+        requested_slices.append((start, end))
+        return httpx.Response(200, content=json.dumps(collection[start:end]).encode(), headers=headers)
+
+    monkeypatch.setattr("app.api.endpoints.data_ingestion.settings.FETCH_PAGE_SIZE", 4)
+    monkeypatch.setattr("app.api.endpoints.data_ingestion.settings.FETCH_CONCURRENCY", 2)
+    client = FeedClient(transport=httpx.MockTransport(handler))
+    with patch("app.api.endpoints.data_ingestion.feed_client", client):
+        batches = [batch async for batch in stream_data_from_json_server(batch_size=3)]
+    assert sorted(requested_slices) == [(0, 4), (4, 6)]
+    records = [record for batch in batches for record in frame_rows(batch)]
+    assert len(records) == len(collection)
+    assert sum(label == "test_label2" for label, _, _ in records) == 3
+
+@pytest.mark.asyncio
+async def test_stream_data_from_json_server_slice_error(sample_data, monkeypatch):
+    def handler(request):
+        if request.method == "HEAD":
+            return httpx.Response(200, headers={"X-Total-Count": "2"})
+        if request.url.params["_start"] == "1":
+            return httpx.Response(404)
+        return httpx.Response(200, content=json.dumps(sample_data[:1]).encode())
+
+    monkeypatch.setattr("app.api.endpoints.data_ingestion.settings.FETCH_PAGE_SIZE", 1)
+    monkeypatch.setattr("app.api.endpoints.data_ingestion.settings.FETCH_CONCURRENCY", 2)
+    client = FeedClient(transport=httpx.MockTransport(handler))
+    with patch("app.api.endpoints.data_ingestion.feed_client", client):
+        with pytest.raises(HTTPException):
+            async for _ in stream_data_from_json_server():
+                pass
+
+@pytest.mark.asyncio
+async def test_stream_data_from_json_server_too_few_items_to_slice(sample_data, monkeypatch):
+    requests = []
+
+    def handler(request):
+        if request.method == "HEAD":
+            return httpx.Response(200, headers={"X-Total-Count": str(len(sample_data))})
+        requests.append(dict(request.url.params))
+        return httpx.Response(200, content=json.dumps(sample_data).encode())
+
+    monkeypatch.setattr("app.api.endpoints.data_ingestion.settings.FETCH_PAGE_SIZE", 1)
+    monkeypatch.setattr("app.api.endpoints.data_ingestion.settings.FETCH_CONCURRENCY", 4)
+    client = FeedClient(transport=httpx.MockTransport(handler))
+    with patch("app.api.endpoints.data_ingestion.feed_client", client):
+        batches = [batch async for batch in stream_data_from_json_server()]
+    # Two items for four concurrent downloads: the feed is fetched in a single unsliced request
+    assert requests == [{}]
+    assert sum(len(batch) for batch in batches) == 2
+
+def test_transform_measurements_skips_watermarked_labels():
+    watermarks = {"temp": datetime(2021, 1, 1, 0, 14), "hum": datetime(2021, 1, 1, 0, 14, 39)}
+    # 1609460079000 is 2021-01-01T00:14:39Z: temp is newer than its watermark (and invalid), hum is not
+    frame, ignored = transform_measurements(
+        [("1609460079000", {"temp": "x", "hum": 92.5, "precip": 0.0})], watermarks
+    )
+    assert ignored == 1
+    assert frame.to_dict("records") == [{"label": "precip", "measured_at": "1609460079000", "value": 0.0}]
+
+def test_transform_measurements_typed():
+    frame, ignored = transform_measurements(
+        [("1609460079000", {"temp": -2.3, "hum": "92.5"}), ("bad", {"temp": 1.0}), ("2023-07-25T14:00:00+02:00", {"hum": 80})],
+        typed=True
+    )
+    assert ignored == 1
+    assert frame_rows(frame) == [
+        ("temp", datetime(2021, 1, 1, 0, 14, 39), -2.3),
+        ("hum", datetime(2021, 1, 1, 0, 14, 39), 92.5),
+        ("hum", datetime(2023, 7, 25, 12, 0, 0), 80.0),
+    ]
+
+def test_transform_measurements_coercion_ignores_the_rest_of_the_batch():
+    # float() accepts these spellings, whether the other values of the batch are numeric or not
+    values = {"temp": "1_000", "hum": " 12 ", "precip": True}
+    numeric, _ = transform_measurements([("1609460079000", values)])
+    mixed, ignored = transform_measurements([("1609460079000", {**values, "wind": "x"})])
+    assert ignored == 1
+    assert numeric["value"].tolist() == mixed["value"].tolist() == [1000.0, 12.0, 1.0]
+
+def test_parse_timestamps():
+    parsed = parse_timestamps(["1609460079000", "1609460079", "2023-07-25T12:00:00", "2023-07-25T14:00:00+02:00", "bad"])
+    assert parsed.tolist()[:4] == [
+        datetime(2021, 1, 1, 0, 14, 39),
+        datetime(2021, 1, 1, 0, 14, 39),
+        datetime(2023, 7, 25, 12, 0, 0),
+        datetime(2023, 7, 25, 12, 0, 0),
+    ]
+    assert parsed.isna().tolist() == [False, False, False, False, True]
+
+@pytest.mark.asyncio
+async def test_run_ingestion_is_incremental(async_session: AsyncSession):
+    feed = [{"1609460079000": {"temp": -2.3, "hum": 92.5}}]
+    client = FeedClient(transport=httpx.MockTransport(lambda request: httpx.Response(200, json=feed)))
+    with patch("app.api.endpoints.data_ingestion.feed_client", client):
+        assert await run_ingestion(async_session) == 2
+        feed.append({"1609460980000": {"temp": -2.2, "hum": 92.4}})
+        # Only the measurement newer than the high-water marks is transformed and stored
+        assert await run_ingestion(async_session) == 2
+
+@pytest.mark.asyncio
+async def test_run_ingestion_counts_only_inserted_rows(async_session: AsyncSession):
+    feed = [{"1609460079000": {"temp": -2.3, "hum": 92.5}}]
+    client = FeedClient(transport=httpx.MockTransport(lambda request: httpx.Response(200, json=feed)))
+    with patch("app.api.endpoints.data_ingestion.feed_client", client):
+        assert await run_ingestion(async_session) == 2
+        # Without watermarks the same feed is ingested again: every row is skipped by the unique key
+        progress = IngestionJob()
+        with patch("app.api.endpoints.data_ingestion.get_watermarks", AsyncMock(return_value={})):
+            assert await run_ingestion(async_session, progress) == 0
+        assert progress.transformed == 2
+        assert progress.inserted == 0
+
+@pytest.mark.asyncio
+async def test_run_ingestion_from_local_file(async_session: AsyncSession, tmp_path, monkeypatch):
+    db_json = tmp_path / "db.json"
+    db_json.write_text(json.dumps({"measurements": [{"1609460079000": {"temp": -2.3, "hum": 92.5}}]}))
+    monkeypatch.setattr("app.api.endpoints.data_ingestion.settings.INGEST_SOURCE", "file")
+    source = LocalFileSource(str(db_json), chunk_bytes=16)
+    with patch("app.api.endpoints.data_ingestion.file_source", source):
+        assert await run_ingestion(async_session) == 2
+        # The file is unchanged since its last ingestion: it is not read again
+        assert await run_ingestion(async_session) == 0
+
 def test_transform_data(sample_data):
     transformed_data, ignored_records = transform_data(sample_data)
     assert len(transformed_data) == 2
@@ -46,10 +200,59 @@ def test_transform_data(sample_data):
     assert transformed_data[0]["measured_at"] == "2023-07-25T12:00:00"
     assert transformed_data[0]["value"] == 10.5
 
+def test_transform_data_counts_ignored_records():
+    raw_data = [
+        {"2023-07-25T12:00:00": {"temp": "10.5", "hum": None, "precip": "n/a"}},
+        {"2023-07-25T13:00:00": "not a dict"},
+        42,
+    ]
+    transformed_data, ignored_records = transform_data(raw_data)
+    assert transformed_data == [{"label": "temp", "measured_at": "2023-07-25T12:00:00", "value": 10.5}]
+    assert ignored_records == 4
+
 @pytest.mark.asyncio
 async def test_ingest_data(mock_db, sample_data):
     async with httpx.AsyncClient(app=app, base_url="http://testserver") as ac:
-        with patch("app.api.endpoints.data_ingestion.fetch_data_from_json_server", return_value=[DataCreate(label="test_label", measured_at=datetime(2023, 7, 25, 12, 0, 0), value=10.5)]):
+        started = asyncio.Event()
+        release = asyncio.Event()
+
+        async def fake_ingestion(db, progress=None):
+            progress.fetched, progress.transformed, progress.rejected = 3, 2, 1
+            started.set()
+            await release.wait()
+            progress.inserted = 2
+            return 2
+
+        with patch("app.api.endpoints.data_ingestion.run_ingestion", fake_ingestion):
             response = await ac.post("/ingest/")
+            assert response.status_code == 202
+            job_id = response.json()["job_id"]
+            await started.wait()
+
+            # A second trigger is coalesced into the running job
+            response = await ac.post("/ingest/")
+            assert response.json()["job_id"] == job_id
+            assert response.json()["status"] == "running"
+
+            release.set()
+            await ingestion_jobs.get(job_id).task
+            response = await ac.get(f"/ingest/{job_id}")
             assert response.status_code == 200
-            assert response.json() == {"message": "Data ingested successfully"}
+            status = response.json()
+            assert status["status"] == "succeeded"
+            assert (status["fetched"], status["transformed"], status["rejected"], status["inserted"]) == (3, 2, 1, 2)
+            assert status["rows_per_second"] > 0
+
+@pytest.mark.asyncio
+async def test_ingestion_job_failure_and_unknown_job():
+    async with httpx.AsyncClient(app=app, base_url="http://testserver") as ac:
+        async def failing_ingestion(db, progress=None):
+            raise HTTPException(status_code=500, detail="Error fetching data")
+
+        with patch("app.api.endpoints.data_ingestion.run_ingestion", failing_ingestion):
+            job_id = (await ac.post("/ingest/")).json()["job_id"]
+            await ingestion_jobs.get(job_id).task
+        status = (await ac.get(f"/ingest/{job_id}")).json()
+        assert status["status"] == "failed"
+        assert "Error fetching data" in status["error"]
+        assert (await ac.get("/ingest/unknown")).status_code == 404
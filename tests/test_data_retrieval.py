@@ -1,10 +1,18 @@
+import asyncio
+import httpx
+import json
 import pytest
 from unittest.mock import patch, AsyncMock
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
 from fastapi.testclient import TestClient
 from sqlalchemy.ext.asyncio import AsyncSession
 from app.main import app
+from app.config import settings
+from app.crud import store_rows
 from app.db import get_db
 from app.models import Data
+from app.schemas import DataRecord, DataRetrievalResponse
 from datetime import datetime
 
 client = TestClient(app)
@@ -51,7 +59,8 @@ async def test_retrieve_data(setup_database):
                 "measured_at": "2023-07-25T12:00:00",
                 "value": 10.5
             }
-        ]
+        ],
+        "next_cursor": None
     }
 
 @pytest.mark.asyncio
@@ -60,6 +69,205 @@ async def test_retrieve_data_not_found():
     assert response.status_code == 404
     assert response.json() == {"detail": "No data found matching the criteria."}
 
+@pytest.fixture
+async def setup_many(async_session):
+    rows = [("hum", datetime(2023, 7, 25, hour, 0, 0), 10.5 + hour) for hour in range(5)]
+    await store_rows(rows, async_session)
+    return rows
+
+@pytest.mark.asyncio
+async def test_retrieve_data_streamed_in_batches(setup_many, monkeypatch):
+    monkeypatch.setattr(settings, "DATA_STREAM_BATCH_SIZE", 2)
+    response = client.get("/api/data", params={"datalogger": "hum", "since": "2023-07-25T01:00:00"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/json"
+    # Same bytes as the buffered response model
+    expected = DataRetrievalResponse(data=[
+        DataRecord(label=label, measured_at=measured_at.isoformat(), value=value)
+        for label, measured_at, value in setup_many[1:]
+    ])
+    assert response.content == JSONResponse(jsonable_encoder(expected)).body
+
+@pytest.mark.asyncio
+async def test_retrieve_data_ndjson(setup_many, monkeypatch):
+    monkeypatch.setattr(settings, "DATA_STREAM_BATCH_SIZE", 2)
+    response = client.get("/api/data", params={"datalogger": "hum", "before": "2023-07-25T02:00:00"},
+                          headers={"Accept": "application/x-ndjson"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert [json.loads(line) for line in response.text.splitlines()] == [
+        {"label": "hum", "measured_at": f"2023-07-25T0{hour}:00:00", "value": 10.5 + hour} for hour in range(3)
+    ]
+
+@pytest.mark.asyncio
+async def test_retrieve_data_pages(setup_many, monkeypatch):
+    monkeypatch.setattr(settings, "DATA_STREAM_BATCH_SIZE", 1)
+    monkeypatch.setattr(settings, "DATA_MAX_PAGE_SIZE", 3)
+    pages, params = [], {"datalogger": "hum", "limit": 2}
+    while True:
+        body = client.get("/api/data", params=params).json()
+        pages.append([record["value"] for record in body["data"]])
+        if body["next_cursor"] is None:
+            break
+        params["cursor"] = body["next_cursor"]
+    assert pages == [[10.5, 11.5], [12.5, 13.5], [14.5]]
+
+    # The server caps the page size
+    body = client.get("/api/data", params={"datalogger": "hum", "limit": 100}).json()
+    assert len(body["data"]) == 3
+    lines = client.get("/api/data", params={"datalogger": "hum", "cursor": body["next_cursor"]},
+                       headers={"Accept": "application/x-ndjson"}).text.splitlines()
+    assert [json.loads(line)["value"] for line in lines] == [13.5, 14.5]
+
+    # A cursor only applies to the datalogger it was issued for
+    response = client.get("/api/data", params={"datalogger": "temp", "cursor": body["next_cursor"]})
+    assert response.status_code == 400
+    response = client.get("/api/data", params={"datalogger": "hum", "cursor": "not-a-cursor"})
+    assert response.status_code == 400
+
+@pytest.mark.asyncio
+async def test_retrieve_cached_results(setup_many, async_session):
+    params = {"datalogger": "hum", "span": "hour", "since": "2023-07-25"}
+    first = client.get("/api/summary", params=params)
+    assert client.get("/api/summary", params={**params, "since": "2023-07-25T00:00:00"}).content == first.content
+    page = client.get("/api/data", params={"datalogger": "hum"})
+    assert client.get("/api/data", params={"datalogger": "hum"}).content == page.content
+    assert client.get("/api/cache").json()["hits"] == 2
+
+    # Rows written outside the cached ranges keep the entries, rows inside them invalidate the entries
+    await store_rows([("temp", datetime(2023, 7, 25, 6, 0, 0), 1.0), ("hum", datetime(2023, 7, 24), 1.0)],
+                     async_session)
+    assert client.get("/api/summary", params=params).content == first.content
+    await store_rows([("hum", datetime(2023, 7, 25, 6, 0, 0), 1.0)], async_session)
+    assert len(client.get("/api/summary", params=params).json()["data"]) == 6
+    assert len(client.get("/api/data", params={"datalogger": "hum"}).json()["data"]) == 7
+    stats = client.get("/api/cache").json()
+    assert (stats["hits"], stats["misses"], stats["invalidations"]) == (3, 4, 2)
+
+@pytest.mark.asyncio
+async def test_retrieve_data_does_not_wait_for_a_slow_client(setup_many, monkeypatch):
+    monkeypatch.setattr(settings, "DATA_STREAM_BATCH_SIZE", 1)
+    monkeypatch.setattr(settings, "RESULT_CACHE_WAIT_TIMEOUT", 0.2)
+    started, release = asyncio.Event(), asyncio.Event()
+    sent = []
+
+    # The client stays connected
+    async def receive():
+        await asyncio.Event().wait()
+
+    # The first client reads the streamed body one chunk, then stalls until released
+    async def send(message):
+        sent.append(message)
+        if message["type"] == "http.response.body" and message.get("more_body"):
+            started.set()
+            await release.wait()
+
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+             "path": "/api/data", "raw_path": b"/api/data", "query_string": b"datalogger=hum", "root_path": "",
+             "headers": [(b"host", b"test")], "client": ("test", 1), "server": ("test", 80)}
+    slow = asyncio.create_task(app(scope, receive, send))
+    await asyncio.wait_for(started.wait(), 5)
+
+    # An identical request stops waiting for it after RESULT_CACHE_WAIT_TIMEOUT and runs the query itself
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as async_client:
+        response = await asyncio.wait_for(async_client.get("/api/data", params={"datalogger": "hum"}), 5)
+    assert response.status_code == 200
+    assert [record["value"] for record in response.json()["data"]] == [value for _, _, value in setup_many]
+    assert not slow.done()
+
+    release.set()
+    await asyncio.wait_for(slow, 5)
+    assert b"".join(message.get("body", b"") for message in sent) == response.content
+
+@pytest.mark.asyncio
+async def test_retrieve_conditional(setup_many, async_session):
+    summary = client.get("/api/summary", params={"datalogger": "hum"})
+    assert summary.headers["cache-control"] == f"public, max-age={settings.SUMMARY_MAX_AGE}"
+    page = client.get("/api/data", params={"datalogger": "hum"})
+    assert page.headers["cache-control"] == "no-cache"
+    ndjson = client.get("/api/data", params={"datalogger": "hum"}, headers={"Accept": "application/x-ndjson"})
+    assert ndjson.headers["etag"] != page.headers["etag"]
+
+    with patch("app.api.endpoints.data_retrieval.result_cache") as cache:
+        response = client.get("/api/summary", params={"datalogger": "hum"},
+                              headers={"If-None-Match": summary.headers["etag"]})
+        assert response.status_code == 304 and response.content == b""
+        response = client.get("/api/data", params={"datalogger": "hum"},
+                              headers={"If-None-Match": f'"other", W/{page.headers["etag"]}'})
+        assert response.status_code == 304
+        assert response.headers["etag"] == page.headers["etag"]
+        # Answered without the cache, nor the database
+        assert not cache.mock_calls
+
+    # A write to another label keeps the tags, a write to the label changes them
+    await store_rows([("temp", datetime(2023, 7, 25, 6, 0, 0), 1.0)], async_session)
+    assert client.get("/api/data", params={"datalogger": "hum"},
+                      headers={"If-None-Match": page.headers["etag"]}).status_code == 304
+    await store_rows([("hum", datetime(2023, 7, 20), 1.0)], async_session)
+    response = client.get("/api/summary", params={"datalogger": "hum"},
+                          headers={"If-None-Match": summary.headers["etag"]})
+    assert response.status_code == 200
+    assert response.headers["etag"] != summary.headers["etag"]
+
+    # "*" matches only a representation that exists
+    for path in ("/api/data", "/api/summary"):
+        assert client.get(path, params={"datalogger": "hum"}, headers={"If-None-Match": "*"}).status_code == 304
+        assert client.get(path, params={"datalogger": "none"}, headers={"If-None-Match": "*"}).status_code == 404
+
+@pytest.mark.asyncio
+async def test_retrieve_data_csv(setup_many, monkeypatch):
+    monkeypatch.setattr(settings, "DATA_STREAM_BATCH_SIZE", 2)
+    response = client.get("/api/data", params={"datalogger": "hum", "limit": 3},
+                          headers={"Accept": "application/json;q=0.5, text/csv"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    assert response.text.splitlines() == ["label,measured_at,value"] + [
+        f"hum,2023-07-25T0{hour}:00:00,{10.5 + hour}" for hour in range(3)
+    ]
+    # The cursor of the next page is in a Link header
+    next_url = response.links["next"]["url"]
+    assert next_url.startswith("/api/data?") and "format=csv" in next_url
+    assert len(client.get(next_url).text.splitlines()) == 3
+    # format= takes precedence over the Accept header
+    response = client.get("/api/data", params={"datalogger": "hum", "format": "json"}, headers={"Accept": "text/csv"})
+    assert len(response.json()["data"]) == 5
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("data_format", ["arrow", "parquet"])
+async def test_retrieve_data_columnar(setup_many, data_format):
+    pyarrow = pytest.importorskip("pyarrow")
+    parquet = pytest.importorskip("pyarrow.parquet")
+    response = client.get("/api/data", params={"datalogger": "hum", "format": data_format})
+    assert response.status_code == 200
+    if data_format == "arrow":
+        assert response.headers["content-type"] == "application/vnd.apache.arrow.stream"
+        table = pyarrow.ipc.open_stream(response.content).read_all()
+    else:
+        assert response.headers["content-type"] == "application/vnd.apache.parquet"
+        table = parquet.read_table(pyarrow.BufferReader(response.content))
+    assert table.column_names == ["label", "measured_at", "value"]
+    assert table.column("value").to_pylist() == [row[2] for row in setup_many]
+    assert [value.replace(tzinfo=None) for value in table.column("measured_at").to_pylist()] == \
+        [row[1] for row in setup_many]
+
+@pytest.mark.asyncio
+async def test_retrieve_data_without_pyarrow(setup_many, monkeypatch):
+    monkeypatch.setattr("app.responses.pyarrow", None)
+    response = client.get("/api/data", params={"datalogger": "hum", "format": "parquet"})
+    assert response.status_code == 406
+    response = client.get("/api/data", params={"datalogger": "hum"},
+                          headers={"Accept": "application/vnd.apache.arrow.stream"})
+    assert response.status_code == 406
+    # A representation that can be produced is picked among the acceptable ones
+    response = client.get("/api/data", params={"datalogger": "hum"},
+                          headers={"Accept": "application/vnd.apache.arrow.stream, application/x-ndjson;q=0.5"})
+    assert response.headers["content-type"] == "application/x-ndjson"
+
+@pytest.mark.asyncio
+async def test_retrieve_data_invalid_bound():
+    response = client.get("/api/data", params={"datalogger": "hum", "since": "yesterday"})
+    assert response.status_code == 400
+
 @pytest.mark.asyncio
 async def test_retrieve_aggregated_data(setup_database, sample_aggregated_data):
     with patch("app.crud.get_aggregated_data", AsyncMock(return_value=sample_aggregated_data)):
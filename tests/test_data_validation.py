@@ -0,0 +1,61 @@
+import io
+import json
+import os
+import tarfile
+import pytest
+from app.data_validation import extract_files, validate_json_or_yaml
+
+@pytest.fixture
+def archive(tmp_path):
+    path = tmp_path / "datalogger.tar.gz"
+    with tarfile.open(path, "w:gz") as tar:
+        for name, content in (("datalogger/db.json", b'{"measurements": []}'), ("datalogger/node_modules/a.js", b"x")):
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            info.mtime = 1670446579
+            tar.addfile(info, io.BytesIO(content))
+    return str(path)
+
+def test_extract_files_is_skipped_when_current(archive, tmp_path):
+    extract_path = str(tmp_path / "extracted")
+    assert extract_files(archive, extract_path) is True
+    assert extract_files(archive, extract_path) is False
+
+    # A modified or missing member triggers a new extraction
+    os.remove(os.path.join(extract_path, "datalogger/node_modules/a.js"))
+    assert extract_files(archive, extract_path) is True
+    assert os.path.exists(os.path.join(extract_path, "datalogger/node_modules/a.js"))
+
+def test_extract_only_wanted_members(archive, tmp_path):
+    extract_path = str(tmp_path / "extracted")
+    assert extract_files(archive, extract_path, ["datalogger/db.json"]) is True
+    assert os.path.exists(os.path.join(extract_path, "datalogger/db.json"))
+    assert not os.path.exists(os.path.join(extract_path, "datalogger/node_modules"))
+    assert extract_files(archive, extract_path, ["datalogger/db.json"]) is False
+    # The full extraction was never recorded, so it still has to run
+    assert extract_files(archive, extract_path) is True
+
+def test_extract_unknown_member(archive, tmp_path):
+    with pytest.raises(KeyError):
+        extract_files(archive, str(tmp_path / "extracted"), ["datalogger/missing.json"])
+
+def test_validate_json_or_yaml(tmp_path):
+    files = {
+        "data.json": '{"measurements": [1, 2]}',
+        # YAML behind a .json extension, as the OpenAPI spec: the format is sniffed from the content
+        "spec.json": "openapi: '3.0.0'\ninfo:\n  title: test\n",
+        "broken.json": '{"measurements": [1, 2}',
+    }
+    for name, content in files.items():
+        (tmp_path / name).write_text(content)
+    paths = [str(tmp_path / name) for name in files] + [str(tmp_path / "missing.json")]
+    assert validate_json_or_yaml(paths) == dict(zip(paths, [True, True, False, False]))
+
+def test_validate_json_or_yaml_in_parallel(tmp_path, monkeypatch):
+    monkeypatch.setattr("app.data_validation.PARALLEL_MIN_BYTES", 0)
+    paths = []
+    for index in range(2):
+        path = tmp_path / f"data{index}.json"
+        path.write_text(json.dumps({"measurements": list(range(100))}))
+        paths.append(str(path))
+    assert validate_json_or_yaml(paths, workers=2) == {path: True for path in paths}
@@ -0,0 +1,57 @@
+import httpx
+import pytest
+from app.fetch import FeedClient
+
+@pytest.mark.asyncio
+async def test_stream_retries_transient_errors():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        if len(calls) == 1:
+            raise httpx.ConnectError("connection refused", request=request)
+        if len(calls) == 2:
+            return httpx.Response(503)
+        return httpx.Response(200, content=b"[]")
+
+    client = FeedClient(retries=2, backoff=0, transport=httpx.MockTransport(handler))
+    async with client.stream("http://feed/measurements") as response:
+        assert await response.aread() == b"[]"
+    assert len(calls) == 3
+    await client.aclose()
+
+@pytest.mark.asyncio
+async def test_stream_gives_up_after_retries():
+    def handler(request):
+        return httpx.Response(503)
+
+    client = FeedClient(retries=1, backoff=0, transport=httpx.MockTransport(handler))
+    with pytest.raises(httpx.HTTPStatusError):
+        async with client.stream("http://feed/measurements"):
+            pass
+    await client.aclose()
+
+@pytest.mark.asyncio
+async def test_conditional_request_after_remember():
+    seen_headers = []
+
+    def handler(request):
+        seen_headers.append(dict(request.headers))
+        if request.headers.get("if-none-match") == '"v1"':
+            return httpx.Response(304)
+        return httpx.Response(200, content=b"[]", headers={"ETag": '"v1"', "Last-Modified": "Wed, 07 Dec 2022 10:00:00 GMT"})
+
+    client = FeedClient(transport=httpx.MockTransport(handler))
+    async with client.stream("http://feed/measurements") as response:
+        await response.aread()
+        # Not remembered yet: the next request is still unconditional
+    async with client.stream("http://feed/measurements") as response:
+        assert response is not None
+        client.remember(response)
+    async with client.stream("http://feed/measurements") as response:
+        assert response is None
+    assert seen_headers[2]["if-modified-since"] == "Wed, 07 Dec 2022 10:00:00 GMT"
+    # Unconditional fetches ignore the remembered validators
+    async with client.stream("http://feed/measurements", conditional=False) as response:
+        assert response is not None
+    await client.aclose()
@@ -0,0 +1,51 @@
+import pytest
+from sqlalchemy import inspect, select
+from sqlalchemy.ext.asyncio import create_async_engine
+from app.migrations import MIGRATIONS, run_migrations
+from app.models import Data, SchemaMigration
+
+
+@pytest.mark.asyncio
+async def test_run_migrations_drops_legacy_indexes(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'legacy.db'}")
+    async with engine.begin() as conn:
+        # Table of the first schema: single-column indexes and no natural key index
+        await conn.exec_driver_sql(
+            "CREATE TABLE data (id INTEGER PRIMARY KEY, label VARCHAR, measured_at DATETIME, value FLOAT)"
+        )
+        for column in ("id", "label", "measured_at", "value"):
+            await conn.exec_driver_sql(f"CREATE INDEX ix_data_{column} ON data ({column})")
+        await conn.run_sync(SchemaMigration.__table__.create)
+
+        assert await conn.run_sync(run_migrations) == [version for version, _, _ in MIGRATIONS]
+        indexes = await conn.run_sync(lambda sync_conn: inspect(sync_conn).get_indexes(Data.__tablename__))
+        assert [(index["name"], index["column_names"]) for index in indexes] == [
+            ("uq_data_label_measured_at", ["label", "measured_at"])
+        ]
+        # Applied migrations are recorded and not run again
+        assert await conn.run_sync(run_migrations) == []
+        versions = (await conn.execute(select(SchemaMigration.version))).scalars().all()
+        assert versions == [version for version, _, _ in MIGRATIONS]
+    await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_run_migrations_removes_duplicates(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'duplicates.db'}")
+    async with engine.begin() as conn:
+        # The first ingestion inserted every run again
+        await conn.exec_driver_sql(
+            "CREATE TABLE data (id INTEGER PRIMARY KEY, label VARCHAR, measured_at DATETIME, value FLOAT)"
+        )
+        await conn.exec_driver_sql(
+            "INSERT INTO data (label, measured_at, value) VALUES "
+            "('temp', '2022-12-01 00:00:00.000000', 1.0), ('temp', '2022-12-01 00:00:00.000000', 1.0), "
+            "('hum', '2022-12-01 00:00:00.000000', 70.0), ('temp', '2022-12-01 00:15:00.000000', 2.0), "
+            "('temp', '2022-12-01 00:00:00.000000', 1.0)"
+        )
+        await conn.run_sync(SchemaMigration.__table__.create)
+
+        await conn.run_sync(run_migrations)
+        rows = (await conn.execute(select(Data.id, Data.label, Data.value).order_by(Data.id))).all()
+        assert [tuple(row) for row in rows] == [(1, "temp", 1.0), (3, "hum", 70.0), (4, "temp", 2.0)]
+    await engine.dispose()
@@ -0,0 +1,39 @@
+import pytest
+from datetime import datetime
+from app.config import settings
+from app.responses import encode_aggregates, stream_json, stream_ndjson
+from app.storage import Record
+
+# Values whose JSON spelling differs between encoders
+VALUES = [10.5, 3.0, -0.0, 1e-05, 1.5e-07, 0.0001, 1e+16, 1.2345678901234568e+17, 12345.678]
+RECORDS = [Record("témp", datetime(2022, 12, 1, 0, 5, 0, 250000 * (i % 2)), value) for i, value in enumerate(VALUES)]
+AGGREGATES = [
+    {"label": "temp", "measured_at": "2022-12-01", "value": 7, "min_value": 1e-05, "max_value": 16.0},
+    {"label": "temp", "measured_at": "2022-12-02", "value": 2.5, "min_value": None, "max_value": None},
+]
+
+async def body(stream) -> bytes:
+    return b"".join([chunk async for chunk in stream])
+
+async def batches():
+    for start in range(0, len(RECORDS), 2):
+        yield RECORDS[start:start + 2]
+
+async def encodings():
+    return (await body(stream_json(batches(), lambda: "cursor")), await body(stream_ndjson(batches())),
+            encode_aggregates(AGGREGATES))
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("orjson_installed", [True, False])
+async def test_fast_json_is_byte_compatible(monkeypatch, orjson_installed):
+    expected = await encodings()
+    monkeypatch.setattr(settings, "FAST_JSON_RESPONSES", True)
+    if not orjson_installed:
+        monkeypatch.setattr("app.responses.orjson", None)
+    assert await encodings() == expected
+
+@pytest.mark.asyncio
+async def test_fast_json_refuses_nan(monkeypatch):
+    monkeypatch.setattr(settings, "FAST_JSON_RESPONSES", True)
+    with pytest.raises(ValueError):
+        encode_aggregates([{"label": "temp", "measured_at": "2022-12-01", "value": float("nan")}])
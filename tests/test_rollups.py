@@ -0,0 +1,97 @@
+import httpx
+import pytest
+from datetime import datetime
+from unittest.mock import patch
+from sqlalchemy.future import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.api.endpoints.data_ingestion import _run_ingestion_job
+from app.crud import store_rows, get_aggregated_data
+from app.fetch import FeedClient
+from app.jobs import IngestionJob
+from app.models import Data, DataRollup
+from app.rollups import _plan_range, backfill_rollups
+from app.storage import StorageLayout
+
+ROWS = [
+    ("temp", datetime(2022, 11, 30, 23, 10), 1.0),
+    ("temp", datetime(2022, 12, 1, 0, 5), 2.0),
+    ("temp", datetime(2022, 12, 1, 0, 50), 4.0),
+    ("temp", datetime(2022, 12, 1, 13, 0), 8.0),
+    ("temp", datetime(2022, 12, 2, 1, 0), 16.0),
+    ("hum", datetime(2022, 12, 1, 0, 5), 70.0),
+]
+
+async def raw_aggregates(db, label, span, since=None, before=None):
+    async def no_rollups(*args):
+        return False
+    with patch("app.crud.has_rollups", no_rollups):
+        return await get_aggregated_data(db, label, span, since, before)
+
+def test_plan_range():
+    assert _plan_range(datetime(2022, 11, 30, 23, 10), datetime(2022, 12, 2, 1, 0), ("day", "hour")) == [
+        ("day", datetime(2022, 12, 1), datetime(2022, 12, 2)),
+        # No whole hour before midnight: the edge is left to the raw data
+        (None, datetime(2022, 11, 30, 23, 10), datetime(2022, 12, 1)),
+        ("hour", datetime(2022, 12, 2), datetime(2022, 12, 2, 1)),
+    ]
+    assert _plan_range(None, None, ("month", "day", "hour")) == [("month", None, None)]
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("span", ["hour", "day", "month"])
+@pytest.mark.parametrize("since, before", [
+    (None, None),
+    ("2022-12-01", "2022-12-02T00:00:00"),
+    ("2022-11-30T23:30:00", "2022-12-01 13:00:00"),
+    ("2022-12-01T00:05:00+00:00", None),
+])
+async def test_summary_from_rollups_matches_raw_data(async_session: AsyncSession, span, since, before):
+    await store_rows(ROWS, async_session, on_conflict="ignore")
+    # Already stored rows are not counted twice
+    await store_rows(ROWS[:3], async_session, on_conflict="ignore")
+    summary = await get_aggregated_data(async_session, "temp", span, since, before)
+    assert summary == await raw_aggregates(async_session, "temp", span, since, before)
+    assert summary
+
+@pytest.mark.asyncio
+async def test_rollups_follow_updated_values(async_session: AsyncSession):
+    await store_rows(ROWS, async_session)
+    await store_rows([("temp", datetime(2022, 12, 1, 0, 50), 1.5)], async_session, on_conflict="update")
+    summary = await get_aggregated_data(async_session, "temp", "hour", "2022-12-01", "2022-12-01T00:59:00")
+    assert summary == [{"label": "temp", "measured_at": "2022-12-01 00:00:00", "value": 1.75,
+                        "min_value": 1.5, "max_value": 2.0}]
+
+@pytest.mark.asyncio
+async def test_backfill_rollups(async_session: AsyncSession):
+    async_session.add_all([Data(label=label, measured_at=measured_at, value=value) for label, measured_at, value in ROWS])
+    await async_session.commit()
+    # Aggregated by the database, without loading the raw rows
+    with patch.object(StorageLayout, "fetch_rows", side_effect=AssertionError("raw rows loaded")):
+        assert await backfill_rollups(async_session) is True
+    months = (await async_session.execute(
+        select(DataRollup.bucket, DataRollup.count).where(DataRollup.label == "temp", DataRollup.span == "month")
+        .order_by(DataRollup.bucket)
+    )).all()
+    assert months == [("2022-11", 1), ("2022-12", 4)]
+    assert await backfill_rollups(async_session) is False
+
+@pytest.mark.asyncio
+async def test_ingestion_job_backfills_rollups_first(async_session: AsyncSession, async_session_factory):
+    async_session.add_all([Data(label=label, measured_at=measured_at, value=value) for label, measured_at, value in ROWS])
+    await async_session.commit()
+    # A measurement of December 3rd (UTC), newer than the stored ones
+    feed = [{"1670025600000": {"temp": 32.0}}]
+    client = FeedClient(transport=httpx.MockTransport(lambda request: httpx.Response(200, json=feed)))
+    with patch("app.api.endpoints.data_ingestion.feed_client", client), \
+            patch("app.api.endpoints.data_ingestion.AsyncSessionLocal", async_session_factory):
+        await _run_ingestion_job(IngestionJob())
+    months = (await async_session.execute(
+        select(DataRollup.bucket, DataRollup.count).where(DataRollup.label == "temp", DataRollup.span == "month")
+        .order_by(DataRollup.bucket)
+    )).all()
+    # The stored rows were rolled up before the new one was added
+    assert months == [("2022-11", 1), ("2022-12", 5)]
+
+@pytest.mark.asyncio
+async def test_get_aggregated_data_invalid_bound(async_session: AsyncSession):
+    with pytest.raises(ValueError):
+        await get_aggregated_data(async_session, "temp", "day", since="yesterday")
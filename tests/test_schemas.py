@@ -5,7 +5,6 @@ from app.schemas import (
     DataRecord,
     DataRetrievalResponse,
     AggregatedDataRecord,
-    DataIngestionResponse,
     AggregatedDataRetrievalResponse
 )
 
@@ -61,10 +60,6 @@ def test_aggregated_data_record():
     assert agg_data_record.max_value == 15.0
     assert AggregatedDataRecord.Config.model_config.get('arbitrary_types_allowed') is True
 
-def test_data_ingestion_response():
-    response = DataIngestionResponse(message="Data ingested successfully")
-    assert response.message == "Data ingested successfully"
-
 def test_aggregated_data_retrieval_response():
     agg_data_records = [
         AggregatedDataRecord(
@@ -0,0 +1,106 @@
+import pytest
+from datetime import datetime
+from unittest.mock import patch
+from sqlalchemy import func
+from sqlalchemy.future import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.config import settings
+from app.crud import store_rows, store_data_in_db, get_data, get_aggregated_data, get_daily_aggregates, \
+    get_aggregated_data_by_label_and_hour, check_duplicate_data, get_watermarks, delete_all_data, encode_cursor
+from app.models import Data, DataCompact, DataWide
+from app.schemas import DataCreate
+from app.storage import COMPACT_LAYOUT, ROW_LAYOUT, STORAGE_LAYOUTS, WIDE_LAYOUT, get_layout, to_epoch_ms
+
+ROWS = [
+    ("temp", datetime(2022, 11, 30, 23, 10), 1.0),
+    ("temp", datetime(2022, 12, 1, 0, 5, 0, 250000), 2.0),
+    ("temp", datetime(2022, 12, 1, 13, 0), 8.0),
+    ("temp", datetime(2022, 12, 2, 1, 0), 16.0),
+    ("hum", datetime(2022, 12, 1, 0, 5), 70.0),
+]
+
+@pytest.fixture
+def layout(request, monkeypatch):
+    monkeypatch.setattr(settings, "STORAGE_LAYOUT", request.param)
+    return request.param
+
+# Function to read everything crud exposes about the stored rows
+async def snapshot(db: AsyncSession):
+    async def no_rollups(*args):
+        return False
+    with patch("app.crud.has_rollups", no_rollups):
+        summaries = [await get_aggregated_data(db, "temp", span) for span in ("hour", "day", "month")]
+    return {
+        "data": [tuple(row) for row in await get_data(db, "temp", "2022-12-01", "2022-12-02T01:00:00")],
+        "page": [tuple(row) for row in await get_data(db, "temp", cursor=encode_cursor("temp", ROWS[1][1]), limit=1)],
+        "summaries": summaries,
+        "rolled_up": await get_aggregated_data(db, "temp", "day", "2022-11-30T23:30:00"),
+        "daily": await get_daily_aggregates(db),
+        "hourly": await get_aggregated_data_by_label_and_hour(db, "temp"),
+        "watermarks": await get_watermarks(db),
+    }
+
+@pytest.mark.asyncio
+async def test_layouts_are_transparent(async_session: AsyncSession, monkeypatch):
+    snapshots = {}
+    for layout in STORAGE_LAYOUTS:
+        monkeypatch.setattr(settings, "STORAGE_LAYOUT", layout)
+        await store_rows(ROWS, async_session, on_conflict="ignore")
+        snapshots[layout] = await snapshot(async_session)
+        await delete_all_data(async_session)
+    assert snapshots[COMPACT_LAYOUT] == snapshots[ROW_LAYOUT]
+    assert snapshots[WIDE_LAYOUT] == snapshots[ROW_LAYOUT]
+    assert snapshots[ROW_LAYOUT]["data"] == [tuple(row) for row in ROWS[1:4]]
+    assert snapshots[ROW_LAYOUT]["page"] == [ROWS[2]]
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("layout", [COMPACT_LAYOUT], indirect=True)
+async def test_compact_layout_storage(async_session: AsyncSession, layout):
+    assert await store_rows(ROWS, async_session) == len(ROWS)
+    stored = (await async_session.execute(select(DataCompact.measured_at).order_by(DataCompact.measured_at))).scalars()
+    assert list(stored)[:2] == [to_epoch_ms(datetime(2022, 11, 30, 23, 10)), 1669853100000]
+    assert (await async_session.execute(select(func.count()).select_from(Data))).scalar() == 0
+
+    # Conflicts on the (datalogger, measured_at) key: the row is skipped, nothing is written
+    assert await store_rows([("temp", datetime(2022, 11, 30, 23, 10), 5.0)], async_session, on_conflict="ignore") == 0
+    await store_rows([("temp", datetime(2022, 12, 2, 1, 0), 32.0)], async_session, on_conflict="update")
+    data = await get_data(async_session, "temp")
+    assert [row.value for row in data] == [1.0, 2.0, 8.0, 32.0]
+
+    duplicates = await check_duplicate_data([
+        DataCreate(label="hum", measured_at=datetime(2022, 12, 1, 0, 5), value=70.0),
+        DataCreate(label="pressure", measured_at=datetime(2022, 12, 1, 0, 5), value=1.0),
+    ], async_session)
+    assert [record.label for record in duplicates] == ["hum"]
+
+    with pytest.raises(ValueError):
+        await store_data_in_db([DataCreate(label="temp", measured_at=datetime(2023, 1, 1), value=1.0)],
+                               async_session, use_orm=True)
+
+@pytest.mark.parametrize("layout", ["columnar"], indirect=True)
+def test_invalid_storage_layout(layout):
+    with pytest.raises(ValueError):
+        get_layout()
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("layout", [WIDE_LAYOUT], indirect=True)
+async def test_wide_layout_storage(async_session: AsyncSession, layout):
+    measured_at = datetime(2022, 12, 1, 0, 15)
+    # The metrics of a reading written by separate chunks end up in one row
+    await store_rows([("temp", measured_at, 7.0), ("hum", measured_at, 60.0)], async_session, chunk_size=1)
+    await store_rows([("temp", measured_at, 9.0), ("precip", measured_at, 0.5)], async_session, on_conflict="ignore")
+    readings = (await async_session.execute(select(DataWide))).scalars().all()
+    assert [(row.temp, row.hum, row.precip) for row in readings] == [(7.0, 60.0, 0.5)]
+    # Only the metric that was stored counts in the summaries
+    summary = await get_aggregated_data(async_session, "temp", "hour")
+    assert [(row["value"], row["max_value"]) for row in summary] == [(7.0, 7.0)]
+
+    await store_rows([("temp", measured_at, 9.0)], async_session, on_conflict="update")
+    assert [row.value for row in await get_data(async_session, "temp")] == [9.0]
+    assert await get_aggregated_data(async_session, "temp", "hour") == [
+        {"label": "temp", "measured_at": "2022-12-01 00:00:00", "value": 9.0, "min_value": 9.0, "max_value": 9.0}
+    ]
+    assert await get_data(async_session, "pressure") == []
+
+    with pytest.raises(ValueError):
+        await store_rows([("pressure", measured_at, 1013.0)], async_session)
@@ -0,0 +1,63 @@
+import json
+import pytest
+from app.streaming import MeasurementStreamParser
+
+MEASUREMENTS = [
+    {"1609460079000": {"precip": 0.0, "temp": -2.3, "hum": 92.5}, "1609460980000": {"precip": None, "temp": -2.2}},
+    {"1609461880000": {"precip": 0.0, "temp": 12345, "hum": 92.5}},
+]
+
+def parse(document: bytes, chunk_size: int, **kwargs):
+    parser = MeasurementStreamParser(**kwargs)
+    pairs = []
+    for start in range(0, len(document), chunk_size):
+        pairs += parser.feed(document[start:start + chunk_size])
+    pairs += parser.close()
+    return pairs
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 16, 1 << 16])
+def test_parse_array_in_chunks(chunk_size):
+    document = json.dumps(MEASUREMENTS).encode()
+    expected = [(timestamp, values) for record in MEASUREMENTS for timestamp, values in record.items()]
+    assert parse(document, chunk_size) == expected
+
+def test_parse_single_object():
+    document = json.dumps(MEASUREMENTS[0]).encode()
+    assert parse(document, 5) == list(MEASUREMENTS[0].items())
+
+def test_parse_root_key():
+    document = json.dumps({"other": [{"x": 1}], "measurements": MEASUREMENTS[1:], "extra": 1}).encode()
+    assert parse(document, 4, root_key="measurements") == list(MEASUREMENTS[1].items())
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 7])
+def test_parse_root_key_skips_unrelated_values(chunk_size):
+    other = {"a": ["]", "}", "\\", "q\"{["], "b": [[{"c": None}], 1.5e3], "s": "x\\\"]"}
+    document = json.dumps({"other": other, "name": "\"}{", "count": 12, "flag": True,
+                           "measurements": MEASUREMENTS[1:]}).encode()
+    assert parse(document, chunk_size, root_key="measurements") == list(MEASUREMENTS[1].items())
+
+def test_unrelated_root_value_is_scanned_once():
+    # The skipped text is dropped as it is scanned, the buffer does not grow with the value
+    parser = MeasurementStreamParser(root_key="measurements")
+    parser.feed(b'{"other": [')
+    for _ in range(1000):
+        assert parser.feed(b'{"x": "]}", "y": [1, 2]}, ') == []
+        assert len(parser._buffer) < 64
+    pairs = parser.feed(b'{}], "measurements": ' + json.dumps(MEASUREMENTS[1:]).encode() + b'}')
+    assert pairs + parser.close() == list(MEASUREMENTS[1].items())
+    assert parser.done
+
+def test_unrelated_root_value_mismatched_brackets():
+    parser = MeasurementStreamParser(root_key="measurements")
+    with pytest.raises(ValueError):
+        parser.feed(b'{"other": [1, 2}, "measurements": []}')
+
+def test_non_object_entries_are_reported():
+    document = json.dumps([3, {"k\"ey": {"temp": 1.0}}]).encode()
+    assert parse(document, 2) == [(None, 3), ("k\"ey", {"temp": 1.0})]
+
+def test_truncated_document():
+    parser = MeasurementStreamParser()
+    parser.feed(b'[{"1609460079000": {"temp": 1.')
+    with pytest.raises(ValueError):
+        parser.close()
@@ -0,0 +1,34 @@
+import pytest
+from datetime import datetime
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import asyncpg
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.crud import store_rows
+from app.models import Data
+from app.time_buckets import POSTGRESQL_FORMATS, time_bucket
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("span, expected", [
+    ("hour", "2022-12-31 01:00:00"),
+    ("day", "2022-12-31"),
+    ("month", "2022-12"),
+])
+async def test_time_bucket(async_session: AsyncSession, span, expected):
+    await store_rows([("temp", datetime(2022, 12, 31, 1, 59, 59, 999999), 1.0)], async_session)
+    result = await async_session.execute(select(time_bucket(span, Data.measured_at)))
+    assert result.scalar_one() == expected
+
+@pytest.mark.parametrize("span", ["hour", "day", "month"])
+def test_time_bucket_postgresql_grouping(span):
+    bucket = time_bucket(span, Data.measured_at)
+    statement = select(Data.label, bucket, func.count()).group_by(bucket, Data.label).order_by(bucket, Data.label)
+    sql = str(statement.compile(dialect=asyncpg.dialect()))
+    expression = f"to_char(date_trunc('{span}', data.measured_at), '{POSTGRESQL_FORMATS[span]}')"
+    # SELECT, GROUP BY and ORDER BY render the same bucket expression, without bind parameters
+    assert sql.count(expression) == 3
+    assert "$" not in sql
+
+def test_time_bucket_invalid_span():
+    with pytest.raises(ValueError):
+        time_bucket("week", Data.measured_at)